@@ -1,2 +1,5 @@
 from .authorization_server import AuthorizationServer, Grant
 from .access_token import AccessToken
+from .signing_service import SigningService, SigningServiceOverloaded, SigningServiceUnavailable
+from .store import SQLiteStore
+from .key_ring import KeyRing
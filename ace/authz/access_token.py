@@ -1,18 +1,31 @@
 import os
 
+from cbor2 import dumps
+
 from ace.cbor.constants import Keys as CK
 from ace.cose.constants import Key
 from ace.cose import CoseKey
 import ace.cose.cwt as cwt
-from ecdsa import SigningKey
+from ace.cose.cwt import CwtTemplate
+from ace.cose.signing import Signer, as_signer
+from ace.authz.signing_service import SigningService
+
+
+# Length of the random reference of a token in bytes
+REFERENCE_LENGTH = 16
 
 
 class AccessToken:
 
-    def __init__(self, claims: dict):
-        self._reference: str = os.urandom(16).hex()
+    def __init__(self, claims: dict, reference: bytes = None, bound_key: CoseKey = None):
+        """
+        :param claims: Claims of the token
+        :param reference: Reference of a restored token, a new one is created if None
+        :param bound_key: PoP key of a restored token, whose CNF claim is already set
+        """
+        self._reference: bytes = os.urandom(REFERENCE_LENGTH) if reference is None else reference
         self._claims = claims
-        self._bound_key = None
+        self._bound_key = bound_key
 
     def bind_key(self, key: CoseKey):
         self._bound_key = key
@@ -22,18 +35,56 @@ class AccessToken:
             CK.CNF: { Key.COSE_KEY: key.encode()}
         })
 
-    def sign_and_export_self_contained(self, key: SigningKey, key_id: bytes) -> str:
-        return cwt.encode(self._claims, key, key_id)
+    def sign_and_export_self_contained(self, key: Signer, key_id: bytes = None, template: CwtTemplate = None) -> bytes:
+        """
+        :param key_id: Key id written to the token, unless a template with pre-encoded headers is given
+        """
+        signer = as_signer(key)
+        return self._prepare(key_id, template, signer.algorithm).serialize_signed(signer)
+
+    async def sign_and_export_self_contained_async(self,
+                                                   service: SigningService,
+                                                   key_id: bytes = None,
+                                                   template: CwtTemplate = None) -> bytes:
+        message = self._prepare(key_id, template, service.signer.algorithm)
+
+        if service.signer.prehash:
+            signature = await service.sign_digest(message.digest())
+        else:
+            signature = await service.sign(message.to_be_signed())
+
+        return message.serialize(signature)
+
+    def mac_and_export_self_contained(self, key: bytes, key_id: bytes = None, template: CwtTemplate = None) -> bytes:
+        """
+        :param key: HMAC key shared with the audience, the algorithm is taken from the template
+        """
+        if template is not None:
+            return template.encode_mac(self._claims, key)
+
+        return cwt.encode_mac(self._claims, key, key_id)
+
+    def _prepare(self, key_id: bytes, template: CwtTemplate, alg: int):
+        if template is not None:
+            return template.prepare(self._claims)
+
+        return cwt.prepare(self._claims, key_id, alg)
 
-    def export_referential(self):
-        return self.reference
+    def export_referential(self) -> bytes:
+        """
+        :return: The reference as a CBOR byte string, which the resource server introspects at the AS
+        """
+        return dumps(self.reference)
 
     @property
     def issuer(self) -> str:
         return self._claims[CK.ISS]
 
     @property
-    def cti(self) -> str:
+    def cti(self):
+        """
+        :return: The token ID, bytes for compact tokens
+        """
         return self._claims[CK.CTI]
 
     @property
@@ -41,7 +92,10 @@ class AccessToken:
         return self._claims[CK.AUD]
 
     @property
-    def scope(self) -> str:
+    def scope(self):
+        """
+        :return: The scope, an integer mask for compact tokens
+        """
         return self._claims[CK.SCOPE]
 
     @property
@@ -57,7 +111,7 @@ class AccessToken:
         return self._bound_key
 
     @property
-    def reference(self) -> str:
+    def reference(self) -> bytes:
         return self._reference
 
     @property
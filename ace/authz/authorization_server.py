@@ -1,3 +1,4 @@
+import asyncio
 import time
 import os
 
@@ -9,34 +10,193 @@ from collections import namedtuple
 from typing import Dict
 
 from ace.cbor.constants import Keys as CK
-from ace.cose.constants import Key as Cose
+from ace.cose.constants import Key as Cose, Algorithm
 from ace.cose import CoseKey
+from ace.cose.cwt import CwtTemplate
+from ace.cose.signing import as_signer, as_verifier
+from ace.scope import ScopeMap
+from ace.cache import ExpiringDict
+from ace.cbor.cbor import encode_head, ARRAY
 from .client_registry import ClientRegistry, Client
 from .key_registry import KeyRegistry
 from .token_registry import TokenRegistry
+from .signing_service import SigningService, SigningServiceOverloaded
+from .key_ring import KeyRing, AsKey
+from .store import SQLiteStore
 from ace.authz.access_token import AccessToken
 
 
+# Introspection response for unknown, expired and malformed tokens
+INACTIVE = dumps({CK.ACTIVE: False})
+
+
+class TokenRequestError(Exception):
+
+    def __init__(self, error: str, status: int = 400):
+        super().__init__(error)
+        self.error = error
+        self.status = status
+
+
 class AuthorizationServer():
 
-    def __init__(self, identity: SigningKey, router: AbstractRouter):
+    ISSUER = 'ace.as-server.com'
+    KEY_ID = b'ace.as-server.com'
+
+    # Lifetime of issued tokens in seconds
+    TOKEN_LIFETIME = 7200.0
+
+    # Length of the binary cti of compact tokens
+    CTI_LENGTH = 8
+
+    def __init__(self,
+                 identity: SigningKey,
+                 router: AbstractRouter,
+                 signing_service: SigningService = None,
+                 registry_capacity: int = None,
+                 store: SQLiteStore = None):
+        """
+        :param identity: Private key of the authorization server, used under KEY_ID. Further keys are
+                         added with add_signing_key()
+        :param router: Router to register the endpoints with
+        :param signing_service: Optional service signing tokens with identity off the event loop
+        :param registry_capacity: Maximum number of issued tokens and PoP keys kept in memory, None for no limit
+        :param store: Optional persistent store for issued tokens and PoP keys
+        """
         self.identity = identity
+        self.signer = as_signer(identity)
+        self.signing_service = signing_service
+        self.key_ring = KeyRing()
+        self.key_ring.add(self.KEY_ID, self.signer, signing_service=signing_service)
         self.client_registry = ClientRegistry()
-        self.key_registry = KeyRegistry()
-        self.token_registry = TokenRegistry()
+        self.key_registry = KeyRegistry(capacity=registry_capacity, store=store)
+        self.token_registry = TokenRegistry(capacity=registry_capacity, store=store)
         self.resource_servers: Dict[str, ResourceServer] = {}
 
+        # (client_id, audience) => mask of the scopes granted to the client
+        self.grants: Dict[tuple, int] = {}
+
+        # (kid, audience) => CWT template of the tokens signed with the key for the audience
+        self.templates: Dict[tuple, CwtTemplate] = {}
+
+        # Issued token => its encoded introspection response
+        self.introspection_responses = ExpiringDict(capacity=registry_capacity)
+
+        # Maximum number of token requests accepted by /token/batch
+        self.max_batch_size = 1024
+
+        # client_id => audience of the resource server introspecting with it
+        self.introspecting_clients: Dict[str, str] = {}
+
+        # Maximum number of tokens accepted by /introspect/batch
+        self.max_introspection_batch = 1024
+
         router.add_post('/token', self.token)
+        router.add_post('/token/batch', self.token_batch)
         router.add_post('/introspect', self.introspect)
+        router.add_post('/introspect/batch', self.introspect_batch)
 
     def register_client(self, client_id, client_secret, grants):
+        # Drop the grants of a previous registration
+        previous = self.client_registry.get_client(client_id)
+        for grant in (previous.grants if previous is not None else []):
+            self.grants.pop((client_id, grant.audience), None)
+
         self.client_registry.register_client(Client(client_id, client_secret, grants))
 
-    def register_resource_server(self, audience, scopes, public_key):
-        self.resource_servers[audience] = ResourceServer(audience, scopes, public_key)
+        for grant in grants:
+            self._compile_grant(client_id, grant)
+
+    def register_resource_server(self, audience, scopes, public_key, mac_key: bytes = None,
+                                 mac_alg: int = Algorithm.HMAC_256_256, compact: bool = False,
+                                 referential: bool = False, client_id: str = None, client_secret: bytes = None):
+        """
+        :param mac_key: Key shared with the resource server. If given, tokens for the audience are
+                        MACed (COSE_Mac0) instead of signed, which is much cheaper to verify
+        :param mac_alg: HMAC algorithm used with mac_key
+        :param compact: Issue compact tokens for the audience, whose scope is the integer mask of the
+                        scopes in the order given here and whose cti is binary. Tokens requested with
+                        an integer scope are always compact
+        :param referential: Issue short references instead of self-contained tokens for the audience,
+                            which the resource server resolves at /introspect
+        :param client_id: ID the resource server authenticates with at /introspect, it only learns
+                          about tokens for its own audience
+        :param client_secret: Secret the resource server authenticates with at /introspect
+        """
+        public_key = as_verifier(public_key)
+
+        # Tokens signed by the AS use the templates of the current signing key instead
+        template = None
+        if mac_key is not None:
+            template = CwtTemplate(kid=self.KEY_ID, static_claims={CK.ISS: self.ISSUER, CK.AUD: audience}, alg=mac_alg)
+
+        self.resource_servers[audience] = ResourceServer(
+            audience=audience,
+            scopes=scopes,
+            public_key=public_key,
+            scope_map=ScopeMap(scopes),
+            cnf=CoseKey(public_key, b'rs_pub_key', CoseKey.Type.ECDSA).encode(),
+            template=template,
+            mac_key=mac_key,
+            compact=compact,
+            referential=referential
+        )
+
+        if client_id is not None:
+            self.client_registry.register_client(Client(client_id, client_secret, []))
+            self.introspecting_clients[client_id] = audience
+
+        for key in [key for key in self.templates if key[1] == audience]:
+            del self.templates[key]
+
+        # Grants registered before the resource server only become effective now
+        for client in self.client_registry.registered_clients:
+            self.grants.pop((client.client_id, audience), None)
+            for grant in client.grants:
+                if grant.audience == audience:
+                    self._compile_grant(client.client_id, grant)
+
+    def _compile_grant(self, client_id, grant: 'Grant'):
+        rs = self.resource_servers.get(grant.audience)
+        if rs is None:
+            return
+
+        key = (client_id, grant.audience)
+        self.grants[key] = self.grants.get(key, 0) | rs.scope_map.mask(grant.scopes, strict=False)
+
+    def add_signing_key(self, key, kid: bytes, activates: float = None, retires: float = None,
+                        signing_service: SigningService = None):
+        """
+        Add a signing key, e.g. to rotate keys at runtime. Resource servers need to trust the key by
+        its kid before it activates, see trusted_keys()
+        :param activates: Time from which tokens are signed with key, None for immediately
+        :param retires: Time from which tokens are no longer signed with key, None for never
+        """
+        self.key_ring.add(kid, key, activates, retires, signing_service)
+
+        for template_key in [template_key for template_key in self.templates if template_key[0] == kid]:
+            del self.templates[template_key]
+
+    def retire_signing_key(self, kid: bytes, when: float = None):
+        """
+        Stop signing with the key under kid from when on, immediately if None
+        """
+        self.key_ring.retire(kid, when)
+
+    def trusted_keys(self) -> dict:
+        """
+        :return: kid => (Verifier, expiry) of all keys tokens may still be signed with, the expiry is
+                 None or the time the last token signed with the key expires
+        """
+        return {
+            as_key.kid: (as_key.signer.verifier(),
+                         None if as_key.retires is None else as_key.retires + self.TOKEN_LIFETIME)
+            for as_key in self.key_ring.keys()
+        }
 
     def public_key(self):
-        self.identity.get_verifying_key()
+        as_key = self.key_ring.current()
+        return (self.signer if as_key is None else as_key.signer).verifier()
 
     def verify_client(self, client_id, client_secret):
         return self.client_registry.check_secret(client_id, client_secret)
@@ -50,73 +210,172 @@ class AuthorizationServer():
 
         params = loads(await request.content.read())
 
+        try:
+            response = await self._issue(*self._grant(params))
+        except TokenRequestError as e:
+            return web.Response(status=e.status, body=dumps({'error': e.error}))
+
+        return web.Response(status=200, body=dumps(response))
+
+    # POST
+    async def token_batch(self, request):
+        """
+        Grants access tokens for a CBOR array of token requests, e.g. for gateways provisioning many
+        devices at once. Each request is checked like a request to /token; the response is an array
+        holding either the token response or an error map for each request, in request order.
+        """
+
+        requests = loads(await request.content.read())
+
+        if not isinstance(requests, list) or len(requests) > self.max_batch_size:
+            return web.Response(status=400, body=dumps({'error': 'invalid_request'}))
+
+        async def issue(params):
+            try:
+                return await self._issue(*self._grant(params))
+            except TokenRequestError as e:
+                return {'error': e.error}
+
+        # Signatures of all requests are queued together and batched by the signing service
+        responses = await asyncio.gather(*[issue(params) for params in requests])
+
+        return web.Response(status=200, body=dumps(responses))
+
+    def _grant(self, params: dict):
+        """
+        Validate a token request and create the access token
+        :return: (client_id, resource server, PoP key, access token)
+        :raises TokenRequestError: If the request is not valid
+        """
+
         # Verify basic request
         if not self._verify_token_request(params):
-            return web.Response(status=400, body=dumps({'error': 'invalid_request'}))
+            raise TokenRequestError('invalid_request')
 
         client_id = params[CK.CLIENT_ID]
         client_secret = params[CK.CLIENT_SECRET]
 
         # Check if client is registered
         if not self.verify_client(client_id, client_secret):
-            return web.Response(status=400, body=dumps({'error': 'unauthorized_client'}))
+            raise TokenRequestError('unauthorized_client')
 
         # Check if audience exists
         requested_audience = params[CK.AUD]
         if requested_audience not in self.resource_servers.keys():
-            return web.Response(status=400, body=dumps({'error': 'unknown_audience'}))
+            raise TokenRequestError('unknown_audience')
 
         # Retrieve Resource Server for Audience
         rs = self.resource_servers[requested_audience]
 
         # Check if RS has requested scopes
-        requested_scopes = params[CK.SCOPE].split(",")
-        if not all(elem in rs.scopes for elem in requested_scopes):
-            return web.Response(status=400, body=dumps({'error': 'unknown_scope'}))
+        requested_scopes = rs.scope_map.mask(params[CK.SCOPE])
+        if requested_scopes is None:
+            raise TokenRequestError('unknown_scope')
 
         # Check if client is allowed to access scopes on audience
-        # TODO
+        if requested_scopes & ~self.grants.get((client_id, requested_audience), 0):
+            raise TokenRequestError('invalid_scope')
 
         # Extract Clients Public PoP key
-        client_pop_key = CoseKey.from_cose(params[CK.CNF][Cose.COSE_KEY])
+        try:
+            client_pop_key = CoseKey.from_cose(params[CK.CNF][Cose.COSE_KEY])
+        except (KeyError, ValueError, TypeError, AssertionError):
+            # Malformed COSE_Key or a point not on the curve
+            raise TokenRequestError('invalid_request')
+
+        # Clients asking for a mask understand compact tokens
+        compact = rs.compact or isinstance(params[CK.SCOPE], int)
 
         # Extract client claims scope and audience
-        client_claims = {k: params[k] for k in (CK.SCOPE, CK.AUD)}
+        client_claims = {
+            CK.SCOPE: requested_scopes if compact else self._scope_names(rs, params[CK.SCOPE]),
+            CK.AUD: requested_audience
+        }
 
         # Create access token, bind PoP key
-        token = self._bind_token(client_claims, client_pop_key)
+        token = self._bind_token(client_claims, client_pop_key, compact)
 
-        # Register bound PoP key for later reference
-        self.key_registry.add_key(client_id, client_pop_key)
-        self.token_registry.add_token(token, self_contained=True)
+        return client_id, rs, client_pop_key, token
 
-        token_sent = token.sign_and_export_self_contained(self.identity, key_id=b'ace.as-server.com')
-        # token_sent = token.export_referential()
+    async def _issue(self, client_id, rs: 'ResourceServer', client_pop_key: CoseKey, token: AccessToken) -> dict:
+        """
+        Sign and register a granted access token
+        :return: The token response
+        """
+        if rs.referential:
+            token_sent = token.export_referential()
+        else:
+            try:
+                token_sent = await self._sign(token, rs)
+            except SigningServiceOverloaded:
+                raise TokenRequestError('temporarily_unavailable', status=503)
+
+        # Register bound PoP key for later reference
+        self.key_registry.add_key(client_id, client_pop_key, expires=token.expires)
+        self.token_registry.add_token(token, self_contained=not rs.referential)
 
-        response = {
+        return {
             CK.ACCESS_TOKEN: token_sent,
             CK.TOKEN_TYPE: 'pop',
             CK.PROFILE: 'coap_oscore',
-            CK.RS_CNF: CoseKey(rs.public_key, b'rs_pub_key', CoseKey.Type.ECDSA).encode()
+            CK.RS_CNF: rs.cnf
         }
 
-        return web.Response(status=200, body=dumps(response))
+    async def _sign(self, token: AccessToken, rs: 'ResourceServer') -> bytes:
+        if rs.mac_key is not None:
+            return token.mac_and_export_self_contained(rs.mac_key, template=rs.template)
+
+        as_key = self.key_ring.current()
+        if as_key is None:
+            raise TokenRequestError('temporarily_unavailable', status=503)
 
-    def _bind_token(self, client_claims: dict, session_key: CoseKey) -> AccessToken:
+        template = self._template(as_key, rs.audience)
+
+        if as_key.signing_service is None:
+            return token.sign_and_export_self_contained(as_key.signer, template=template)
+
+        return await token.sign_and_export_self_contained_async(as_key.signing_service, template=template)
+
+    def _template(self, as_key: AsKey, audience: str) -> CwtTemplate:
+        template = self.templates.get((as_key.kid, audience))
+
+        if template is None:
+            template = CwtTemplate(kid=as_key.kid,
+                                   static_claims={CK.ISS: self.ISSUER, CK.AUD: audience},
+                                   alg=as_key.signer.algorithm)
+            self.templates[(as_key.kid, audience)] = template
+
+        return template
+
+    @staticmethod
+    def _scope_names(rs: 'ResourceServer', scope):
+        """
+        :return: The requested scope as a comma separated string
+        """
+        if isinstance(scope, int):
+            return ",".join(rs.scope_map.names(scope))
+
+        return scope
+
+    def _bind_token(self, client_claims: dict, session_key: CoseKey, compact: bool = False) -> AccessToken:
         """
         Bind session_key to access_token
         :param client_claims: client claims to be included in the access token
         :param session_key: PoP key to be bound to the access token
+        :param compact: Whether to use a binary cti
         :return:
         """
-        cti = os.urandom(2)
+        if compact:
+            cti = os.urandom(self.CTI_LENGTH)
+        else:
+            cti = os.urandom(2).hex()
 
         # Claims to be included in the access token
         claims = {
-            CK.ISS: 'ace.as-server.com',
+            CK.ISS: self.ISSUER,
             CK.IAT: int(time.time()),
-            CK.EXP: int(time.time() + 7200.0),
-            CK.CTI: cti.hex()  # TODO: use 'bytes' instead of string as per spec
+            CK.EXP: int(time.time() + self.TOKEN_LIFETIME),
+            CK.CTI: cti
         }
 
         # Add client claims (aud and scope)
@@ -137,40 +396,115 @@ class AuthorizationServer():
         expected_keys = [CK.GRANT_TYPE,
                          CK.CLIENT_ID,
                          CK.CLIENT_SECRET,
-                         CK.AUD]
+                         CK.SCOPE,
+                         CK.AUD,
+                         CK.CNF]
+
+        if not isinstance(request_data, dict):
+            return False
 
-        if request_data is None:
+        if not all(key in request_data for key in expected_keys):
             return False
 
-        return all(key in request_data for key in expected_keys)
+        return isinstance(request_data[CK.CLIENT_ID], str) \
+            and isinstance(request_data[CK.AUD], str) \
+            and isinstance(request_data[CK.SCOPE], (str, int)) \
+            and isinstance(request_data[CK.CNF], dict)
 
     # POST
     async def introspect(self, request):
         params = loads(await request.content.read())
 
         # Check if token was supplied
-        if CK.TOKEN not in params:
+        if not isinstance(params, dict) or CK.TOKEN not in params:
             return web.Response(status=400, body=dumps({'error': 'missing "token" parameter'}))
 
+        audience = self._introspecting_audience(params)
+        if audience is None:
+            return web.Response(status=401, body=dumps({'error': 'unauthorized_client'}))
+
         token = params[CK.TOKEN]  # required
-        token_type_hint = params[CK.TOKEN_TYPE_HINT]  # optional
-
-        access_context = self.token_registry.get_token(reference=token)
-
-        response = {
-            CK.ACTIVE: True,
-            CK.SCOPE: access_context.scope,
-            CK.AUD: access_context.audience,
-            CK.ISS: access_context.issuer,
-            CK.EXP: access_context.expires,
-            CK.IAT: access_context.issued_at,
-            CK.CNF: {
-                Cose.COSE_KEY: access_context.bound_key.encode()
-            }
-        }
+        token_type_hint = params.get(CK.TOKEN_TYPE_HINT)  # optional
+
+        return web.Response(status=201, body=self._introspect(token, audience))
+
+    # POST
+    async def introspect_batch(self, request):
+        """
+        Introspects an array of tokens given as token parameter of an authenticated request, each token
+        given by its reference or as a map holding its binary cti, e.g. for a resource server
+        revalidating its tokens after a restart. The response is an array of the introspection
+        responses in request order, {active: false} for tokens that are unknown, expired or meant for
+        another resource server.
+        """
+
+        params = loads(await request.content.read())
+
+        if not isinstance(params, dict):
+            return web.Response(status=400, body=dumps({'error': 'invalid_request'}))
+
+        tokens = params.get(CK.TOKEN)
+        if not isinstance(tokens, list) or len(tokens) > self.max_introspection_batch:
+            return web.Response(status=400, body=dumps({'error': 'invalid_request'}))
 
-        return web.Response(status=201, body=dumps(response))
+        audience = self._introspecting_audience(params)
+        if audience is None:
+            return web.Response(status=401, body=dumps({'error': 'unauthorized_client'}))
 
+        # The responses are encoded already, only the array head is new
+        body = encode_head(ARRAY, len(tokens)) + b''.join(self._introspect(token, audience) for token in tokens)
 
-ResourceServer = namedtuple('ResourceServer', 'audience scopes public_key')
+        return web.Response(status=200, body=body)
+
+    def _introspecting_audience(self, params: dict) -> str:
+        """
+        :return: The audience of the resource server authenticated by params, None if not authenticated
+        """
+        client_id = params.get(CK.CLIENT_ID)
+        audience = self.introspecting_clients.get(client_id) if isinstance(client_id, str) else None
+
+        if audience is None or not self.verify_client(client_id, params.get(CK.CLIENT_SECRET)):
+            return None
+
+        return audience
+
+    def _introspect(self, token, audience: str) -> bytes:
+        """
+        :param token: The reference of a token or a map holding its binary cti. Textual ctis are short
+                      and would allow enumerating tokens, so they are not looked up
+        :param audience: The audience of the introspecting resource server
+        :return: The encoded introspection response
+        """
+        try:
+            if isinstance(token, bytes):
+                access_context = self.token_registry.get_token(reference=token)
+            elif isinstance(token, dict) and isinstance(token.get(CK.CTI), bytes):
+                access_context = self.token_registry.get_token(cti=token[CK.CTI])
+            else:
+                return INACTIVE
+        except KeyError:
+            return INACTIVE
+
+        if access_context.audience != audience:
+            return INACTIVE
+
+        response = self.introspection_responses.get(access_context)
+
+        if response is None:
+            response = dumps({
+                CK.ACTIVE: True,
+                CK.SCOPE: access_context.scope,
+                CK.AUD: access_context.audience,
+                CK.ISS: access_context.issuer,
+                CK.EXP: access_context.expires,
+                CK.IAT: access_context.issued_at,
+                CK.CNF: {
+                    Cose.COSE_KEY: access_context.bound_key.encode()
+                }
+            })
+            self.introspection_responses.set(access_context, response, expires=access_context.expires)
+
+        return response
+
+ResourceServer = namedtuple('ResourceServer', 'audience scopes public_key scope_map cnf template mac_key compact referential')
 Grant = namedtuple('Grant', 'audience scopes')
\ No newline at end of file
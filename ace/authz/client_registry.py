@@ -1,37 +1,99 @@
-from typing import List
+import hashlib
+import hmac
+import os
+
+from typing import Dict, List
+
+from ace.cache import LRUCache
+
+KDF_ITERATIONS = 10000
+SALT_LENGTH = 16
+
+
+def hash_secret(client_secret: bytes, salt: bytes, iterations: int = KDF_ITERATIONS) -> bytes:
+    """
+    Derive the stored hash of a client secret (PBKDF2-HMAC-SHA256)
+    """
+    if isinstance(client_secret, str):
+        client_secret = client_secret.encode('utf-8')
+
+    return hashlib.pbkdf2_hmac('sha256', client_secret, salt, iterations)
 
 
 class Client(object):
-    def __init__(self, client_id, client_secret, grants):
+    def __init__(self, client_id, client_secret, grants, iterations: int = KDF_ITERATIONS):
+        """
+        :param client_id: The client's ID
+        :param client_secret: The client's secret, only a salted hash of it is kept
+        :param grants: The client's grants
+        :param iterations: KDF iterations for hashing the secret
+        """
         self.client_id = client_id
-        self.client_secret = client_secret
         self.grants = grants
+        self.iterations = iterations
+        self.salt = os.urandom(SALT_LENGTH)
+        self.secret_hash = hash_secret(client_secret, self.salt, iterations)
+
+    @classmethod
+    def from_secret_hash(cls, client_id, secret_hash: bytes, salt: bytes, grants, iterations: int = KDF_ITERATIONS):
+        """
+        Create a client from a secret hash provisioned elsewhere, see hash_secret()
+        """
+        client = cls.__new__(cls)
+        client.client_id = client_id
+        client.grants = grants
+        client.iterations = iterations
+        client.salt = salt
+        client.secret_hash = secret_hash
+
+        return client
+
+    def check_secret(self, client_secret: bytes) -> bool:
+        """
+        :return: True if client_secret hashes to the stored hash, compared in constant time
+        """
+        return hmac.compare_digest(hash_secret(client_secret, self.salt, self.iterations), self.secret_hash)
 
 
 class ClientRegistry(object):
-    def __init__(self):
-        self._registered_clients = []
+    def __init__(self, cache_size: int = 4096):
+        """
+        :param cache_size: Number of recently verified secrets to remember
+        """
+        self._registered_clients: Dict[str, Client] = {}
+
+        # client_id => HMAC of the last secret that passed the KDF check, keyed per process so that
+        # the cache is no cheaper to attack than the salted hashes
+        self._verified = LRUCache(maxsize=cache_size)
+        self._cache_key = os.urandom(32)
 
     @property
     def registered_clients(self) -> List[Client]:
         """
         :return: A list of all registered clients
         """
-        return self._registered_clients
+        return list(self._registered_clients.values())
 
     def register_client(self, client: Client):
         """
         Register a client
         :param client: Pre-made Client object
         """
-        self._registered_clients.append(client)
+        self._registered_clients[client.client_id] = client
+        self._verified.pop(client.client_id)
+
+    def get_client(self, client_id: str) -> Client:
+        """
+        :return: The registered client or None
+        """
+        return self._registered_clients.get(client_id)
 
     def client_exists(self, client_id: str):
         """
         :param client_id: The client's ID
         :return: True if client_id is a registered client
         """
-        return client_id in [c.client_id for c in self.registered_clients]
+        return client_id in self._registered_clients
 
     def check_secret(self, client_id: str, client_secret: bytes):
         """
@@ -39,9 +101,24 @@ class ClientRegistry(object):
         :param client_secret: The clients's secret to be tested
         :return: True if the client_secret passed to this function belongs to the registered client
         """
-        if not self.client_exists(client_id):
+        client = self._registered_clients.get(client_id)
+        if client is None:
+            return False
+
+        if isinstance(client_secret, str):
+            client_secret = client_secret.encode('utf-8')
+        elif not isinstance(client_secret, bytes):
             return False
 
-        registered_secret = [c.client_secret for c in self.registered_clients if c.client_id == client_id][0]
+        digest = hmac.new(self._cache_key, client_secret, hashlib.sha256).digest()
+
+        # Only pay for the KDF if this secret was not verified recently
+        verified = self._verified.get(client_id)
+        if verified is not None and hmac.compare_digest(verified, digest):
+            return True
+
+        if not client.check_secret(client_secret):
+            return False
 
-        return registered_secret == client_secret
+        self._verified.set(client_id, digest)
+        return True
@@ -1,15 +1,52 @@
+from ace.cache import ExpiringDict
 from ace.cose import CoseKey
 
 
 class KeyRegistry:
-    def __init__(self):
-        self.registry = {}
+    def __init__(self, capacity: int = None, store=None):
+        """
+        :param capacity: Maximum number of keys kept in memory, None for no limit
+        :param store: Optional persistent store (e.g. SQLiteStore) backing the in-memory registry
+        """
+        self.registry = ExpiringDict(capacity=capacity)
+        self.store = store
 
-    def add_key(self, client_id, key: CoseKey):
-        self.registry[(client_id, key.key_id)] = key
+    def add_key(self, client_id, key: CoseKey, expires: float = None):
+        """
+        :param expires: Time after which the key is dropped, usually the expiry of the token it is bound to
+        """
+        self.registry.set((client_id, key.key_id), key, expires=expires)
+
+        if self.store is not None:
+            self.store.put_key(client_id, key, expires=expires)
 
     def find_key(self, client_id, key_id):
-        return self.registry[(client_id, key_id)]
+        """
+        :raises KeyError: If the key is unknown or expired
+        """
+        key = self.registry.get((client_id, key_id))
+
+        if key is None and self.store is not None:
+            loaded = self.store.load_key(client_id, key_id)
+            if loaded is not None:
+                (key, expires) = loaded
+                self.registry.set((client_id, key_id), key, expires=expires)
+
+        if key is None:
+            raise KeyError((client_id, key_id))
+
+        return key
 
     def _has_key(self, client_id, key_id):
-        return (client_id, key_id) in self.registry
+        try:
+            self.find_key(client_id, key_id)
+        except KeyError:
+            return False
+
+        return True
+
+    def __len__(self):
+        return len(self.registry)
+
+    def stats(self) -> dict:
+        return self.registry.stats()
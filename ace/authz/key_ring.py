@@ -0,0 +1,107 @@
+import time
+
+from collections import namedtuple
+from typing import Dict, List
+
+from ace.cose.signing import as_signer
+from .signing_service import SigningService
+
+INFINITY = float('inf')
+
+
+class KeyRing(object):
+    """
+    Signing keys of the authorization server with activation and retirement times. Tokens are signed
+    with the most recently activated key that is not retired yet, so a new key can be added ahead of
+    time and takes over without a restart. The current key is cached until the next transition.
+    """
+
+    def __init__(self, clock=time.time):
+        self._keys: Dict[bytes, 'AsKey'] = {}
+        self._clock = clock
+
+        self._current: AsKey = None
+        # The current key is valid within [_valid_from, _valid_until)
+        self._valid_from = INFINITY
+        self._valid_until = -INFINITY
+
+    def add(self, kid: bytes, key, activates: float = None, retires: float = None,
+            signing_service: SigningService = None) -> 'AsKey':
+        """
+        :param kid: Key id written to the tokens signed with key
+        :param activates: Time from which the key signs tokens, None for immediately
+        :param retires: Time from which the key no longer signs tokens, None for never
+        :param signing_service: Optional service signing with this key off the event loop
+        """
+        as_key = AsKey(kid=kid,
+                       signer=as_signer(key) if signing_service is None else signing_service.signer,
+                       activates=activates,
+                       retires=retires,
+                       signing_service=signing_service)
+
+        self._keys[kid] = as_key
+        self._invalidate()
+
+        return as_key
+
+    def retire(self, kid: bytes, when: float = None):
+        """
+        Stop signing with the key from when on, immediately if None
+        """
+        as_key = self._keys[kid]
+        self._keys[kid] = as_key._replace(retires=self._clock() if when is None else when)
+        self._invalidate()
+
+    def remove(self, kid: bytes):
+        self._keys.pop(kid, None)
+        self._invalidate()
+
+    def get(self, kid: bytes) -> 'AsKey':
+        return self._keys.get(kid)
+
+    def current(self) -> 'AsKey':
+        """
+        :return: The key to sign with now, None if no key is active
+        """
+        now = self._clock()
+
+        if not self._valid_from <= now < self._valid_until:
+            self._select(now)
+
+        return self._current
+
+    def keys(self) -> List['AsKey']:
+        return list(self._keys.values())
+
+    def _select(self, now: float):
+        active = [k for k in self._keys.values() if _activates(k) <= now < _retires(k)]
+        self._current = max(active, key=_activates, default=None)
+
+        # The choice holds until a key activates or the current key retires
+        transitions = [_activates(k) for k in self._keys.values() if _activates(k) > now]
+        if self._current is not None:
+            transitions.append(_retires(self._current))
+
+        self._valid_from = now
+        self._valid_until = min(transitions, default=INFINITY)
+
+    def _invalidate(self):
+        self._valid_from = INFINITY
+        self._valid_until = -INFINITY
+
+    def __contains__(self, kid):
+        return kid in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def _activates(as_key: 'AsKey') -> float:
+    return -INFINITY if as_key.activates is None else as_key.activates
+
+
+def _retires(as_key: 'AsKey') -> float:
+    return INFINITY if as_key.retires is None else as_key.retires
+
+
+AsKey = namedtuple('AsKey', 'kid signer activates retires signing_service')
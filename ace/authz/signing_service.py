@@ -0,0 +1,165 @@
+import asyncio
+
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List
+
+from ace.cose.signing import Signer, as_signer
+
+# Signer installed in a worker process by the process pool initializer
+_worker_signer: Signer = None
+
+
+def _install_signer(signer: Signer):
+    global _worker_signer
+    _worker_signer = signer
+
+
+def _sign_batch(signer: Signer, messages: List[tuple]) -> List[bytes]:
+    signer = signer or _worker_signer
+    return [signer.sign_digest(data) if prehashed else signer.sign(data) for (data, prehashed) in messages]
+
+
+class SigningServiceOverloaded(Exception):
+    pass
+
+
+class SigningServiceUnavailable(SigningServiceOverloaded):
+    """
+    The executor was shut down or is broken, e.g. a worker process died
+    """
+    pass
+
+
+class SigningService:
+    """
+    Signs messages off the event loop. Requests arriving within batch_window seconds of each
+    other are handed to the executor as a single batch to save on dispatch and IPC overhead.
+    """
+
+    def __init__(self,
+                 signer,
+                 executor: Executor,
+                 max_queue: int = 1024,
+                 max_batch: int = 32,
+                 batch_window: float = 0.002,
+                 ship_signer: bool = True):
+        """
+        :param signer: Key used for signing
+        :param executor: Executor running the signatures
+        :param max_queue: Maximum number of signatures waiting or in progress before requests are rejected
+        :param max_batch: Maximum number of signatures per batch
+        :param batch_window: Maximum time in seconds a request waits for further requests to batch with
+        :param ship_signer: Whether the signer is sent along with each batch; False if the executor's
+                            workers already have it installed
+        """
+        self.signer = as_signer(signer)
+        self.executor = executor
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+
+        self._ship_signer = ship_signer
+        self._pending = []
+        self._in_flight = 0
+        self._flush_handle = None
+
+    @classmethod
+    def with_process_pool(cls, signer, workers: int = None, **kwargs):
+        signer = as_signer(signer)
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_install_signer, initargs=(signer,))
+
+        return cls(signer, executor, ship_signer=False, **kwargs)
+
+    @classmethod
+    def with_thread_pool(cls, signer, workers: int = None, **kwargs):
+        return cls(signer, ThreadPoolExecutor(max_workers=workers), **kwargs)
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        :return: Number of signatures waiting or in progress
+        """
+        return len(self._pending) + self._in_flight
+
+    async def sign(self, message: bytes) -> bytes:
+        """
+        Sign a message
+        :raises SigningServiceOverloaded: If max_queue signatures are already queued
+        :raises SigningServiceUnavailable: If the executor cannot sign anymore
+        """
+        return await self._enqueue((message, False))
+
+    async def sign_digest(self, digest: bytes) -> bytes:
+        """
+        Sign the SHA-256 digest of a message, which keeps the data sent to worker processes small
+        :raises SigningServiceOverloaded: If max_queue signatures are already queued
+        :raises SigningServiceUnavailable: If the executor cannot sign anymore
+        :raises TypeError: If the key can not sign digests, see Signer.prehash
+        """
+        if not self.signer.prehash:
+            raise TypeError(f"{type(self.signer).__name__} can not sign digests")
+
+        return await self._enqueue((digest, True))
+
+    async def _enqueue(self, message: tuple) -> bytes:
+        if self.queue_depth >= self.max_queue:
+            raise SigningServiceOverloaded()
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((message, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        self._in_flight += len(batch)
+
+        signer = self.signer if self._ship_signer else None
+        try:
+            result = asyncio.get_running_loop().run_in_executor(self.executor,
+                                                                _sign_batch,
+                                                                signer,
+                                                                [message for (message, _) in batch])
+        except (RuntimeError, BrokenExecutor) as e:
+            # Shut down executors raise RuntimeError
+            self._in_flight -= len(batch)
+            self._fail(batch, SigningServiceUnavailable(str(e)))
+            return
+
+        result.add_done_callback(lambda done: self._complete(batch, done))
+
+    def _complete(self, batch, done):
+        self._in_flight -= len(batch)
+
+        error = asyncio.CancelledError() if done.cancelled() else done.exception()
+        if isinstance(error, BrokenExecutor):
+            error = SigningServiceUnavailable(str(error))
+        if error is not None:
+            self._fail(batch, error)
+            return
+
+        for ((_, future), signature) in zip(batch, done.result()):
+            if not future.done():
+                future.set_result(signature)
+
+    @staticmethod
+    def _fail(batch, error: BaseException):
+        for (_, future) in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,206 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from cbor2 import dumps, loads
+
+from ace.cbor.constants import Keys as CK
+from ace.cose import CoseKey
+from ace.cose.constants import Key as Cose
+from ace.authz.access_token import AccessToken
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    kind      TEXT NOT NULL,
+    id        BLOB NOT NULL,
+    reference BLOB,
+    exp       INTEGER,
+    claims    BLOB NOT NULL,
+    PRIMARY KEY (kind, id)
+);
+CREATE TABLE IF NOT EXISTS keys (
+    client_id TEXT NOT NULL,
+    key_id    BLOB NOT NULL,
+    exp       INTEGER,
+    cose_key  BLOB NOT NULL,
+    PRIMARY KEY (client_id, key_id)
+);
+"""
+
+_BY_CTI = 'cti'
+_BY_REF = 'ref'
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStore:
+    """
+    Persists issued tokens and PoP keys in a local SQLite database in WAL mode.
+
+    Writes are queued and group-committed by a background thread, reads go to the database
+    directly and are meant for cache misses only, see TokenRegistry and KeyRegistry.
+    """
+
+    def __init__(self, path: str, batch_size: int = 256, purge_interval: float = 60.0, retries: int = 3,
+                 retry_delay: float = 0.05):
+        """
+        :param path: Path of the database file
+        :param batch_size: Maximum number of writes per transaction
+        :param purge_interval: Seconds between deletions of expired rows
+        :param retries: Number of times a failed transaction is retried, e.g. while the database is locked
+        :param retry_delay: Seconds before the first retry, doubled for every further one
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.purge_interval = purge_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        # Writes lost after all retries, the last error is raised by flush()
+        self.failed_writes = 0
+        self._error = None
+
+        connection = self._connect()
+        connection.executescript(_SCHEMA)
+        connection.close()
+
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='ace-store-writer', daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @property
+    def _reader(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def put_token(self, token: AccessToken, self_contained: bool = True):
+        kind, token_id = (_BY_CTI, token.cti) if self_contained else (_BY_REF, token.reference)
+
+        self._queue.put((
+            'INSERT OR REPLACE INTO tokens (kind, id, reference, exp, claims) VALUES (?, ?, ?, ?, ?)',
+            (kind, token_id, token.reference, token.claims.get(CK.EXP), dumps(token.claims))
+        ))
+
+    def put_key(self, client_id, key: CoseKey, expires: float = None):
+        self._queue.put((
+            'INSERT OR REPLACE INTO keys (client_id, key_id, exp, cose_key) VALUES (?, ?, ?, ?)',
+            (client_id, key.key_id, expires, key.encode())
+        ))
+
+    def load_token(self, reference=None, cti=None) -> AccessToken:
+        """
+        :return: The stored token if present and not expired, None otherwise
+        """
+        kind, token_id = (_BY_CTI, cti) if cti is not None else (_BY_REF, reference)
+
+        row = self._reader.execute(
+            'SELECT reference, claims FROM tokens WHERE kind = ? AND id = ? AND (exp IS NULL OR exp > ?)',
+            (kind, token_id, time.time())
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        (stored_reference, claims) = row
+        claims = loads(claims)
+
+        bound_key = CoseKey.from_cose(claims[CK.CNF][Cose.COSE_KEY]) if CK.CNF in claims else None
+
+        return AccessToken(claims=claims, reference=stored_reference, bound_key=bound_key)
+
+    def load_key(self, client_id, key_id):
+        """
+        :return: (CoseKey, expiry) of the stored key if present and not expired, None otherwise
+        """
+        row = self._reader.execute(
+            'SELECT cose_key, exp FROM keys WHERE client_id = ? AND key_id = ? AND (exp IS NULL OR exp > ?)',
+            (client_id, key_id, time.time())
+        ).fetchone()
+
+        return None if row is None else (CoseKey.from_cose(row[0]), row[1])
+
+    def flush(self):
+        """
+        Block until all queued writes are committed
+        :raises sqlite3.Error: If writes were lost since the last flush()
+        """
+        self._queue.join()
+
+        (error, self._error) = (self._error, None)
+        if error is not None:
+            raise error
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _write_loop(self):
+        connection = self._connect()
+        last_purge = time.time()
+
+        while True:
+            batch = [self._queue.get()]
+
+            # Group-commit everything that queued up in the meantime
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            writes = [item for item in batch if item is not None]
+
+            try:
+                last_purge = self._write(connection, writes, last_purge)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if len(writes) < len(batch):
+                connection.close()
+                return
+
+    def _write(self, connection: sqlite3.Connection, writes: list, last_purge: float) -> float:
+        """
+        Commit a batch of writes in one transaction, retrying it if it fails
+        :return: The time of the last purge of expired rows
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                with connection:
+                    for (statement, params) in writes:
+                        connection.execute(statement, params)
+
+                    if time.time() - last_purge > self.purge_interval:
+                        connection.execute('DELETE FROM tokens WHERE exp <= ?', (time.time(),))
+                        connection.execute('DELETE FROM keys WHERE exp <= ?', (time.time(),))
+                        last_purge = time.time()
+
+                return last_purge
+            except sqlite3.Error as e:
+                if attempt < self.retries:
+                    logger.warning("Store write failed, retrying: %s", e)
+                    time.sleep(self.retry_delay * 2 ** attempt)
+                    continue
+
+                logger.error("Store write failed, %d writes lost", len(writes), exc_info=True)
+                self.failed_writes += len(writes)
+                self._error = e
+
+        return last_purge
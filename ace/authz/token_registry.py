@@ -1,20 +1,54 @@
 from ace.authz.access_token import AccessToken
+from ace.cache import ExpiringDict
 
 
 class TokenRegistry:
 
-    def __init__(self):
-        self.tokens_by_cti = {}
-        self.tokens_by_ref = {}
+    def __init__(self, capacity: int = None, store=None):
+        """
+        :param capacity: Maximum number of tokens kept in memory per index, None for no limit
+        :param store: Optional persistent store (e.g. SQLiteStore) backing the in-memory indexes
+        """
+        self.tokens_by_cti = ExpiringDict(capacity=capacity)
+        self.tokens_by_ref = ExpiringDict(capacity=capacity)
+        self.store = store
 
     def add_token(self, token: AccessToken, self_contained=True):
         if self_contained:
-            self.tokens_by_cti[token.cti] = token
+            self.tokens_by_cti.set(token.cti, token, expires=token.expires)
         else:
-            self.tokens_by_ref[token.reference] = token
+            self.tokens_by_ref.set(token.reference, token, expires=token.expires)
+
+        if self.store is not None:
+            self.store.put_token(token, self_contained=self_contained)
 
     def get_token(self, reference=None, cti=None) -> AccessToken:
+        """
+        :raises KeyError: If the token is unknown or expired
+        """
         if cti is not None:
-            return self.tokens_by_cti[cti]
+            index, key = self.tokens_by_cti, cti
+        else:
+            index, key = self.tokens_by_ref, reference
+
+        token = index.get(key)
+
+        # Tokens not in memory are loaded lazily, e.g. after a restart
+        if token is None and self.store is not None:
+            token = self.store.load_token(reference=reference, cti=cti)
+            if token is not None:
+                index.set(key, token, expires=token.expires)
+
+        if token is None:
+            raise KeyError(key)
+
+        return token
+
+    def __len__(self):
+        return len(self.tokens_by_cti) + len(self.tokens_by_ref)
 
-        return self.tokens_by_ref[reference]
+    def stats(self) -> dict:
+        return {
+            'by_cti': self.tokens_by_cti.stats(),
+            'by_ref': self.tokens_by_ref.stats()
+        }
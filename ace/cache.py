@@ -0,0 +1,155 @@
+import time
+
+from collections import OrderedDict
+
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    Mapping of bounded size, evicting the least recently used entry when full
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries[key]
+        except KeyError:
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._entries.pop(key, default)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ExpiringDict(object):
+    """
+    Mapping whose entries expire at an absolute time. Expiry times are hashed into a timer wheel of
+    `resolution` second slots, so an insert is O(1) and expired entries are dropped slot by slot.
+    With a capacity set, the least recently used entry is evicted when full.
+    """
+
+    def __init__(self, capacity: int = None, resolution: float = 1.0, clock=time.time):
+        self.capacity = capacity
+        self.resolution = resolution
+        self._clock = clock
+
+        # key => (value, expires)
+        self._entries = OrderedDict()
+        # slot => keys expiring within that slot
+        self._slots = {}
+        # first slot that has not been expired yet
+        self._cursor = None
+
+        self.expired = 0
+        self.evicted = 0
+
+    def _slot(self, expires: float) -> int:
+        return int(expires // self.resolution)
+
+    def set(self, key, value, expires: float = None):
+        """
+        :param expires: Absolute expiry time as returned by the clock, None to never expire
+        """
+        self.expire()
+
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+
+        if expires is not None:
+            self._slots.setdefault(self._slot(expires), []).append(key)
+
+        if self.capacity is not None and len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        (value, expires) = entry
+        if expires is not None and expires <= self._clock():
+            del self._entries[key]
+            self.expired += 1
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+
+        return entry[0]
+
+    def expire(self, now: float = None):
+        """
+        Drop all entries of slots that lie completely in the past. Entries expiring in the current
+        slot are dropped when accessed.
+        """
+        now_slot = self._slot(self._clock() if now is None else now)
+
+        if self._cursor == now_slot:
+            return
+
+        # After a long idle period it is cheaper to look at the occupied slots than to turn the wheel
+        if self._cursor is None or now_slot - self._cursor > len(self._slots):
+            due = sorted(slot for slot in self._slots if slot < now_slot)
+        else:
+            due = range(self._cursor, now_slot)
+
+        for slot in due:
+            for key in self._slots.pop(slot, ()):
+                entry = self._entries.get(key)
+
+                # Skip keys that have since been removed or re-added with a different expiry
+                if entry is None or entry[1] is None or self._slot(entry[1]) != slot:
+                    continue
+
+                del self._entries[key]
+                self.expired += 1
+
+        self._cursor = now_slot
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'capacity': self.capacity,
+            'expired': self.expired,
+            'evicted': self.evicted
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self._slots.clear()
+        self._cursor = None
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return len(self._entries)
+
@@ -3,4 +3,77 @@ def json_to_cbor(json: dict) -> dict:
     Convert string keys to integer keys
     """
 
-    return { int(k): json[k] for k in json.keys() }
\ No newline at end of file
+    return { int(k): json[k] for k in json.keys() }
+
+# Major types
+UNSIGNED_INT = 0
+NEGATIVE_INT = 1
+BYTE_STRING  = 2
+TEXT_STRING  = 3
+ARRAY        = 4
+MAP          = 5
+TAG          = 6
+
+
+def encode_head(major_type: int, argument: int) -> bytes:
+    """
+    Encode the initial byte(s) of a data item in the shortest form, e.g. the length prefix of a byte string.
+    Identical to the heads written by cbor2.dumps, so pre-encoded fragments can be spliced together.
+    """
+    major = major_type << 5
+
+    if argument < 24:
+        return bytes([major | argument])
+    if argument < 0x100:
+        return bytes([major | 24, argument])
+    if argument < 0x10000:
+        return bytes([major | 25]) + argument.to_bytes(2, 'big')
+    if argument < 0x100000000:
+        return bytes([major | 26]) + argument.to_bytes(4, 'big')
+
+    return bytes([major | 27]) + argument.to_bytes(8, 'big')
+
+
+def decode_head(buffer, offset: int = 0):
+    """
+    Decode the initial byte(s) of the data item at offset
+    :return: (major type, argument, offset of the item's content)
+    """
+    initial = buffer[offset]
+    major_type = initial >> 5
+    info = initial & 0x1f
+    offset += 1
+
+    if info < 24:
+        return major_type, info, offset
+    if info > 27:
+        raise ValueError("Indefinite lengths are not supported")
+
+    size = 1 << (info - 24)
+    if offset + size > len(buffer):
+        raise ValueError("Truncated CBOR data item")
+
+    return major_type, int.from_bytes(buffer[offset:offset + size], 'big'), offset + size
+
+
+def skip_item(buffer, offset: int = 0) -> int:
+    """
+    :return: The offset after the data item starting at offset
+    """
+    (major_type, argument, offset) = decode_head(buffer, offset)
+
+    if major_type in (BYTE_STRING, TEXT_STRING):
+        offset += argument
+    elif major_type == ARRAY:
+        for _ in range(argument):
+            offset = skip_item(buffer, offset)
+    elif major_type == MAP:
+        for _ in range(2 * argument):
+            offset = skip_item(buffer, offset)
+    elif major_type == TAG:
+        offset = skip_item(buffer, offset)
+
+    if offset > len(buffer):
+        raise ValueError("Truncated CBOR data item")
+
+    return offset
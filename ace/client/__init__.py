@@ -1,30 +1,42 @@
 import aiohttp
 
-from typing import List
+from typing import List, Union
 from cbor2 import dumps, loads
 from ace.cbor.constants import Keys as CK, GrantTypes
 from ace.cose.constants import Key as Cose
 from ace.cose import CoseKey
 from ace.edhoc import Client as EdhocClient
+from ace.edhoc.store import ContextStore
 
 from ace.client.ace_session import AceSession
 
 
 class Client:
 
-    def __init__(self, client_id: str, client_secret: bytes):
+    def __init__(self, client_id: str, client_secret: bytes, pop_key_curve: int = Cose.Curve.P_256,
+                 aead_algorithms: List[int] = None, context_store: ContextStore = None):
+        """
+        :param pop_key_curve: Curve of the generated PoP keys, Cose.Curve.Ed25519 for EdDSA
+        :param aead_algorithms: AEAD algorithms offered for OSCORE in order of preference, None for the default
+        :param context_store: Persists established OSCORE contexts by resource server URL, see resume_session()
+        """
         self.client_id = client_id
         self.client_secret = client_secret
+        self.pop_key_curve = pop_key_curve
+        self.aead_algorithms = aead_algorithms
+        self.context_store = context_store
         self.sessions = {}
 
-    async def request_access_token(self, as_url: str, audience: str, scopes: List['str']):
+    async def request_access_token(self, as_url: str, audience: str, scopes: Union[List[str], int]):
         """
         Request access token from authorization server
         :param as_url: The URL of the authorization server
         :param audience: The audience of the resource server
-        :param scopes: The scopes to be accessed
+        :param scopes: The scopes to be accessed, or their integer mask to request a compact token
         """
-        session = AceSession.create(key_id=bytes(f"{self.client_id}{AceSession.session_id}", 'ascii'))
+        session = AceSession.create(key_id=bytes(f"{self.client_id}{AceSession.session_id}", 'ascii'),
+                                    curve=self.pop_key_curve,
+                                    aead_algorithms=self.aead_algorithms)
 
         pop_key = session.public_pop_key
 
@@ -32,7 +44,7 @@ class Client:
             CK.GRANT_TYPE:    GrantTypes.CLIENT_CREDENTIALS,
             CK.CLIENT_ID:     self.client_id,
             CK.CLIENT_SECRET: self.client_secret,
-            CK.SCOPE:         ",".join(scopes),
+            CK.SCOPE:         scopes if isinstance(scopes, int) else ",".join(scopes),
             CK.AUD:           audience,
             CK.CNF:           { Cose.COSE_KEY: CoseKey(pop_key, session.pop_key_id, CoseKey.Type.ECDSA).encode() }
         }
@@ -55,6 +67,23 @@ class Client:
         if session.oscore_context is None:
             session.oscore_context = await self.establish_oscore_context(session, rs_url)
 
+            if self.context_store is not None:
+                self.context_store.save(rs_url.encode(), session.oscore_context, peer=session.pop_key_id)
+
+    def resume_session(self, rs_url: str) -> AceSession:
+        """
+        Resume the OSCORE context established with a resource server before a restart, without
+        requesting a token or running EDHOC again
+        :return: The resumed session, None if no context is stored for rs_url
+        """
+        loaded = None if self.context_store is None else self.context_store.load(rs_url.encode())
+        if loaded is None:
+            return None
+
+        (oscore_context, pop_key_id) = loaded
+
+        return AceSession.resume(pop_key_id, oscore_context, rs_url)
+
     async def establish_oscore_context(self, session: AceSession, rs_url: str):
         raise NotImplementedError
 
@@ -2,13 +2,15 @@ import requests
 
 from ecdsa import SigningKey, VerifyingKey, NIST256p
 from ace.edhoc import Client as EdhocClient
+from ace.cose.constants import Key
+from ace.cose.signing import generate_signing_key
 
 
 class AceSession:
 
     session_id = 0
 
-    def __init__(self, session_id, private_pop_key, public_pop_key, pop_key_id: bytes):
+    def __init__(self, session_id, private_pop_key, public_pop_key, pop_key_id: bytes, aead_algorithms: list = None):
         self.session_id = session_id
         self.private_pop_key = private_pop_key
         self.public_pop_key = public_pop_key
@@ -17,7 +19,8 @@ class AceSession:
         self.rs_url = None
         self.edhoc_client = EdhocClient(self.private_pop_key,
                                    None,
-                                   kid=self.pop_key_id)
+                                   kid=self.pop_key_id,
+                                   aead_algorithms=aead_algorithms)
         self.oscore_context = None
 
     # @property
@@ -33,8 +36,12 @@ class AceSession:
         self.edhoc_client.server_id = value
 
     @classmethod
-    def create(cls, key_id: bytes):
-        (prv_key, pub_key) = AceSession.generate_session_key()
+    def create(cls, key_id: bytes, curve: int = Key.Curve.P_256, aead_algorithms: list = None):
+        """
+        :param curve: Curve of the PoP key, Key.Curve.Ed25519 for smaller and faster EdDSA keys
+        :param aead_algorithms: AEAD algorithms offered in EDHOC for the OSCORE context
+        """
+        (prv_key, pub_key) = AceSession.generate_session_key(curve)
 
         session_id = AceSession.session_id
         AceSession.session_id += 1
@@ -42,16 +49,40 @@ class AceSession:
         return AceSession(session_id=session_id,
                           private_pop_key=prv_key,
                           public_pop_key=pub_key,
-                          pop_key_id=key_id)
+                          pop_key_id=key_id,
+                          aead_algorithms=aead_algorithms)
+
+    @classmethod
+    def resume(cls, pop_key_id: bytes, oscore_context, rs_url: str = None):
+        """
+        A session with a stored OSCORE context only. It has neither the PoP key nor the token, so
+        it cannot repeat EDHOC: a new session is needed when the resource server rejects the context
+        """
+        session = cls.__new__(cls)
+        session.session_id = None
+        session.private_pop_key = None
+        session.public_pop_key = None
+        session.pop_key_id = pop_key_id
+        session.token = None
+        session.rs_url = rs_url
+        session.edhoc_client = None
+        session.oscore_context = oscore_context
+
+        return session
 
     @staticmethod
-    def generate_session_key():
+    def generate_session_key(curve: int = Key.Curve.P_256):
         """
         Generates an asymmetric session key
+        :param curve: COSE identifier of the curve
         :return: (private_key, public_key) pair
         """
 
-        private_key = SigningKey.generate(curve=NIST256p)
-        public_key = private_key.get_verifying_key()
+        private_key = generate_signing_key(curve)
+
+        if curve == Key.Curve.Ed25519:
+            public_key = private_key.public_key()
+        else:
+            public_key = private_key.get_verifying_key()
 
         return private_key, public_key
@@ -2,13 +2,18 @@ from cbor2 import dumps, loads
 import aiocoap
 from aiocoap import Context, GET, POST
 
+from typing import List
+
 from ace.client import Client, AceSession
+from ace.cose.constants import Key
+from ace.edhoc.store import ContextStore
 
 
 class CoAPClient(Client):
 
-    def __init__(self, client_id: str, client_secret: bytes, protocol):
-        super().__init__(client_id, client_secret)
+    def __init__(self, client_id: str, client_secret: bytes, protocol, pop_key_curve: int = Key.Curve.P_256,
+                 aead_algorithms: List[int] = None, context_store: ContextStore = None):
+        super().__init__(client_id, client_secret, pop_key_curve, aead_algorithms, context_store)
         self.protocol = protocol
 
     async def upload_access_token(self, session: AceSession, rs_url: str, endpoint: str):
@@ -46,6 +51,32 @@ class CoAPClient(Client):
 
         return loads(decrypted_response)
 
+    async def observe_resource(self, session: AceSession, rs_url: str, endpoint: str):
+        """
+        Observe a protected resource
+        :return: Async iterator over the decrypted response and notifications, ends when the
+                 resource server removes the observer
+        """
+        await self.ensure_oscore_context(session, rs_url)
+
+        payload = session.oscore_context.encrypt(b'')
+        request = self.protocol.request(aiocoap.Message(code=GET, uri=f"{rs_url}{endpoint}", observe=0,
+                                                        payload=payload))
+        response = await request.response
+        assert response.code == aiocoap.CONTENT
+
+        yield loads(session.oscore_context.decrypt(response.payload))
+
+        try:
+            async for notification in request.observation:
+                if not notification.code.is_successful():
+                    # Observation ended by the resource server, e.g. the token expired
+                    return
+
+                yield loads(session.oscore_context.decrypt(notification.payload))
+        except aiocoap.error.Error:
+            return
+
     async def put_resource(self, session: AceSession, rs_url: str, endpoint: str, data: bytes):
         await self.ensure_oscore_context(session, rs_url)
         
@@ -1,13 +1,18 @@
 from cbor2 import dumps, loads
 import aiohttp
 
+from typing import List
+
 from ace.client import Client, AceSession
+from ace.cose.constants import Key
+from ace.edhoc.store import ContextStore
 
 
 class HTTPClient(Client):
 
-    def __init__(self, client_id: str, client_secret: bytes):
-        super().__init__(client_id, client_secret)
+    def __init__(self, client_id: str, client_secret: bytes, pop_key_curve: int = Key.Curve.P_256,
+                 aead_algorithms: List[int] = None, context_store: ContextStore = None):
+        super().__init__(client_id, client_secret, pop_key_curve, aead_algorithms, context_store)
         self.client = aiohttp.ClientSession()
     
     async def establish_oscore_context(self, session: AceSession, rs_url: str):
@@ -1,2 +1,3 @@
-from ace.cose.cose import Signature1Message, Encrypt0Message
+from ace.cose.cose import Signature1Message, Mac0Message, Encrypt0Message
 from ace.cose.key import CoseKey
+from ace.cose.trust_store import TrustStore
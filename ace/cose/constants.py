@@ -18,11 +18,24 @@ class Header:
 
 
 class Algorithm:
+    HMAC_256_64 = 4
+    HMAC_256_256 = 5
+    EdDSA = -8
     ES256 = -7
     ES384 = -35
     ES512 = -36
+    A128GCM = 1
+    A192GCM = 2
+    A256GCM = 3
     AES_CCM_16_64_128 = 10
+    AES_CCM_16_64_256 = 11
     AES_CCM_64_64_128 = 12
+    AES_CCM_64_64_256 = 13
+    CHACHA20_POLY1305 = 24
+    AES_CCM_16_128_128 = 30
+    AES_CCM_16_128_256 = 31
+    AES_CCM_64_128_128 = 32
+    AES_CCM_64_128_256 = 33
 
 
 class Key:
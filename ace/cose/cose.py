@@ -1,10 +1,14 @@
 import hashlib
+import hmac
 
-from cbor2 import loads, dumps, CBORTag
-from cryptography.hazmat.primitives.ciphers.aead import AESCCM
-from ecdsa import SigningKey, VerifyingKey, util
+from collections import namedtuple
+
+from cbor2 import loads, dumps, CBORTag, CBORDecodeError
+from cryptography.hazmat.primitives.ciphers.aead import AESCCM, AESGCM, ChaCha20Poly1305
 
 from ace.cose.constants import Header, Tag, Algorithm
+from ace.cose.signing import Signer, Verifier, as_signer, as_verifier
+from ace.cbor.cbor import encode_head, decode_head, skip_item, BYTE_STRING, ARRAY, MAP, TAG
 
 signature_algorithms = ['ES256', 'ES384', 'ES521']
 
@@ -26,15 +30,35 @@ class Signature1Message:
         self.protected_header = b'' if protected_header is None else protected_header
         self.unprotected_header = unprotected_header
 
-    def serialize_signed(self, key: SigningKey) -> bytes:
-        signature = Signature1Message.create_signature(context="Signature1",
-                                                       body_protected=self.protected_header,
-                                                       payload=self.payload,
-                                                       external_aad=self.external_aad,
-                                                       key=key)
-
-        print("Signature is: ", signature.hex())
-
+    def serialize_signed(self, key: Signer) -> bytes:
+        signature = sign_sig_structure(as_signer(key),
+                                       "Signature1",
+                                       self.protected_header,
+                                       self.external_aad,
+                                       self.payload)
+
+        return self.serialize(signature)
+
+    def to_be_signed(self) -> bytes:
+        """
+        :return: The encoded Sig_structure, for signing the message elsewhere
+        """
+        return dumps(Signature1Message.sign_structure("Signature1",
+                                                      self.protected_header,
+                                                      self.payload,
+                                                      self.external_aad))
+
+    def digest(self) -> bytes:
+        """
+        :return: SHA-256 of to_be_signed(), computed without encoding the Sig_structure. Only of use
+                 for ECDSA, EdDSA signs to_be_signed() itself
+        """
+        return sig_structure_digest("Signature1", self.protected_header, self.external_aad, self.payload)
+
+    def serialize(self, signature: bytes) -> bytes:
+        """
+        Encode the message with a signature computed over to_be_signed()
+        """
         cose_sign1 = [
             self.protected_header,
             self.unprotected_header,
@@ -49,21 +73,16 @@ class Signature1Message:
                          context: str,
                          body_protected: bytes,
                          payload: bytes,
-                         key: SigningKey,
+                         key: Signer,
                          external_aad: bytes,
                          sign_protected: bytes = None) -> bytes:
 
-        sign_structure = Signature1Message.sign_structure(context,
-                                                          body_protected,
-                                                          payload,
-                                                          external_aad,
-                                                          sign_protected)
-
-        to_sign = dumps(sign_structure)
-
-        signature = key.sign_deterministic(to_sign, hashlib.sha256, sigencode=util.sigencode_string)
+        if sign_protected is not None:
+            fields = (body_protected, sign_protected, external_aad, payload)
+        else:
+            fields = (body_protected, external_aad, payload)
 
-        return signature
+        return sign_sig_structure(as_signer(key), context, *fields)
 
     @classmethod
     def sign_structure(cls, context: str,
@@ -80,19 +99,216 @@ class Signature1Message:
         return sign_structure
 
     @classmethod
-    def verify(cls, encoded, key: VerifyingKey, external_aad: bytes):
-        decoded = loads(encoded)
-
-        tag = decoded.tag
-        (protected, unprotected, payload, signature) = decoded.value
+    def parse(cls, encoded):
+        """
+        Locate the fields of an encoded COSE_Sign1 without copying them
+        :return: (protected, unprotected, payload, signature) as memoryview slices of encoded. The
+                 unprotected header is the content of the byte string or the encoded map
+        :raises SignatureVerificationFailed: If encoded is not a COSE_Sign1 structure
+        """
+        try:
+            return parse_structure(encoded, Tag.COSE_SIGN1)
+        except (ValueError, IndexError) as e:
+            raise SignatureVerificationFailed(str(e))
 
-        sign_structure = Signature1Message.sign_structure("Signature1", protected, payload, external_aad)
-        to_verify = dumps(sign_structure)
+    @classmethod
+    def verify(cls, encoded, key: Verifier, external_aad: bytes):
+        (protected, unprotected, payload, signature) = Signature1Message.parse(encoded)
 
-        if not key.verify(signature, to_verify, hashlib.sha256, sigdecode=util.sigdecode_string):
+        if not verify_sig_structure(as_verifier(key), bytes(signature), "Signature1", protected, external_aad, payload):
             raise SignatureVerificationFailed()
 
-        return payload
+        return bytes(payload)
+
+
+class MacVerificationFailed(SignatureVerificationFailed):
+    pass
+
+
+# HMAC algorithm => length of the (truncated) tag
+mac_tag_lengths = {
+    Algorithm.HMAC_256_64: 8,
+    Algorithm.HMAC_256_256: 32,
+}
+
+
+class Mac0Message:
+
+    def __init__(self,
+                 payload: bytes=b'',
+                 external_aad: bytes=b'',
+                 protected_header: bytes=None,
+                 unprotected_header: bytes=None):
+
+        self.payload = payload
+        self.external_aad = external_aad
+        self.protected_header = b'' if protected_header is None else protected_header
+        self.unprotected_header = unprotected_header
+
+    def to_be_maced(self) -> bytes:
+        """
+        :return: The encoded MAC_structure
+        """
+        return dumps(["MAC0", self.protected_header, self.external_aad, self.payload])
+
+    def compute_tag(self, key: bytes) -> bytes:
+        """
+        :param key: The shared HMAC key, the algorithm is taken from the protected header
+        """
+        alg = loads(self.protected_header).get(Header.ALG) if self.protected_header else None
+
+        return mac_structure_tag(key, alg, "MAC0", self.protected_header, self.external_aad, self.payload)
+
+    def serialize(self, tag: bytes) -> bytes:
+        cose_mac0 = [
+            self.protected_header,
+            self.unprotected_header,
+            self.payload,
+            tag,
+        ]
+
+        return dumps(CBORTag(Tag.COSE_MAC0, cose_mac0))
+
+    def serialize_maced(self, key: bytes) -> bytes:
+        return self.serialize(self.compute_tag(key))
+
+    @classmethod
+    def parse(cls, encoded):
+        """
+        Locate the fields of an encoded COSE_Mac0 without copying them
+        :return: (protected, unprotected, payload, tag) as memoryview slices of encoded
+        :raises MacVerificationFailed: If encoded is not a COSE_Mac0 structure
+        """
+        try:
+            return parse_structure(encoded, Tag.COSE_MAC0)
+        except (ValueError, IndexError) as e:
+            raise MacVerificationFailed(str(e))
+
+    @classmethod
+    def verify(cls, encoded, key: bytes, external_aad: bytes):
+        (protected, unprotected, payload, tag) = Mac0Message.parse(encoded)
+
+        try:
+            alg = loads(bytes(protected)).get(Header.ALG) if len(protected) else None
+        except (CBORDecodeError, AttributeError) as e:
+            raise MacVerificationFailed(str(e))
+
+        if alg not in mac_tag_lengths:
+            raise MacVerificationFailed("Unsupported MAC algorithm")
+
+        expected = mac_structure_tag(key, alg, "MAC0", protected, external_aad, payload)
+
+        if not hmac.compare_digest(expected, bytes(tag)):
+            raise MacVerificationFailed()
+
+        return bytes(payload)
+
+
+def parse_structure(encoded, tag: int):
+    """
+    Locate the four fields of an encoded COSE_Sign1 or COSE_Mac0 without copying them
+    :param tag: The COSE tag the structure may be wrapped in
+    :return: Tuple of memoryview slices of encoded
+    :raises ValueError: If encoded is not such a structure
+    """
+    view = memoryview(encoded)
+
+    (major_type, argument, offset) = decode_head(view)
+    if major_type == TAG:
+        if argument != tag:
+            raise ValueError("Unexpected COSE tag")
+        (major_type, argument, offset) = decode_head(view, offset)
+
+    if (major_type, argument) != (ARRAY, 4):
+        raise ValueError("Not a COSE array")
+
+    fields = []
+    for _ in range(4):
+        (major_type, argument, start) = decode_head(view, offset)
+
+        if major_type == BYTE_STRING:
+            offset = start + argument
+            if offset > len(view):
+                raise ValueError("Truncated byte string")
+        elif major_type == MAP and len(fields) == 1:
+            start = offset
+            offset = skip_item(view, offset)
+        else:
+            raise ValueError("Unexpected COSE field")
+
+        fields.append(view[start:offset])
+
+    return tuple(fields)
+
+
+def _feed_structure(hash, context: str, fields):
+    hash.update(encode_head(ARRAY, 1 + len(fields)))
+    hash.update(_encoded_contexts.get(context) or dumps(context))
+
+    for field in fields:
+        hash.update(encode_head(BYTE_STRING, len(field)))
+        hash.update(field)
+
+
+def sig_structure_digest(context: str, *fields) -> bytes:
+    """
+    SHA-256 of the encoded Sig_structure [context, *fields], fed to the hash piece by piece
+    :param fields: Byte strings (or memoryviews of them) following the context
+    """
+    digest = hashlib.sha256()
+    _feed_structure(digest, context, fields)
+
+    return digest.digest()
+
+
+def sig_structure(context: str, *fields) -> bytes:
+    """
+    The encoded Sig_structure [context, *fields], joined from the fields without decoding them
+    """
+    parts = [encode_head(ARRAY, 1 + len(fields)), _encoded_contexts.get(context) or dumps(context)]
+
+    for field in fields:
+        parts.append(encode_head(BYTE_STRING, len(field)))
+        parts.append(field)
+
+    return b''.join(parts)
+
+
+def sign_sig_structure(signer: Signer, context: str, *fields) -> bytes:
+    """
+    Sign the Sig_structure [context, *fields], hashing it incrementally if the algorithm allows
+    """
+    if signer.prehash:
+        return signer.sign_digest(sig_structure_digest(context, *fields))
+
+    return signer.sign(sig_structure(context, *fields))
+
+
+def verify_sig_structure(verifier: Verifier, signature: bytes, context: str, *fields) -> bool:
+    """
+    Verify a signature over the Sig_structure [context, *fields], e.g. straight from the slices
+    of a received message, see Signature1Message.parse()
+    """
+    if verifier.prehash:
+        return verifier.verify_digest(signature, sig_structure_digest(context, *fields))
+
+    return verifier.verify(signature, sig_structure(context, *fields))
+
+
+def mac_structure_tag(key: bytes, alg: int, context: str, *fields) -> bytes:
+    """
+    HMAC-SHA256 tag of the encoded MAC_structure [context, *fields], truncated as required by alg
+    """
+    if alg not in mac_tag_lengths:
+        raise ValueError(f"Unsupported MAC algorithm {alg}")
+
+    mac = hmac.new(key, digestmod=hashlib.sha256)
+    _feed_structure(mac, context, fields)
+
+    return mac.digest()[:mac_tag_lengths[alg]]
+
+
+_encoded_contexts = {context: dumps(context) for context in ("Signature", "Signature1", "CounterSignature", "MAC0")}
 
 
 class Encrypt0Message:
@@ -101,11 +317,17 @@ class Encrypt0Message:
                  plaintext: bytes,
                  protected_header: bytes,
                  unprotected_header: dict,
-                 external_aad: bytes = b''):
+                 external_aad: bytes = b'',
+                 alg: int = None):
+        """
+        :param alg: AEAD algorithm fixed by the security context, e.g. for OSCORE. Only if None, the
+                    protected header may name one
+        """
         self.plaintext = plaintext
         self.unprotected_header = unprotected_header
         self.protected_header = protected_header
         self.external_aad = external_aad
+        self.alg = alg
 
     def serialize(self, iv: bytes, key: bytes):
         enc_structure = Encrypt0Message.enc_structure(self.protected_header, self.external_aad)
@@ -117,30 +339,116 @@ class Encrypt0Message:
 
         return dumps(CBORTag(Tag.COSE_ENCRYPT0, cose_encrypt0))
 
-    # AES-CCM-64-64-128 = AES-CCM mode 128-bit key, 64-bit tag, 7-byte nonce
     def _encrypt(self, key: bytes, iv: bytes, aad: bytes):
-        cipher = AESCCM(key, tag_length=8)
-        ciphertext = cipher.encrypt(nonce=iv, data=self.plaintext, associated_data=aad)
+        alg = Encrypt0Message.algorithm(self.protected_header, self.alg)
+        cipher = aead_cipher(alg, key)
+        ciphertext = cipher.encrypt(iv, self.plaintext, aad)
 
         return ciphertext
 
+    @classmethod
+    def algorithm(cls, protected: bytes, alg: int = None) -> int:
+        """
+        :param alg: The AEAD fixed by the caller, e.g. by an OSCORE context. The sender can not override it
+        :return: alg, else the AEAD named in the protected header, else DEFAULT_AEAD
+        :raises ValueError: If the protected header is not a map or names an unsupported AEAD
+        """
+        if alg is None and protected:
+            try:
+                header = loads(protected)
+            except CBORDecodeError as e:
+                raise ValueError(str(e))
+
+            if not isinstance(header, dict):
+                raise ValueError("Protected header is not a map")
+
+            alg = header.get(Header.ALG)
+
+        if alg is None:
+            return DEFAULT_AEAD
+
+        if alg not in aead_algorithms:
+            raise ValueError("Unsupported AEAD algorithm")
+
+        return alg
+
     @classmethod
     def enc_structure(cls, protected: bytes, external_aad: bytes):
         return ["Encrypt0", protected, external_aad]
 
     @classmethod
-    def decrypt(cls, encoded: bytes, key: bytes, iv: bytes, external_aad: bytes):
-        decoded = loads(encoded)
+    def parse(cls, encoded: bytes):
+        """
+        :return: (protected, unprotected, ciphertext) of an encoded COSE_Encrypt0
+        :raises ValueError: If encoded is not a COSE_Encrypt0
+        """
+        try:
+            decoded = loads(encoded)
+        except CBORDecodeError as e:
+            raise ValueError(str(e))
+
+        if isinstance(decoded, CBORTag):
+            if decoded.tag != Tag.COSE_ENCRYPT0:
+                raise ValueError("Unexpected COSE tag")
+            decoded = decoded.value
+
+        if not isinstance(decoded, list) or len(decoded) != 3 or not isinstance(decoded[1], dict):
+            raise ValueError("Not a COSE_Encrypt0")
+
+        return tuple(decoded)
 
-        tag = decoded.tag
-        (protected, unprotected, ciphertext) = decoded.value
+    @classmethod
+    def decrypt(cls, encoded: bytes, key: bytes, iv: bytes, external_aad: bytes, alg: int = None):
+        (protected, unprotected, ciphertext) = Encrypt0Message.parse(encoded)
+
+        return Encrypt0Message.decrypt_parsed(protected, ciphertext, key, iv, external_aad, alg)
 
+    @classmethod
+    def decrypt_parsed(cls, protected: bytes, ciphertext: bytes, key: bytes, iv: bytes, external_aad: bytes,
+                       alg: int = None):
+        """
+        Decrypt the fields of a COSE_Encrypt0 returned by parse()
+        """
         aad = dumps(Encrypt0Message.enc_structure(protected, external_aad))
+        alg = Encrypt0Message.algorithm(protected, alg)
 
-        print("OSCORE AAD: ", aad.hex())
-        print("TAG: ", ciphertext[-8:].hex())
+        cipher = aead_cipher(alg, key)
 
-        cipher = AESCCM(key, tag_length=8)
-        plaintext = cipher.decrypt(nonce=iv, data=ciphertext, associated_data=aad)
+        plaintext = cipher.decrypt(iv, ciphertext, aad)
 
         return plaintext
+
+AeadAlgorithm = namedtuple('AeadAlgorithm', 'cipher key_length nonce_length tag_length')
+
+# AEAD used when neither the message nor the context names one
+DEFAULT_AEAD = Algorithm.AES_CCM_16_64_128
+
+aead_algorithms = {
+    Algorithm.A128GCM: AeadAlgorithm(AESGCM, 16, 12, 16),
+    Algorithm.A192GCM: AeadAlgorithm(AESGCM, 24, 12, 16),
+    Algorithm.A256GCM: AeadAlgorithm(AESGCM, 32, 12, 16),
+    Algorithm.CHACHA20_POLY1305: AeadAlgorithm(ChaCha20Poly1305, 32, 12, 16),
+    Algorithm.AES_CCM_16_64_128: AeadAlgorithm(AESCCM, 16, 13, 8),
+    Algorithm.AES_CCM_16_64_256: AeadAlgorithm(AESCCM, 32, 13, 8),
+    Algorithm.AES_CCM_64_64_128: AeadAlgorithm(AESCCM, 16, 7, 8),
+    Algorithm.AES_CCM_64_64_256: AeadAlgorithm(AESCCM, 32, 7, 8),
+    Algorithm.AES_CCM_16_128_128: AeadAlgorithm(AESCCM, 16, 13, 16),
+    Algorithm.AES_CCM_16_128_256: AeadAlgorithm(AESCCM, 32, 13, 16),
+    Algorithm.AES_CCM_64_128_128: AeadAlgorithm(AESCCM, 16, 7, 16),
+    Algorithm.AES_CCM_64_128_256: AeadAlgorithm(AESCCM, 32, 7, 16),
+}
+
+
+def aead_cipher(alg: int, key: bytes):
+    """
+    :return: A cipher of the cryptography package for the COSE AEAD algorithm alg
+    :raises ValueError: If alg is no supported AEAD algorithm
+    """
+    algorithm = aead_algorithms.get(alg)
+    if algorithm is None:
+        raise ValueError(f"Unsupported AEAD algorithm {alg}")
+
+    if algorithm.cipher is AESCCM:
+        return AESCCM(key, tag_length=algorithm.tag_length)
+
+    return algorithm.cipher(key)
@@ -1,20 +1,204 @@
-from ecdsa import SigningKey, VerifyingKey, NIST256p, NIST384p
-from ace.cose import Signature1Message
-from ace.cose.constants import Header, Key, Algorithm
+import asyncio
+import hashlib
+
+from concurrent.futures import Executor
+
+from ace.cose import Signature1Message, Mac0Message, TrustStore
+from ace.cose.signing import Signer, Verifier, as_signer
+from ace.cose.constants import Header, Key, Algorithm, Tag
+from ace.cbor.cbor import encode_head, BYTE_STRING, ARRAY, MAP, TAG
 
 from cbor2 import dumps, loads
 
 
-def encode(claims: dict, key: SigningKey, kid: bytes):
-    protected = { Header.ALG: Algorithm.ES256 }
+def encode(claims: dict, key: Signer, kid: bytes):
+    signer = as_signer(key)
+    return prepare(claims, kid, signer.algorithm).serialize_signed(signer)
+
+
+def prepare(claims: dict, kid: bytes, alg: int = Algorithm.ES256) -> Signature1Message:
+    """
+    Build the unsigned COSE_Sign1 message of a CWT, e.g. to have it signed by a signing service
+    :param alg: Algorithm of the signer, see Signer.algorithm
+    """
+    protected = { Header.ALG: alg }
     unprotected = { Header.KID: kid }
 
-    msg = Signature1Message(payload=dumps(claims),
-                            protected_header=dumps(protected),
-                            unprotected_header=dumps(unprotected))
+    return Signature1Message(payload=dumps(claims),
+                             protected_header=dumps(protected),
+                             unprotected_header=dumps(unprotected))
 
-    return msg.serialize_signed(key)
 
+def decode(encoded, key: Verifier):
+    """
+    :param key: Verifier of the issuer, or a TrustStore to look up the key by the token's kid
+    """
+    if isinstance(key, TrustStore):
+        key = key.resolve(encoded)
 
-def decode(encoded, key: VerifyingKey):
     return loads(Signature1Message.verify(encoded, key, external_aad=b''))
+
+
+def encode_mac(claims: dict, key: bytes, kid: bytes, alg: int = Algorithm.HMAC_256_256):
+    """
+    Encode a CWT authenticated with a key shared between the issuer and the recipient
+    :param alg: Algorithm.HMAC_256_256 or Algorithm.HMAC_256_64
+    """
+    protected = { Header.ALG: alg }
+    unprotected = { Header.KID: kid }
+
+    return Mac0Message(payload=dumps(claims),
+                       protected_header=dumps(protected),
+                       unprotected_header=dumps(unprotected)).serialize_maced(key)
+
+
+def decode_mac(encoded, key: bytes):
+    if isinstance(key, TrustStore):
+        key = key.resolve(encoded)
+
+    return loads(Mac0Message.verify(encoded, key, external_aad=b''))
+
+
+def is_maced(encoded) -> bool:
+    """
+    :return: True if encoded is a tagged COSE_Mac0 rather than a COSE_Sign1 CWT
+    """
+    return encoded[:1] == _mac0_tag
+
+
+_mac0_tag = encode_head(TAG, Tag.COSE_MAC0)
+
+
+def decode_any(encoded, key):
+    """
+    Decode a signed or MACed CWT
+    :param key: Verifier for a COSE_Sign1, the shared HMAC key for a COSE_Mac0, or a TrustStore
+    """
+    if is_maced(encoded):
+        return decode_mac(encoded, key)
+
+    return decode(encoded, key)
+
+
+def decode_many(tokens: list, key_resolver) -> list:
+    """
+    Verify and decode many CWTs
+    :param key_resolver: Called with each encoded token, returns the key to verify it with, see decode_any()
+    :return: For each token in input order either its claims or the exception raised for it
+    """
+    results = []
+
+    for token in tokens:
+        try:
+            results.append(decode_any(token, key_resolver(token)))
+        except Exception as e:
+            results.append(e)
+
+    return results
+
+
+async def decode_many_async(tokens: list, key_resolver, executor: Executor = None, chunk_size: int = 8) -> list:
+    """
+    Like decode_many(), but spread over the workers of an executor in chunks of chunk_size tokens
+    :param executor: Executor running the verifications, the event loop's default executor if None. The
+                     verifications release the GIL, so a thread pool suffices
+    """
+    loop = asyncio.get_running_loop()
+
+    chunks = [tokens[i:i + chunk_size] for i in range(0, len(tokens), chunk_size)]
+    results = await asyncio.gather(*[
+        loop.run_in_executor(executor, decode_many, chunk, key_resolver) for chunk in chunks
+    ])
+
+    return [result for chunk in results for result in chunk]
+
+
+class CwtTemplate:
+    """
+    Pre-encoded headers and static claims for issuing many CWTs with the same key id, e.g. per
+    (issuer, audience). Only the claims that differ from the static ones are encoded per token.
+    The output is byte-identical to encode(), or encode_mac() for a template with an HMAC algorithm.
+    """
+
+    def __init__(self, kid: bytes, static_claims: dict = None, alg: int = Algorithm.ES256):
+        self.kid = kid
+        self.alg = alg
+        self.protected = dumps({ Header.ALG: alg })
+        self.unprotected = dumps({ Header.KID: kid })
+
+        # claim key => (value, encoded key and value)
+        self._fragments = {
+            key: (value, dumps(key) + dumps(value)) for (key, value) in (static_claims or {}).items()
+        }
+
+        # Sig_structure ["Signature1", protected, external_aad, payload] up to the payload
+        self._sig_structure_prefix = (encode_head(ARRAY, 4) +
+                                      dumps("Signature1") +
+                                      dumps(self.protected) +
+                                      dumps(b''))
+
+        # Tagged COSE_Sign1 [protected, unprotected, payload, signature] up to the payload
+        self._sign1_prefix = (encode_head(TAG, Tag.COSE_SIGN1) +
+                              encode_head(ARRAY, 4) +
+                              dumps(self.protected) +
+                              dumps(self.unprotected))
+
+    def encode_claims(self, claims: dict) -> bytes:
+        parts = [encode_head(MAP, len(claims))]
+
+        for (key, value) in claims.items():
+            fragment = self._fragments.get(key)
+
+            if fragment is not None and type(fragment[0]) is type(value) and fragment[0] == value:
+                parts.append(fragment[1])
+            else:
+                parts.append(dumps(key))
+                parts.append(dumps(value))
+
+        return b''.join(parts)
+
+    def prepare(self, claims: dict) -> 'PreparedCwt':
+        return PreparedCwt(self, self.encode_claims(claims))
+
+    def encode(self, claims: dict, key: Signer) -> bytes:
+        return self.prepare(claims).serialize_signed(key)
+
+    def encode_mac(self, claims: dict, key: bytes) -> bytes:
+        return Mac0Message(payload=self.encode_claims(claims),
+                           protected_header=self.protected,
+                           unprotected_header=self.unprotected).serialize_maced(key)
+
+
+class PreparedCwt:
+    """
+    Unsigned CWT created from a CwtTemplate, offering the signing interface of Signature1Message
+    """
+
+    def __init__(self, template: CwtTemplate, payload: bytes):
+        self.template = template
+        self.payload = payload
+
+    def to_be_signed(self) -> bytes:
+        return self.template._sig_structure_prefix + encode_head(BYTE_STRING, len(self.payload)) + self.payload
+
+    def digest(self) -> bytes:
+        digest = hashlib.sha256(self.template._sig_structure_prefix)
+        digest.update(encode_head(BYTE_STRING, len(self.payload)))
+        digest.update(self.payload)
+
+        return digest.digest()
+
+    def serialize(self, signature: bytes) -> bytes:
+        return b''.join((self.template._sign1_prefix,
+                         encode_head(BYTE_STRING, len(self.payload)),
+                         self.payload,
+                         encode_head(BYTE_STRING, len(signature)),
+                         signature))
+
+    def serialize_signed(self, key: Signer) -> bytes:
+        signer = as_signer(key)
+
+        if signer.prehash:
+            return self.serialize(signer.sign_digest(self.digest()))
+
+        return self.serialize(signer.sign(self.to_be_signed()))
@@ -1,7 +1,5 @@
-from cbor2 import loads
-
 from ace.cose.constants import Key
-from ace.edhoc.util import ecdsa_cose_to_key, ecdh_cose_to_key, ecdsa_key_to_cose, ecdh_key_to_cose
+from ace.edhoc.util import cose_to_key, ecdsa_key_to_cose, ecdh_key_to_cose
 
 
 class CoseKey:
@@ -14,8 +12,11 @@ class CoseKey:
         self.key = key
         self.key_id = key_id
         self.ktype = ktype
+        self._encoded = None
 
     def encode(self):
+        if self._encoded is not None:
+            return self._encoded
         if self.ktype == CoseKey.Type.ECDSA:
             return ecdsa_key_to_cose(self.key, kid=self.key_id)
         if self.ktype == CoseKey.Type.ECDHE:
@@ -25,13 +26,16 @@ class CoseKey:
 
     @classmethod
     def from_cose(cls, encoded: bytes, ktype: Type = Type.ECDSA):
-        decoded = loads(encoded)
+        """
+        Decode a COSE_Key with a kid, the validated key is shared with repeated encodings, see cose_to_key()
+        """
+        encoded = bytes(encoded)
 
-        key_id = decoded[Key.KID]
+        (key, key_id) = cose_to_key(encoded, ecdh=ktype == CoseKey.Type.ECDHE)
+        if key_id is None:
+            raise KeyError(Key.KID)
 
-        if ktype == CoseKey.Type.ECDSA:
-            key = ecdsa_cose_to_key(encoded)
-        else:
-            key = ecdh_cose_to_key(encoded)
+        cose_key = CoseKey(key, key_id, ktype)
+        cose_key._encoded = encoded
 
-        return CoseKey(key, key_id, ktype)
+        return cose_key
@@ -0,0 +1,574 @@
+"""
+Signature backends used by COSE, CWT and EDHOC.
+
+The default backend is `cryptography` (OpenSSL), the pure-Python `ecdsa` package is kept as a fallback.
+Independently of the backend, ECDSA signatures are always the raw r||s concatenation required by RFC 8152.
+Ed25519 (EdDSA) keys are always handled by `cryptography`.
+"""
+import hashlib
+import secrets
+import threading
+
+from collections import deque
+
+import ecdsa
+from ecdsa import util, BadSignatureError
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature, decode_dss_signature, Prehashed
+
+from ace.cose.constants import Key, Algorithm
+
+backend = default_backend()
+
+_prehashed = ec.ECDSA(Prehashed(hashes.SHA256()))
+
+CRYPTOGRAPHY = 'cryptography'
+ECDSA = 'ecdsa'
+
+_default_library = CRYPTOGRAPHY
+
+_cryptography_curves = {
+    Key.Curve.P_256: ec.SECP256R1,
+    Key.Curve.P_384: ec.SECP384R1,
+    Key.Curve.P_521: ec.SECP521R1
+}
+
+_cryptography_names = {
+    'secp256r1': Key.Curve.P_256,
+    'secp384r1': Key.Curve.P_384,
+    'secp521r1': Key.Curve.P_521
+}
+
+_ecdsa_curves = {
+    Key.Curve.P_256: ecdsa.NIST256p,
+    Key.Curve.P_384: ecdsa.NIST384p,
+    Key.Curve.P_521: ecdsa.NIST521p
+}
+
+_ecdsa_names = {
+    'NIST256p': Key.Curve.P_256,
+    'NIST384p': Key.Curve.P_384,
+    'NIST521p': Key.Curve.P_521
+}
+
+# Size of a single coordinate (and of r and s) in bytes
+coordinate_sizes = {
+    Key.Curve.P_256: 32,
+    Key.Curve.P_384: 48,
+    Key.Curve.P_521: 66
+}
+
+
+def set_default_library(name: str):
+    """
+    Select the backend used when wrapping plain keys
+    :param name: Either CRYPTOGRAPHY or ECDSA
+    """
+    global _default_library
+
+    if name not in (CRYPTOGRAPHY, ECDSA):
+        raise ValueError(f"Unknown signature backend '{name}'")
+
+    _default_library = name
+
+
+def get_default_library() -> str:
+    return _default_library
+
+
+class Signer:
+    """
+    Creates raw r||s signatures over a message
+    """
+
+    algorithm = Algorithm.ES256
+
+    # Whether sign_digest() is supported, EdDSA can only sign complete messages
+    prehash = True
+
+    @property
+    def curve(self) -> int:
+        raise NotImplementedError
+
+    def sign(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def sign_digest(self, digest: bytes) -> bytes:
+        """
+        Sign the SHA-256 digest of a message, for messages that are hashed incrementally
+        :raises TypeError: If the key type can not sign digests, see prehash
+        """
+        raise NotImplementedError
+
+    def verifier(self) -> 'Verifier':
+        raise NotImplementedError
+
+
+class Verifier:
+    """
+    Checks raw r||s signatures over a message
+    """
+
+    algorithm = Algorithm.ES256
+
+    # Whether verify_digest() is supported, EdDSA can only verify complete messages
+    prehash = True
+
+    @property
+    def curve(self) -> int:
+        raise NotImplementedError
+
+    def verify(self, signature: bytes, data: bytes) -> bool:
+        raise NotImplementedError
+
+    def verify_digest(self, signature: bytes, digest: bytes) -> bool:
+        """
+        Verify a signature given the SHA-256 digest of the message
+        :raises TypeError: If the key type can not verify digests, see prehash
+        """
+        raise NotImplementedError
+
+    def public_numbers(self):
+        """
+        :return: (curve, x, y) with the COSE curve identifier and both coordinates as integers
+        :raises TypeError: If the key has no coordinates
+        """
+        raise NotImplementedError
+
+
+class CryptographySigner(Signer):
+
+    def __init__(self, private_key: ec.EllipticCurvePrivateKey):
+        self.private_key = private_key
+        self._curve = _cryptography_names[private_key.curve.name]
+        self._size = coordinate_sizes[self._curve]
+
+    @property
+    def curve(self) -> int:
+        return self._curve
+
+    def sign(self, data: bytes) -> bytes:
+        return self._raw(self.private_key.sign(data, ec.ECDSA(hashes.SHA256())))
+
+    def sign_digest(self, digest: bytes) -> bytes:
+        return self._raw(self.private_key.sign(digest, _prehashed))
+
+    def _raw(self, der_signature: bytes) -> bytes:
+        (r, s) = decode_dss_signature(der_signature)
+
+        return r.to_bytes(self._size, 'big') + s.to_bytes(self._size, 'big')
+
+    def verifier(self) -> 'CryptographyVerifier':
+        return CryptographyVerifier(self.private_key.public_key())
+
+    # OpenSSL keys cannot be pickled, transfer them as DER so signers can be handed to worker processes
+    def __getstate__(self):
+        return self.private_key.private_bytes(serialization.Encoding.DER,
+                                              serialization.PrivateFormat.PKCS8,
+                                              serialization.NoEncryption())
+
+    def __setstate__(self, state):
+        self.__init__(serialization.load_der_private_key(state, password=None, backend=backend))
+
+
+class CryptographyVerifier(Verifier):
+
+    def __init__(self, public_key: ec.EllipticCurvePublicKey):
+        self.public_key = public_key
+        self._curve = _cryptography_names[public_key.curve.name]
+        self._size = coordinate_sizes[self._curve]
+
+    @property
+    def curve(self) -> int:
+        return self._curve
+
+    def verify(self, signature: bytes, data: bytes) -> bool:
+        return self._verify(signature, data, ec.ECDSA(hashes.SHA256()))
+
+    def verify_digest(self, signature: bytes, digest: bytes) -> bool:
+        return self._verify(signature, digest, _prehashed)
+
+    def _verify(self, signature: bytes, data: bytes, algorithm) -> bool:
+        if len(signature) != 2 * self._size:
+            return False
+
+        r = int.from_bytes(signature[:self._size], 'big')
+        s = int.from_bytes(signature[self._size:], 'big')
+
+        try:
+            self.public_key.verify(encode_dss_signature(r, s), data, algorithm)
+        except InvalidSignature:
+            return False
+
+        return True
+
+    def public_numbers(self):
+        numbers = self.public_key.public_numbers()
+        return self._curve, numbers.x, numbers.y
+
+    def __getstate__(self):
+        return self.public_key.public_bytes(serialization.Encoding.DER,
+                                            serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    def __setstate__(self, state):
+        self.__init__(serialization.load_der_public_key(state, backend=backend))
+
+
+class EcdsaSigner(Signer):
+
+    def __init__(self, signing_key: ecdsa.SigningKey):
+        self.signing_key = signing_key
+        self._curve = _ecdsa_names[signing_key.curve.name]
+
+    @property
+    def curve(self) -> int:
+        return self._curve
+
+    def sign(self, data: bytes) -> bytes:
+        return self.signing_key.sign_deterministic(data, hashlib.sha256, sigencode=util.sigencode_string)
+
+    def sign_digest(self, digest: bytes) -> bytes:
+        return self.signing_key.sign_digest_deterministic(digest, hashlib.sha256, sigencode=util.sigencode_string)
+
+    def verifier(self) -> 'EcdsaVerifier':
+        return EcdsaVerifier(self.signing_key.get_verifying_key())
+
+
+class EcdsaVerifier(Verifier):
+
+    def __init__(self, verifying_key: ecdsa.VerifyingKey):
+        self.verifying_key = verifying_key
+        self._curve = _ecdsa_names[verifying_key.curve.name]
+
+    @property
+    def curve(self) -> int:
+        return self._curve
+
+    def verify(self, signature: bytes, data: bytes) -> bool:
+        try:
+            return self.verifying_key.verify(signature, data, hashlib.sha256, sigdecode=util.sigdecode_string)
+        except (BadSignatureError, util.MalformedSignature):
+            return False
+
+    def verify_digest(self, signature: bytes, digest: bytes) -> bool:
+        try:
+            return self.verifying_key.verify_digest(signature, digest, sigdecode=util.sigdecode_string)
+        except (BadSignatureError, util.MalformedSignature):
+            return False
+
+    def public_numbers(self):
+        point = self.verifying_key.pubkey.point
+        return self._curve, point.x(), point.y()
+
+
+class Ed25519Signer(Signer):
+
+    algorithm = Algorithm.EdDSA
+    prehash = False
+
+    def __init__(self, private_key: ed25519.Ed25519PrivateKey):
+        self.private_key = private_key
+
+    @property
+    def curve(self) -> int:
+        return Key.Curve.Ed25519
+
+    def sign(self, data: bytes) -> bytes:
+        return self.private_key.sign(data)
+
+    def sign_digest(self, digest: bytes) -> bytes:
+        raise TypeError("EdDSA signs the complete message")
+
+    def verifier(self) -> 'Ed25519Verifier':
+        return Ed25519Verifier(self.private_key.public_key())
+
+    def __getstate__(self):
+        return self.private_key.private_bytes(serialization.Encoding.Raw,
+                                              serialization.PrivateFormat.Raw,
+                                              serialization.NoEncryption())
+
+    def __setstate__(self, state):
+        self.__init__(ed25519.Ed25519PrivateKey.from_private_bytes(state))
+
+
+class Ed25519Verifier(Verifier):
+
+    algorithm = Algorithm.EdDSA
+    prehash = False
+
+    def __init__(self, public_key: ed25519.Ed25519PublicKey):
+        self.public_key = public_key
+
+    @classmethod
+    def from_public_bytes(cls, x: bytes) -> 'Ed25519Verifier':
+        return cls(ed25519.Ed25519PublicKey.from_public_bytes(x))
+
+    @property
+    def curve(self) -> int:
+        return Key.Curve.Ed25519
+
+    def verify(self, signature: bytes, data: bytes) -> bool:
+        try:
+            self.public_key.verify(signature, data)
+        except InvalidSignature:
+            return False
+
+        return True
+
+    def verify_digest(self, signature: bytes, digest: bytes) -> bool:
+        raise TypeError("EdDSA verifies the complete message")
+
+    def public_bytes(self) -> bytes:
+        """
+        :return: The 32 byte encoded public key, the x parameter of an OKP COSE_Key
+        """
+        return self.public_key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+    def public_numbers(self):
+        raise TypeError("Ed25519 keys have no (x, y) coordinates, see public_bytes()")
+
+    def __getstate__(self):
+        return self.public_bytes()
+
+    def __setstate__(self, state):
+        self.__init__(ed25519.Ed25519PublicKey.from_public_bytes(state))
+
+
+class PrecomputedNonceSigner(Signer):
+    """
+    ECDSA signer drawing precomputed (r, k^-1) pairs from a pool that a background thread fills with
+    nonces k from a CSPRNG, so signing in the request path costs two modular multiplications instead
+    of a scalar multiplication. Falls back to the wrapped signer while the pool is empty.
+
+    Each nonce is used exactly once. Pickling, e.g. to hand the signer to worker processes, therefore
+    yields the wrapped signer without the pool.
+    """
+
+    def __init__(self, key, pool_size: int = 1024, low_water: int = 256, library: str = None):
+        """
+        :param key: ECDSA private key or Signer, used for the fallback
+        :param pool_size: Number of pairs the pool is filled up to
+        :param low_water: Pool size below which the background thread refills the pool, at most pool_size
+        """
+        self.base = as_signer(key, library)
+        if not self.base.prehash:
+            raise TypeError("Precomputed nonces require an ECDSA key")
+        if not 0 <= low_water <= pool_size:
+            raise ValueError("low_water must be between 0 and pool_size")
+
+        self.pool_size = pool_size
+        self.low_water = low_water
+
+        self._d = _private_value(self.base)
+        self._n = _ecdsa_curves[self.base.curve].order
+        self._size = coordinate_sizes[self.base.curve]
+        self._ec_curve = _cryptography_curves[self.base.curve]()
+
+        self._pool = deque()
+        self._wakeup = threading.Event()
+        self._closed = False
+
+        # Counters updated by request threads and the background thread, see stats()
+        self._counter_lock = threading.Lock()
+        self.precomputed = 0
+        self.signed = 0
+        self.fallbacks = 0
+        self.refills = 0
+
+        self._worker = threading.Thread(target=self._refill_loop, name='ace-nonce-pool', daemon=True)
+        self._worker.start()
+        self._wakeup.set()
+
+    @property
+    def curve(self) -> int:
+        return self.base.curve
+
+    def sign(self, data: bytes) -> bytes:
+        return self.sign_digest(hashlib.sha256(data).digest())
+
+    def sign_digest(self, digest: bytes) -> bytes:
+        try:
+            (r, k_inv) = self._pool.popleft()
+        except IndexError:
+            self._wakeup.set()
+            with self._counter_lock:
+                self.fallbacks += 1
+            return self.base.sign_digest(digest)
+
+        if len(self._pool) < self.low_water:
+            self._wakeup.set()
+
+        z = int.from_bytes(digest, 'big')
+        excess = 8 * len(digest) - self._n.bit_length()
+        if excess > 0:
+            z >>= excess
+
+        s = k_inv * (z + r * self._d) % self._n
+        if s == 0:
+            with self._counter_lock:
+                self.fallbacks += 1
+            return self.base.sign_digest(digest)
+
+        with self._counter_lock:
+            self.signed += 1
+        return r.to_bytes(self._size, 'big') + s.to_bytes(self._size, 'big')
+
+    def verifier(self) -> Verifier:
+        return self.base.verifier()
+
+    def stats(self) -> dict:
+        with self._counter_lock:
+            return {
+                'pool': len(self._pool),
+                'pool_size': self.pool_size,
+                'low_water': self.low_water,
+                'precomputed': self.precomputed,
+                'signed': self.signed,
+                'fallbacks': self.fallbacks,
+                'refills': self.refills
+            }
+
+    def close(self):
+        """
+        Stop the background thread and drop the remaining nonces
+        """
+        self._closed = True
+        self._wakeup.set()
+        self._worker.join()
+        self._pool.clear()
+
+    def _precompute(self) -> tuple:
+        while True:
+            k = secrets.randbelow(self._n - 1) + 1
+
+            # k*G in OpenSSL, which releases the GIL
+            point = ec.derive_private_key(k, self._ec_curve, backend).public_key().public_numbers()
+            r = point.x % self._n
+
+            if r != 0:
+                return r, pow(k, -1, self._n)
+
+    def _refill_loop(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+
+            if self._closed:
+                return
+            if len(self._pool) >= self.low_water:
+                continue
+
+            with self._counter_lock:
+                self.refills += 1
+            while len(self._pool) < self.pool_size and not self._closed:
+                self._pool.append(self._precompute())
+                with self._counter_lock:
+                    self.precomputed += 1
+
+    def __reduce__(self):
+        return _identity, (self.base,)
+
+
+def _identity(value):
+    return value
+
+
+def _private_value(signer: Signer) -> int:
+    if isinstance(signer, CryptographySigner):
+        return signer.private_key.private_numbers().private_value
+    if isinstance(signer, EcdsaSigner):
+        return signer.signing_key.privkey.secret_multiplier
+
+    raise TypeError(f"Unsupported signer type {type(signer).__name__}")
+
+
+def as_signer(key, library: str = None) -> Signer:
+    """
+    Wrap a private key of either library into a Signer of the requested backend
+    :param key: A Signer, an ecdsa.SigningKey, a cryptography EllipticCurvePrivateKey or Ed25519PrivateKey
+    :param library: CRYPTOGRAPHY or ECDSA, defaults to the module wide default
+    """
+    if isinstance(key, Signer):
+        return key
+
+    if isinstance(key, ed25519.Ed25519PrivateKey):
+        return Ed25519Signer(key)
+
+    library = library or _default_library
+
+    if isinstance(key, ecdsa.SigningKey):
+        if library == ECDSA:
+            return EcdsaSigner(key)
+
+        curve = _cryptography_curves[_ecdsa_names[key.curve.name]]
+        return CryptographySigner(ec.derive_private_key(key.privkey.secret_multiplier, curve(), backend=backend))
+
+    if isinstance(key, ec.EllipticCurvePrivateKey):
+        if library == CRYPTOGRAPHY:
+            return CryptographySigner(key)
+
+        curve = _ecdsa_curves[_cryptography_names[key.curve.name]]
+        return EcdsaSigner(ecdsa.SigningKey.from_secret_exponent(key.private_numbers().private_value, curve))
+
+    raise TypeError(f"Unsupported signing key type {type(key).__name__}")
+
+
+def as_verifier(key, library: str = None) -> Verifier:
+    """
+    Wrap a public key of either library into a Verifier of the requested backend
+    :param key: A Verifier, an ecdsa.VerifyingKey, a cryptography EllipticCurvePublicKey or Ed25519PublicKey
+    :param library: CRYPTOGRAPHY or ECDSA, defaults to the module wide default
+    """
+    if isinstance(key, Verifier):
+        return key
+
+    if isinstance(key, ed25519.Ed25519PublicKey):
+        return Ed25519Verifier(key)
+
+    library = library or _default_library
+
+    if isinstance(key, ecdsa.VerifyingKey):
+        if library == ECDSA:
+            return EcdsaVerifier(key)
+
+        point = key.pubkey.point
+        return verifier_from_numbers(_ecdsa_names[key.curve.name], point.x(), point.y(), library)
+
+    if isinstance(key, ec.EllipticCurvePublicKey):
+        if library == CRYPTOGRAPHY:
+            return CryptographyVerifier(key)
+
+        numbers = key.public_numbers()
+        return verifier_from_numbers(_cryptography_names[key.curve.name], numbers.x, numbers.y, library)
+
+    raise TypeError(f"Unsupported verifying key type {type(key).__name__}")
+
+
+def verifier_from_numbers(curve: int, x: int, y: int, library: str = None) -> Verifier:
+    """
+    Create a Verifier from a COSE curve identifier and the public point coordinates
+    """
+    library = library or _default_library
+
+    if library == ECDSA:
+        ecdsa_curve = _ecdsa_curves[curve]
+        point = ecdsa.ellipticcurve.Point(ecdsa_curve.curve, x, y)
+        return EcdsaVerifier(ecdsa.VerifyingKey.from_public_point(point, ecdsa_curve))
+
+    numbers = ec.EllipticCurvePublicNumbers(x, y, _cryptography_curves[curve]())
+    return CryptographyVerifier(numbers.public_key(backend))
+
+
+def generate_signing_key(curve: int = Key.Curve.P_256):
+    """
+    Generate a private key for signing
+    :param curve: COSE identifier of the curve, Key.Curve.Ed25519 for EdDSA
+    :return: An ecdsa.SigningKey for the NIST curves, a cryptography Ed25519PrivateKey for Ed25519
+    """
+    if curve == Key.Curve.Ed25519:
+        return ed25519.Ed25519PrivateKey.generate()
+
+    return ecdsa.SigningKey.generate(curve=_ecdsa_curves[curve])
@@ -0,0 +1,89 @@
+import time
+
+from cbor2 import loads, CBORDecodeError
+
+from ace.cose.constants import Header, Tag
+from ace.cose.cose import SignatureVerificationFailed, parse_structure
+from ace.cose.signing import Verifier, as_verifier
+from ace.cbor.cbor import encode_head, TAG
+
+
+class TrustStore(object):
+    """
+    Keys of trusted token issuers indexed by key id, so the key verifying a token is found with a
+    single lookup of the kid in its unprotected header. Keys can be added and removed at runtime,
+    e.g. while the issuer rotates its signing key.
+    """
+
+    def __init__(self, clock=time.time):
+        # kid => (key, expires)
+        self._keys = {}
+        self._clock = clock
+
+    def add(self, kid: bytes, key, expires: float = None):
+        """
+        :param key: Public key of the issuer, or the shared key for MACed tokens
+        :param expires: Time after which tokens are no longer accepted under this kid, None for never
+        """
+        if not isinstance(key, (bytes, Verifier)):
+            key = as_verifier(key)
+
+        self._keys[kid] = (key, expires)
+
+    def remove(self, kid: bytes):
+        self._keys.pop(kid, None)
+
+    def get(self, kid: bytes):
+        """
+        :return: The key registered under kid, None if unknown or expired
+        """
+        entry = self._keys.get(kid)
+        if entry is None:
+            return None
+
+        (key, expires) = entry
+        if expires is not None and expires <= self._clock():
+            return None
+
+        return key
+
+    def resolve(self, encoded):
+        """
+        :return: The key for the kid in the unprotected header of an encoded COSE_Sign1 or COSE_Mac0
+        :raises SignatureVerificationFailed: If the message has no kid or the kid is not trusted
+        """
+        key = self.get(self._kid(encoded))
+        if key is None:
+            raise SignatureVerificationFailed("Untrusted key id")
+
+        return key
+
+    def expires(self, encoded):
+        """
+        :return: The time after which the key of an encoded COSE_Sign1 or COSE_Mac0 is no longer
+                 trusted, None for never
+        :raises SignatureVerificationFailed: If the message has no kid or the kid is unknown
+        """
+        entry = self._keys.get(self._kid(encoded))
+        if entry is None:
+            raise SignatureVerificationFailed("Untrusted key id")
+
+        return entry[1]
+
+    def _kid(self, encoded) -> bytes:
+        tag = Tag.COSE_MAC0 if encoded[:1] == _mac0_tag else Tag.COSE_SIGN1
+
+        try:
+            (protected, unprotected, payload, signature) = parse_structure(encoded, tag)
+            return loads(bytes(unprotected)).get(Header.KID)
+        except (ValueError, IndexError, AttributeError, CBORDecodeError) as e:
+            raise SignatureVerificationFailed(str(e))
+
+    def __contains__(self, kid):
+        return self.get(kid) is not None
+
+    def __len__(self):
+        return len(self._keys)
+
+
+_mac0_tag = encode_head(TAG, Tag.COSE_MAC0)
@@ -1,2 +1,3 @@
 from ace.edhoc.protocol import Server, Client
 from ace.edhoc.context import OscoreContext, bxor
+from ace.edhoc.store import ContextStore
@@ -1,10 +1,11 @@
-from cbor2 import loads, dumps
+from cbor2 import dumps
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.backends import default_backend
 
 
 from ace.cose import Encrypt0Message
+from ace.cose.cose import DEFAULT_AEAD, aead_algorithms
 from ace.cose.constants import Header
 
 backend = default_backend()
@@ -12,15 +13,40 @@ backend = default_backend()
 
 class OscoreContext:
 
-    def __init__(self, secret: bytes, salt: bytes, sid: bytes, rid: bytes):
+    def __init__(self, secret: bytes, salt: bytes, sid: bytes, rid: bytes, alg: int = DEFAULT_AEAD):
+        """
+        :param alg: AEAD algorithm of the context, determines key and nonce lengths
+        """
         self.master_secret = secret
         self.master_salt = salt
         self.sender_id = sid
         self.recipient_id = rid
+        self.alg = alg
         self.sequence_number = 0
 
+        # Sequence numbers received, None to accept any, see ReplayWindow
+        self.replay_window: ReplayWindow = None
+
+        # Called when the sequence number reaches checkpointed or the replay window reaches
+        # replay_checkpointed, e.g. to persist the context in blocks, see ContextStore
+        self.on_checkpoint = None
+        self.checkpointed = None
+        self.replay_checkpointed = None
+
+        algorithm = aead_algorithms[alg]
+        self.key_length = algorithm.key_length
+        # OSCORE nonces are at least 7 bytes: ID length, ID and a 5 byte Partial IV
+        self.nonce_length = max(7, algorithm.nonce_length)
+
+        if max(len(sid), len(rid)) > self.nonce_length - 6:
+            raise ValueError("Sender or recipient ID too long for the nonce of the AEAD algorithm")
+
+        self._sender_key = None
+        self._recipient_key = None
+        self._common_iv = None
+
     def encrypt(self, payload: bytes):
-        piv = bytes([self.sequence_number])
+        piv = partial_iv(self.next_sequence_number())
         kid = self.sender_id
 
         protected_header = b''
@@ -29,11 +55,7 @@ class OscoreContext:
 
         # Compute sender key and nonce for this particular message
         key = self.sender_key()
-        nonce = bytes([len(self.sender_id)]) + self.sender_id.rjust(7, b'\0') + bytes([self.sequence_number]).rjust(5, b'\0')
-        nonce = bxor(nonce, self.common_iv())
-
-        # Increase sequence number => nonce is always unique
-        self.sequence_number += 1
+        nonce = self.nonce(self.sender_id, piv)
 
         aad = dumps([piv, kid])
 
@@ -42,50 +64,158 @@ class OscoreContext:
             plaintext=payload,
             protected_header=protected_header,
             unprotected_header=unprotected_header,
-            external_aad=aad
+            external_aad=aad,
+            alg=self.alg
         ).serialize(iv=nonce, key=key)
 
+    def next_sequence_number(self) -> int:
+        """
+        Use up a sequence number, every number is used once => nonce is always unique
+        """
+        if self.on_checkpoint is not None and self.sequence_number >= self.checkpointed:
+            self.on_checkpoint(self)
+
+        sequence_number = self.sequence_number
+        self.sequence_number += 1
+
+        return sequence_number
+
     def decrypt(self, encoded: bytes):
+        return self.decrypt_parsed(*Encrypt0Message.parse(encoded))
+
+    def decrypt_parsed(self, protected: bytes, unprotected: dict, ciphertext: bytes):
+        """
+        Decrypt a message already split by Encrypt0Message.parse()
+        """
         # Extract Partial IV (piv) and kid (recipient_id)
-        prot, unprot, cipher = loads(encoded).value
-        piv = unprot[Header.PARTIAL_IV]
-        kid = unprot[Header.KID]
+        piv = unprotected[Header.PARTIAL_IV]
+        kid = unprotected[Header.KID]
 
         aad = dumps([piv, kid])
 
+        # Reject replays before spending a decryption on them
+        sequence_number = int.from_bytes(piv, 'big')
+        if self.replay_window is not None and not self.replay_window.check(sequence_number):
+            raise ReplayError("Replayed message")
+
         # Compute Key and Nonce for message
         key = self.recipient_key()
-        nonce = bytes([len(self.recipient_id)]) + self.recipient_id.rjust(7, b'\0') + piv.rjust(5, b'\0')
-        nonce = bxor(nonce, self.common_iv())
+        nonce = self.nonce(self.recipient_id, piv)
 
         # Decrypt message
-        return Encrypt0Message.decrypt(
-            encoded,
+        plaintext = Encrypt0Message.decrypt_parsed(
+            protected,
+            ciphertext,
             iv=nonce,
             key=key,
-            external_aad=aad
+            external_aad=aad,
+            alg=self.alg
         )
 
+        # Only authentic messages move the window, a shared window may have seen the number meanwhile
+        if self.replay_window is not None:
+            if not self.replay_window.update(sequence_number):
+                raise ReplayError("Replayed message")
+
+            if self.on_checkpoint is not None and self.replay_window.highest >= self.replay_checkpointed:
+                self.on_checkpoint(self)
+
+        return plaintext
+
+    def nonce(self, id: bytes, piv: bytes) -> bytes:
+        """
+        AEAD nonce: ID length, ID and Partial IV, left-padded to the nonce length and XORed with the Common IV
+        """
+        nonce = bytes([len(id)]) + id.rjust(self.nonce_length - 6, b'\0') + piv.rjust(5, b'\0')
+        return bxor(nonce, self.common_iv())
+
     def __str__(self):
         return f'OSCORE context (master_secret={self.master_secret.hex()}, master_salt={self.master_salt.hex()})'
 
     def sender_key(self):
         # derive sender CEK
-        # CEK = hkdf(master_salt, master_secret, [sender_id, 12, "Key", 16])
-        info = dumps([self.sender_id, 10, "Key", 16])
-        return HKDF(hashes.SHA256(), 16, self.master_salt, info, backend).derive(self.master_secret)
+        # CEK = hkdf(master_salt, master_secret, [sender_id, alg, "Key", key_length])
+        if self._sender_key is None:
+            self._sender_key = self._derive(self.sender_id, "Key", self.key_length)
+        return self._sender_key
 
     def recipient_key(self):
         # derive recipient CEK
-        # CEK = hkdf(master_salt, master_secret, [recipient_id, 12, "Key", 16])
-        info = dumps([self.recipient_id, 10, "Key", 16])
-        return HKDF(hashes.SHA256(), 16, self.master_salt, info, backend).derive(self.master_secret)
+        # CEK = hkdf(master_salt, master_secret, [recipient_id, alg, "Key", key_length])
+        if self._recipient_key is None:
+            self._recipient_key = self._derive(self.recipient_id, "Key", self.key_length)
+        return self._recipient_key
 
     def common_iv(self):
         # derive Common IV
-        # CIV = hkdf(master_salt, master_secret, [b'', 12, "IV", 7])
-        info = dumps([b'', 10, "IV", 13])
-        return HKDF(hashes.SHA256(), 13, self.master_salt, info, backend).derive(self.master_secret)
+        # CIV = hkdf(master_salt, master_secret, [b'', alg, "IV", nonce_length])
+        if self._common_iv is None:
+            self._common_iv = self._derive(b'', "IV", self.nonce_length)
+        return self._common_iv
+
+    def _derive(self, id: bytes, type: str, length: int) -> bytes:
+        info = dumps([id, self.alg, type, length])
+        return HKDF(hashes.SHA256(), length, self.master_salt, info, backend).derive(self.master_secret)
+
+
+class ReplayError(ValueError):
+    pass
+
+
+class ReplayWindow:
+    """
+    Sequence numbers received by a recipient: the highest one and a bitmap of the ones before it.
+    Numbers received before or older than the window are rejected.
+    """
+
+    def __init__(self, size: int = 32, highest: int = -1, bitmap: int = 0):
+        """
+        :param bitmap: Bit i is set if highest - i was received
+        """
+        self.size = size
+        self.highest = highest
+        self.bitmap = bitmap
+
+    def check(self, sequence_number: int) -> bool:
+        """
+        :return: True if sequence_number is acceptable
+        """
+        if sequence_number > self.highest:
+            return True
+
+        offset = self.highest - sequence_number
+        return offset < self.size and not self.bitmap >> offset & 1
+
+    def update(self, sequence_number: int) -> bool:
+        """
+        Mark sequence_number as received
+        :return: False if it was not acceptable, see check()
+        """
+        if not self.check(sequence_number):
+            return False
+
+        if sequence_number > self.highest:
+            self.bitmap = ((self.bitmap << (sequence_number - self.highest)) | 1) & ((1 << self.size) - 1)
+            self.highest = sequence_number
+        else:
+            self.bitmap |= 1 << (self.highest - sequence_number)
+
+        return True
+
+
+# Sequence numbers are encoded in at most 5 bytes
+MAX_SEQUENCE_NUMBER = (1 << 40) - 1
+
+
+def partial_iv(sequence_number: int) -> bytes:
+    """
+    :return: The sequence number in as few bytes as possible, big endian
+    :raises ValueError: If the sequence numbers of the context are used up
+    """
+    if sequence_number > MAX_SEQUENCE_NUMBER:
+        raise ValueError("Sequence numbers exhausted")
+
+    return sequence_number.to_bytes(max(1, (sequence_number.bit_length() + 7) // 8), 'big')
 
 
 def bxor(a: bytes, b: bytes) -> bytes:
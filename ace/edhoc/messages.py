@@ -3,6 +3,7 @@ from cbor2.encoder import encode_array
 
 from ace.cose import Signature1Message, Encrypt0Message
 from ace.cose.cose import Header, Algorithm
+from ace.cose.signing import as_signer
 from ace.edhoc.util import ecdh_key_to_cose, ecdh_cose_to_key
 
 EDHOC_MSG_1 = 1
@@ -51,29 +52,41 @@ class Message1(EdhocMessage):
 
     _tag = EDHOC_MSG_1
 
-    def __init__(self, session_id: bytes, nonce: bytes, ephemeral_key, bytes_object: bytes=None):
+    def __init__(self, session_id: bytes, nonce: bytes, ephemeral_key, bytes_object: bytes=None,
+                 aead_algorithms: list = None):
+        """
+        :param aead_algorithms: AEAD algorithms offered for the OSCORE context in order of preference,
+                                sent as optional trailing element
+        """
         super().__init__(bytes_object)
         self.session_id = session_id
         self.nonce = nonce
         self.ephemeral_key = ephemeral_key
+        self.aead_algorithms = aead_algorithms
 
     @property
     def _data(self):
-        return (self.tag,
+        data = (self.tag,
                 self.session_id,
                 self.nonce,
                 ecdh_key_to_cose(self.ephemeral_key, encode=True))
 
+        if self.aead_algorithms:
+            return (*data, list(self.aead_algorithms))
+
+        return data
+
     @classmethod
     def from_bytes(cls, bytes_object):
-        (tag, session_id, nonce, cose_key) = loads(bytes_object)
+        (tag, session_id, nonce, cose_key, *optional) = loads(bytes_object)
 
         if tag != EDHOC_MSG_1:
             raise ValueError("Not a MSG1 type")
 
         msg1 = Message1(session_id=session_id,
                         nonce=nonce,
-                        ephemeral_key=ecdh_cose_to_key(cose_key))
+                        ephemeral_key=ecdh_cose_to_key(cose_key),
+                        aead_algorithms=optional[0] if optional else None)
         assert (dumps(msg1, default=encode_array) == bytes_object)
         return msg1
 
@@ -82,12 +95,17 @@ class Message2(EdhocMessage):
 
     _tag = EDHOC_MSG_2
 
-    def __init__(self, session_id: bytes, peer_session_id: bytes, peer_nonce: bytes, peer_ephemeral_key, bytes_object:bytes=None):
+    def __init__(self, session_id: bytes, peer_session_id: bytes, peer_nonce: bytes, peer_ephemeral_key, bytes_object:bytes=None,
+                 aead: int = None):
+        """
+        :param aead: AEAD algorithm chosen for the OSCORE context, only sent if algorithms were offered in MSG1
+        """
         super().__init__(bytes_object)
         self.session_id = session_id
         self.peer_session_id = peer_session_id
         self.peer_nonce = peer_nonce
         self.peer_key = peer_ephemeral_key
+        self.aead = aead
 
         self._aad_2 = None
         self._cose_sig_v = None
@@ -107,12 +125,18 @@ class Message2(EdhocMessage):
 
     @property
     def data_2(self):
-        return (self.tag,
+        data = (self.tag,
                 self.session_id,
                 self.peer_session_id,
                 self.peer_nonce,
                 ecdh_key_to_cose(self.peer_key, kid=b'abcd', encode=True))
 
+        # The chosen AEAD is part of data_2, so it is covered by aad_2 and the signature
+        if self.aead is not None:
+            return (*data, self.aead)
+
+        return data
+
     def aad_2(self, hashfunc, message_1: bytes):
         return hashfunc(message_1 + dumps(self.data_2))
 
@@ -128,7 +152,8 @@ class Message2(EdhocMessage):
         ).serialize(iv, key)
 
     def cose_sig_v(self, key):
-        protected = dumps({ Header.ALG: Algorithm.ES256 })
+        key = as_signer(key)
+        protected = dumps({ Header.ALG: key.algorithm })
         unprotected = { Header.KID: b'AsymmetricECDSA256' }
 
         return Signature1Message(
@@ -140,7 +165,7 @@ class Message2(EdhocMessage):
 
     @classmethod
     def from_bytes(cls, bytes_object):
-        (tag, session_id, peer_session_id, peer_nonce, cose_key, cose_enc_2) = loads(bytes_object)
+        (tag, session_id, peer_session_id, peer_nonce, cose_key, *optional, cose_enc_2) = loads(bytes_object)
 
         if tag != EDHOC_MSG_2:
             raise ValueError("Not a MSG2 type")
@@ -148,7 +173,8 @@ class Message2(EdhocMessage):
         return Message2(session_id=session_id,
                         peer_session_id=peer_session_id,
                         peer_nonce=peer_nonce,
-                        peer_ephemeral_key=cose_key)
+                        peer_ephemeral_key=cose_key,
+                        aead=optional[0] if optional else None)
 
 
 class Message3(EdhocMessage):
@@ -193,7 +219,8 @@ class Message3(EdhocMessage):
         ).serialize(iv, key)
 
     def cose_sig_u(self, key, kid: bytes):
-        protected = dumps({ Header.ALG: Algorithm.ES256 })
+        key = as_signer(key)
+        protected = dumps({ Header.ALG: key.algorithm })
         unprotected = { Header.KID: kid }
 
         return Signature1Message(
@@ -9,15 +9,31 @@ from ecdsa import SigningKey, VerifyingKey, NIST256p
 from cbor2 import loads, dumps
 
 from ace.cose.cose import SignatureVerificationFailed
-from ace.edhoc.context import OscoreContext
+from ace.cose.signing import Signer, Verifier, as_signer, as_verifier
+from ace.edhoc.context import OscoreContext, ReplayWindow
 from ace.edhoc.util import ecdh_cose_to_key, ecdh_key_to_cose
 from ace.edhoc.messages import Message1, Message2, Message3, MessageOk, \
     MessageError, EDHOC_MSG_1, EDHOC_MSG_2, EDHOC_MSG_3, EdhocMessage
 from ace.cose import Encrypt0Message, Signature1Message
 from ace.cose.constants import Header, Algorithm
+from ace.cose.cose import DEFAULT_AEAD, aead_algorithms as supported_aead_algorithms
 
 backend = default_backend()
 
+# Length of the EDHOC session ids, which become the OSCORE sender and recipient ids
+SESSION_ID_LENGTH = 2
+
+
+def check_aead_algorithms(algorithms: list):
+    """
+    :raises ValueError: If an algorithm is unknown or its nonce can not hold a session id, e.g. the
+                        7 byte nonce of AES-CCM-64-64-*, which only fits 1 byte ids
+    """
+    for alg in algorithms or []:
+        parameters = supported_aead_algorithms.get(alg)
+        if parameters is None or parameters.nonce_length - 6 < SESSION_ID_LENGTH:
+            raise ValueError(f"AEAD algorithm {alg} can not be used for OSCORE")
+
 
 def derive_key(input_key: bytes, length: int, context_info: bytes):
     # length is in bytes
@@ -51,6 +67,9 @@ class EdhocSession:
     def __init__(self):
         self.session = self.Session(session_id=None, shared_secret=None)
 
+        # AEAD of the OSCORE context, negotiated with MSG1 and MSG2
+        self.aead = DEFAULT_AEAD
+
         self.message1: bytes = None
         self.message2: bytes = None
         self.message3: bytes = None
@@ -81,7 +100,8 @@ class EdhocSession:
                 secret=master_secret,
                 salt=master_salt,
                 sid=self.id,
-                rid=self.peer_id
+                rid=self.peer_id,
+                alg=self.aead
             )
 
         return self._oscore_context
@@ -95,18 +115,32 @@ class EdhocSession:
 
 
 class Server:
-    def __init__(self, sk: SigningKey):
+    def __init__(self, sk: SigningKey, aead_algorithms: list = None, store=None, context_store=None):
+        """
+        :param aead_algorithms: AEAD algorithms accepted for OSCORE contexts in order of preference,
+                                the first one also offered by a client is chosen
+        :param store: State shared with other processes serving sk, e.g. ace.rs.SharedState. Handshakes,
+                      peer identities and security contexts not known locally are looked up there
+        :param context_store: ContextStore persisting the security contexts of a single process by
+                              recipient ID, so they survive a restart. Not used along with store
+        """
+        check_aead_algorithms(aead_algorithms)
+
         self.sk: SigningKey = sk
-        self.vk: VerifyingKey = sk.get_verifying_key()
+        self.aead_algorithms = aead_algorithms or [DEFAULT_AEAD]
+        self.signer: Signer = as_signer(sk)
+        self.vk: Verifier = self.signer.verifier()
         self.peer_identities = {}
         self.sessions = []
         self.security_contexts = {}
         self.pop_key_by_rid = {}
+        self.store = store
+        self.context_store = context_store
 
         super().__init__()
 
     def add_peer_identity(self, key_id: bytes, key: VerifyingKey):
-        self.peer_identities[key_id] = key
+        self.peer_identities[key_id] = as_verifier(key)
 
     def on_receive(self, message):
         print("Server Received: ", message.hex())
@@ -116,17 +150,31 @@ class Server:
         if decoded[0] == EDHOC_MSG_1:
             session = EdhocSession()
             self.sessions.append(session)
-            return self.on_msg_1(message, session)
+            response = self.on_msg_1(message, session)
+            if self.store is not None:
+                self.store.put_session(session)
+            return response
         elif decoded[0] == EDHOC_MSG_3:
             session_id = decoded[1]
-            session = [s for s in self.sessions if s.id == session_id][0]
+            session = self._session(session_id)
+            if session is None:
+                return MessageError()
             return self.on_msg_3(message, session)
 
+    def _session(self, session_id: bytes) -> EdhocSession:
+        session = next((s for s in self.sessions if s.id == session_id), None)
+
+        # The handshake may have been started with another process
+        if session is None and self.store is not None:
+            session = self.store.load_session(session_id)
+
+        return session
+
     def on_msg_1(self, message: bytes, session: EdhocSession):
         session.message1 = message
         msg = Message1.from_bytes(message)
 
-        session_id = os.urandom(2)
+        session_id = os.urandom(SESSION_ID_LENGTH)
         nonce = os.urandom(8)
 
         session_key = ec.generate_private_key(ec.SECP256R1, backend)
@@ -137,6 +185,12 @@ class Server:
 
         ecdh_shared_secret = session_key.exchange(ec.ECDH(), peer_session_key)
 
+        # Only answer with a choice if the client offered algorithms, else both use the default
+        aead = None
+        if msg.aead_algorithms:
+            aead = next((alg for alg in self.aead_algorithms if alg in msg.aead_algorithms), DEFAULT_AEAD)
+            session.aead = aead
+
         session.id = session_id
         session.peer_id = peer_session_id
         session.private_key = session_key
@@ -146,12 +200,13 @@ class Server:
         msg2 = Message2(session_id=peer_session_id,
                         peer_session_id=session_id,
                         peer_nonce=nonce,
-                        peer_ephemeral_key=public_session_key)
+                        peer_ephemeral_key=public_session_key,
+                        aead=aead)
 
         aad2 = msg2.aad_2(message_digest, session.message1)
 
         # Sign message
-        msg2.sign(self.sk, aad=aad2)
+        msg2.sign(self.signer, aad=aad2)
 
         # Encrypt message
         k_2 = derive_key(ecdh_shared_secret, 16, context_info=cose_kdf_context("AES-CCM-64-64-128", 16, other=aad2))
@@ -185,27 +240,66 @@ class Server:
 
         # Perform proof-of-possession
         try:
-            pop_key = self.peer_identities[pop_key_id]
+            pop_key = self._peer_identity(pop_key_id)
             payload = Signature1Message.verify(sig_u, pop_key, external_aad=aad3)
 
+            session.oscore_context.replay_window = ReplayWindow()
             self.security_contexts[session.peer_id] = session.oscore_context
             self.pop_key_by_rid[session.peer_id] = pop_key_id
         except (SignatureVerificationFailed, KeyError) as e:
             return MessageError()
 
+        if self.store is not None:
+            self.store.put_context(session.peer_id, pop_key_id, session.oscore_context)
+            self.store.remove_session(session.id)
+        elif self.context_store is not None:
+            self.context_store.save(session.peer_id, session.oscore_context, peer=pop_key_id)
+
         return MessageOk()
 
+    def _peer_identity(self, key_id: bytes) -> Verifier:
+        if key_id not in self.peer_identities and self.store is not None:
+            key = self.store.load_peer_identity(key_id)
+            if key is not None:
+                self.add_peer_identity(key_id, key)
+
+        return self.peer_identities[key_id]
+
+    def _load_context(self, rid: bytes):
+        if rid in self.security_contexts:
+            return
+
+        if self.store is not None:
+            loaded = self.store.load_context(rid)
+        elif self.context_store is not None:
+            loaded = self.context_store.load(rid)
+        else:
+            return
+
+        if loaded is not None:
+            (self.security_contexts[rid], self.pop_key_by_rid[rid]) = loaded
+
     def oscore_context_for_recipient(self, rid: bytes):
+        self._load_context(rid)
         return self.security_contexts[rid]
 
     def pop_key_id_for_recipient(self, rid: bytes):
+        self._load_context(rid)
         return self.pop_key_by_rid[rid]
 
 
 class Client:
-    def __init__(self, sk: SigningKey, server_id: VerifyingKey, kid: bytes):
+    def __init__(self, sk: SigningKey, server_id: VerifyingKey, kid: bytes, aead_algorithms: list = None):
+        """
+        :param aead_algorithms: AEAD algorithms offered for the OSCORE context in order of preference,
+                                None to use the default without negotiating
+        """
+        check_aead_algorithms(aead_algorithms)
+
         self.sk = sk
-        self.vk = sk.get_verifying_key()
+        self.aead_algorithms = aead_algorithms
+        self.signer: Signer = as_signer(sk)
+        self.vk: Verifier = self.signer.verifier()
         self.server_id = server_id
         self.kid = kid
         self.session = EdhocSession()
@@ -215,7 +309,7 @@ class Client:
         raise NotImplementedError()
 
     def initiate_edhoc(self):
-        session_id = os.urandom(2)
+        session_id = os.urandom(SESSION_ID_LENGTH)
         nonce = os.urandom(8)
 
         session_key = ec.generate_private_key(ec.SECP256R1, backend)
@@ -225,14 +319,20 @@ class Client:
         self.session.private_key = session_key
         self.session.public_key = public_session_key
 
-        msg1 = Message1(session_id, nonce, public_session_key)
+        msg1 = Message1(session_id, nonce, public_session_key, aead_algorithms=self.aead_algorithms)
         self.session.message1 = msg1
 
         return msg1
 
     def continue_edhoc(self, message2):
         self.session.message2 = message2
-        (tag, sess_id, p_sess_id, p_nonce, p_eph_key, enc_2) = loads(message2)
+        (tag, sess_id, p_sess_id, p_nonce, p_eph_key, *optional, enc_2) = loads(message2)
+        aead = optional[0] if optional else None
+
+        if aead is not None:
+            if aead not in (self.aead_algorithms or []) and aead != DEFAULT_AEAD:
+                raise ValueError("Server chose an AEAD algorithm that was not offered")
+            self.session.aead = aead
 
         # Compute EDHOC shared secret
         p_eph_key = ecdh_cose_to_key(p_eph_key)
@@ -241,7 +341,7 @@ class Client:
         self.session.peer_id = p_sess_id
 
         # Derive encryption key
-        msg2 = Message2(sess_id, p_sess_id, p_nonce, p_eph_key, bytes_object=message2)
+        msg2 = Message2(sess_id, p_sess_id, p_nonce, p_eph_key, bytes_object=message2, aead=aead)
         aad2 = msg2.aad_2(message_digest, self.session.message1)
 
         k_2 = derive_key(ecdh_shared_secret,
@@ -263,7 +363,7 @@ class Client:
         msg3 = Message3(peer_session_id=p_sess_id)
         aad3 = msg3.aad_3(message_digest, self.session.message1, self.session.message2)
 
-        msg3.sign(self.sk, kid=self.kid, aad=aad3)
+        msg3.sign(self.signer, kid=self.kid, aad=aad3)
 
         k_3 = derive_key(ecdh_shared_secret,
                          length=16,
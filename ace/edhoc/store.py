@@ -0,0 +1,278 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from ace.edhoc.context import OscoreContext, ReplayWindow
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS oscore_contexts (
+    key             BLOB PRIMARY KEY,
+    sid             BLOB NOT NULL,
+    rid             BLOB NOT NULL,
+    secret          BLOB NOT NULL,
+    salt            BLOB NOT NULL,
+    alg             INTEGER NOT NULL,
+    sequence_number INTEGER NOT NULL,
+    replay_highest  INTEGER,
+    replay_bitmap   INTEGER,
+    clean           INTEGER NOT NULL,
+    peer            BLOB
+);
+"""
+
+# UPDATE ... RETURNING needs SQLite 3.35, older versions read and update in one transaction
+RETURNING_SUPPORTED = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+class ContextStore:
+    """
+    Persists OSCORE security contexts in a local SQLite database, so that a restarted process resumes
+    them instead of repeating EDHOC.
+
+    Sequence numbers are checkpointed in blocks (RFC 8613, Appendix B.1.1): a context reserves the
+    next checkpoint_interval numbers in the database before it uses the first of them, so only one
+    write is needed per block and a restarted context continues after the last reserved block. The
+    replay window is checkpointed the same way. After a crash, numbers up to one block beyond the
+    last checkpoint are treated as received (Appendix B.1.2), close() stores the exact state instead.
+
+    Contexts of a shared store are used by several processes at once. Their replay windows live in
+    the database and every accepted message is marked there, see SharedReplayWindow.
+    """
+
+    def __init__(self, path: str, checkpoint_interval: int = 64, shared: bool = False, timeout: float = 5.0):
+        """
+        :param path: Path of the database file
+        :param checkpoint_interval: Number of sequence numbers reserved per write
+        :param shared: Whether other processes use the contexts at the same time, see ace.rs.SharedState.
+                       Replay windows are then shared through the database
+        :param timeout: Seconds to wait for a lock held by another process
+        """
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.shared = shared
+        self.timeout = timeout
+
+        self._local = threading.local()
+        # key => context handed out by this store
+        self._attached = {}
+
+        connection = self._connect()
+        connection.executescript(_SCHEMA)
+        connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not be inherited by forked processes
+        (pid, connection) = getattr(self._local, 'connection', (None, None))
+        if pid != os.getpid():
+            connection = self._connect()
+            self._local.connection = (os.getpid(), connection)
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Write transaction holding the database lock from its first statement, so that values read
+        in it are not changed by other processes before they are written back
+        """
+        connection = self._connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    def save(self, key: bytes, context: OscoreContext, peer: bytes = None):
+        """
+        Persist a new context and checkpoint it from now on
+        :param peer: Stored along with the context, e.g. the PoP key id of the peer
+        """
+        window = context.replay_window
+
+        with self._connection as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO oscore_contexts (key, sid, rid, secret, salt, alg, sequence_number, '
+                'replay_highest, replay_bitmap, clean, peer) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)',
+                (key, context.sender_id, context.recipient_id, context.master_secret, context.master_salt,
+                 context.alg, context.sequence_number,
+                 None if window is None else window.highest, None if window is None else window.bitmap, peer)
+            )
+
+        if window is not None and self.shared:
+            context.replay_window = SharedReplayWindow(self, key, window.size, window.highest, window.bitmap)
+
+        self._attach(key, context)
+
+    def load(self, key: bytes):
+        """
+        :return: (OscoreContext, peer) stored under key, None if unknown
+        """
+        with self._connection as connection:
+            row = connection.execute(
+                'SELECT sid, rid, secret, salt, alg, sequence_number, replay_highest, replay_bitmap, clean, peer '
+                'FROM oscore_contexts WHERE key = ?', (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            connection.execute('UPDATE oscore_contexts SET clean = 0 WHERE key = ?', (key,))
+
+        (sid, rid, secret, salt, alg, sequence_number, replay_highest, replay_bitmap, clean, peer) = row
+
+        context = OscoreContext(secret, salt, sid, rid, alg)
+
+        # Either the exact state or the end of the last reserved block, both were never used
+        context.sequence_number = sequence_number
+
+        if replay_highest is not None and self.shared:
+            context.replay_window = SharedReplayWindow(self, key, highest=replay_highest, bitmap=replay_bitmap)
+
+        elif replay_highest is not None:
+            window = ReplayWindow(highest=replay_highest, bitmap=replay_bitmap)
+
+            if not clean:
+                # Messages after the last checkpoint may have been received before a crash
+                window.highest += self.checkpoint_interval
+                window.bitmap = (1 << window.size) - 1
+
+            context.replay_window = window
+
+        self._attach(key, context)
+
+        return context, peer
+
+    def remove(self, key: bytes):
+        self._attached.pop(key, None)
+
+        with self._connection as connection:
+            connection.execute('DELETE FROM oscore_contexts WHERE key = ?', (key,))
+
+    def keys(self) -> list:
+        return [row[0] for row in self._connection.execute('SELECT key FROM oscore_contexts')]
+
+    def _attach(self, key: bytes, context: OscoreContext):
+        context.checkpointed = context.sequence_number
+
+        if isinstance(context.replay_window, SharedReplayWindow):
+            # Always up to date in the database
+            context.replay_checkpointed = float('inf')
+        else:
+            context.replay_checkpointed = -1 if context.replay_window is None else context.replay_window.highest
+        context.on_checkpoint = lambda context: self._checkpoint(key, context)
+
+        self._attached[key] = context
+
+    def _checkpoint(self, key: bytes, context: OscoreContext):
+        interval = self.checkpoint_interval
+        window = context.replay_window
+
+        with self._transaction() as connection:
+            if context.sequence_number >= context.checkpointed:
+                end = self._reserve(connection, key, context.sequence_number)
+
+                context.checkpointed = end
+                context.sequence_number = end - interval
+
+            if window is not None and window.highest >= context.replay_checkpointed:
+                connection.execute(
+                    'UPDATE oscore_contexts SET replay_highest = ?, replay_bitmap = ?, clean = 0 WHERE key = ?',
+                    (window.highest, window.bitmap, key)
+                )
+                context.replay_checkpointed = window.highest + interval
+
+    def _reserve(self, connection: sqlite3.Connection, key: bytes, sequence_number: int) -> int:
+        """
+        Reserve the next block of sequence numbers, other processes may have reserved blocks of a
+        shared context in the meantime
+        :return: The end of the reserved block
+        """
+        if RETURNING_SUPPORTED:
+            row = connection.execute(
+                'UPDATE oscore_contexts SET sequence_number = MAX(sequence_number, ?) + ?, clean = 0 '
+                'WHERE key = ? RETURNING sequence_number',
+                (sequence_number, self.checkpoint_interval, key)
+            ).fetchone()
+        else:
+            row = connection.execute('SELECT sequence_number FROM oscore_contexts WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                row = (max(row[0], sequence_number) + self.checkpoint_interval,)
+                connection.execute('UPDATE oscore_contexts SET sequence_number = ?, clean = 0 WHERE key = ?',
+                                   (row[0], key))
+
+        if row is None:
+            raise KeyError(key)
+
+        return row[0]
+
+    def _mark_received(self, key: bytes, sequence_number: int, size: int):
+        """
+        Atomically check sequence_number against the shared replay window of key and mark it
+        :return: (accepted, highest, bitmap) with the window after the update
+        """
+        with self._transaction() as connection:
+            row = connection.execute('SELECT replay_highest, replay_bitmap FROM oscore_contexts WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+
+            window = ReplayWindow(size, -1 if row[0] is None else row[0], row[1] or 0)
+            accepted = window.update(sequence_number)
+
+            if accepted:
+                connection.execute('UPDATE oscore_contexts SET replay_highest = ?, replay_bitmap = ? WHERE key = ?',
+                                   (window.highest, window.bitmap, key))
+
+        return accepted, window.highest, window.bitmap
+
+    def close(self):
+        """
+        Store the exact state of the contexts of this process, returning unused sequence numbers
+        """
+        with self._connection as connection:
+            for (key, context) in self._attached.items():
+                window = context.replay_window
+
+                # Only if no other process reserved numbers after this one
+                connection.execute(
+                    'UPDATE oscore_contexts SET sequence_number = ?, clean = 1 WHERE key = ? AND sequence_number = ?',
+                    (context.sequence_number, key, context.checkpointed)
+                )
+
+                # Shared windows are up to date already
+                if window is not None and not isinstance(window, SharedReplayWindow):
+                    connection.execute('UPDATE oscore_contexts SET replay_highest = ?, replay_bitmap = ? WHERE key = ?',
+                                       (window.highest, window.bitmap, key))
+
+        self._attached.clear()
+
+        (pid, connection) = getattr(self._local, 'connection', (None, None))
+        if pid == os.getpid():
+            connection.close()
+        self._local.connection = (None, None)
+
+
+class SharedReplayWindow(ReplayWindow):
+    """
+    Replay window of a context used by several processes, kept in a shared ContextStore. check()
+    rejects early what this process already saw, update() checks and marks a number in the
+    database in one transaction, so a message accepted by one process is a replay for all others.
+    """
+
+    def __init__(self, store: ContextStore, key: bytes, size: int = 32, highest: int = -1, bitmap: int = 0):
+        super().__init__(size, highest, bitmap)
+        self.store = store
+        self.key = key
+
+    def update(self, sequence_number: int) -> bool:
+        (accepted, self.highest, self.bitmap) = self.store._mark_received(self.key, sequence_number, self.size)
+        return accepted
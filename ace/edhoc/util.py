@@ -1,4 +1,4 @@
-from cbor2 import dumps, loads
+from cbor2 import dumps
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import ec as curves
@@ -6,10 +6,20 @@ from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePublicNumb
 
 from ecdsa import curves as ecdsa_curves, VerifyingKey, ellipticcurve
 
+from ace.cache import LRUCache
+from ace.cbor.cbor import decode_head, skip_item, UNSIGNED_INT, NEGATIVE_INT, BYTE_STRING, TEXT_STRING, MAP
 from ace.cose.constants import Key as CoseKey
+from ace.cose.signing import Verifier, Ed25519Verifier, as_verifier, verifier_from_numbers, coordinate_sizes
 
 backend = default_backend()
 
+# (kind, encoded COSE_Key) => (decoded and validated key, kid), devices present the same key many
+# times. Shared by all COSE_Key decoding, see cose_to_key()
+key_cache = LRUCache(maxsize=1024)
+
+_VERIFIER = 'verifier'
+_ECDH = 'ecdh'
+
 _ecdh_curves = {
     CoseKey.Curve.P_256: curves.SECP256R1,
     CoseKey.Curve.P_384: curves.SECP384R1,
@@ -58,13 +68,88 @@ def ecdh_key_to_cose(key, kid: bytes = None, encode=True):
         return cbor
 
 
+def decode_cose_key(encoded) -> dict:
+    """
+    Decode a COSE_Key in a single pass over the encoded map. Only integer, byte string and text
+    string values are kept, parameters of other types (e.g. key_ops) are skipped.
+    :raises ValueError: If encoded is not a COSE_Key map
+    """
+    view = memoryview(encoded)
+
+    try:
+        (major_type, length, offset) = decode_head(view)
+        if major_type != MAP:
+            raise ValueError("COSE_Key is not a map")
+
+        decoded = {}
+        for _ in range(length):
+            (label, offset) = _decode_scalar(view, offset)
+            if label is None:
+                raise ValueError("Unsupported COSE_Key label")
+
+            (value, end) = _decode_scalar(view, offset)
+            if value is None:
+                end = skip_item(view, offset)
+            else:
+                decoded[label] = value
+            offset = end
+    except IndexError:
+        raise ValueError("Truncated COSE_Key")
+
+    return decoded
+
+
+def _decode_scalar(view: memoryview, offset: int):
+    """
+    :return: (value, offset after the item), value is None for items other than ints and strings
+    """
+    (major_type, argument, offset) = decode_head(view, offset)
+
+    if major_type == UNSIGNED_INT:
+        return argument, offset
+    if major_type == NEGATIVE_INT:
+        return -1 - argument, offset
+    if major_type in (BYTE_STRING, TEXT_STRING):
+        end = offset + argument
+        if end > len(view):
+            raise ValueError("Truncated COSE_Key")
+        value = view[offset:end].tobytes()
+        return (value if major_type == BYTE_STRING else value.decode('utf-8')), end
+
+    return None, offset
+
+
+def cose_to_key(encoded: bytes, ecdh: bool = False) -> tuple:
+    """
+    Decode a COSE_Key, returning the same validated key for repeated encodings
+    :param ecdh: Decode an ECDH public key instead of a Verifier
+    :return: (key, kid), kid is None if the COSE_Key has none
+    """
+    encoded = bytes(encoded)
+    kind = _ECDH if ecdh else _VERIFIER
+
+    entry = key_cache.get((kind, encoded))
+    if entry is None:
+        decoded = decode_cose_key(encoded)
+        key = ecdh_key_from_decoded(decoded) if ecdh else verifier_from_decoded(decoded)
+
+        entry = (key, decoded.get(CoseKey.KID))
+        key_cache.set((kind, encoded), entry)
+
+    return entry
+
+
 def ecdh_cose_to_key(ckey: bytes):
-    decoded = loads(ckey)
+    return cose_to_key(ckey, ecdh=True)[0]
+
 
-    kty = decoded[CoseKey.KTY]
+def ecdh_key_from_decoded(decoded: dict):
+    """
+    :param decoded: COSE_Key as returned by decode_cose_key()
+    """
     curve = _ecdh_curves[decoded[CoseKey.CRV]]
-    x = int(decoded[CoseKey.X].hex(), 16)
-    y = int(decoded[CoseKey.Y].hex(), 16)
+    x = int.from_bytes(decoded[CoseKey.X], 'big')
+    y = int.from_bytes(decoded[CoseKey.Y], 'big')
 
     numbers = EllipticCurvePublicNumbers(x, y, curve())
 
@@ -73,18 +158,41 @@ def ecdh_cose_to_key(ckey: bytes):
     return key
 
 
-def ecdsa_key_to_cose(key: VerifyingKey, kid: bytes = None, encode=True):
-    curve = _ecdsa_names[key.curve.name]
-    x = key.pubkey.point.x()
-    y = key.pubkey.point.y()
+def ecdsa_key_to_cose(key, kid: bytes = None, encode=True):
+    """
+    Encode a public signature key, an EC2 COSE_Key for the NIST curves or an OKP COSE_Key for Ed25519
+    """
+    if isinstance(key, VerifyingKey):
+        curve = _ecdsa_names[key.curve.name]
+        x = key.pubkey.point.x()
+        y = key.pubkey.point.y()
+    else:
+        verifier = as_verifier(key)
+
+        if isinstance(verifier, Ed25519Verifier):
+            cbor = {
+                CoseKey.KTY: CoseKey.Type.OKP,
+                CoseKey.CRV: CoseKey.Curve.Ed25519,
+                CoseKey.X: verifier.public_bytes()
+            }
+
+            return _with_kid(cbor, kid, encode)
+
+        (curve, x, y) = verifier.public_numbers()
+
+    size = coordinate_sizes[curve]
 
     cbor = {
         CoseKey.KTY: CoseKey.Type.EC2,
         CoseKey.CRV: curve,
-        CoseKey.X: bytes.fromhex(format(x, 'x').zfill(64)),
-        CoseKey.Y: bytes.fromhex(format(y, 'x').zfill(64))
+        CoseKey.X: x.to_bytes(size, 'big'),
+        CoseKey.Y: y.to_bytes(size, 'big')
     }
 
+    return _with_kid(cbor, kid, encode)
+
+
+def _with_kid(cbor: dict, kid: bytes, encode: bool):
     if kid is not None:
         cbor.update({CoseKey.KID: kid})
 
@@ -95,12 +203,11 @@ def ecdsa_key_to_cose(key: VerifyingKey, kid: bytes = None, encode=True):
 
 
 def ecdsa_cose_to_key(encoded: bytes) -> VerifyingKey:
-    decoded = loads(encoded)
+    decoded = decode_cose_key(encoded)
 
-    kty = decoded[CoseKey.KTY]
     curve = _ecdsa_curves[decoded[CoseKey.CRV]]
-    x = int(decoded[CoseKey.X].hex(), 16)
-    y = int(decoded[CoseKey.Y].hex(), 16)
+    x = int.from_bytes(decoded[CoseKey.X], 'big')
+    y = int.from_bytes(decoded[CoseKey.Y], 'big')
 
     p = ellipticcurve.Point(curve.curve, x, y)
     key = VerifyingKey.from_public_point(p, curve)
@@ -108,6 +215,29 @@ def ecdsa_cose_to_key(encoded: bytes) -> VerifyingKey:
     return key
 
 
+def cose_to_verifier(encoded: bytes) -> Verifier:
+    """
+    Decode a COSE_Key into a Verifier of the default signature backend
+    """
+    return cose_to_key(encoded)[0]
+
+
+def verifier_from_decoded(decoded: dict) -> Verifier:
+    """
+    :param decoded: COSE_Key as returned by decode_cose_key()
+    """
+    if decoded[CoseKey.KTY] == CoseKey.Type.OKP:
+        if decoded[CoseKey.CRV] != CoseKey.Curve.Ed25519:
+            raise ValueError("Unsupported OKP curve")
+        return Ed25519Verifier.from_public_bytes(decoded[CoseKey.X])
+
+    curve = decoded[CoseKey.CRV]
+    x = int.from_bytes(decoded[CoseKey.X], 'big')
+    y = int.from_bytes(decoded[CoseKey.Y], 'big')
+
+    return verifier_from_numbers(curve, x, y)
+
+
 def vk_from_point(x: bytes, y: bytes):
     curve = ecdsa_curves.NIST256p
     x = int(x.hex(), 16)
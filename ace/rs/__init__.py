@@ -1,5 +1,7 @@
 from ace.rs.resource_server import (AudienceMismatchError,
                                         IntrospectionFailedError,
                                         IntrospectNotActiveError,
-                                        NotAuthorizedException, ResourceServer)
+                                        NotAuthorizedException, ResourceServer,
+                                        ProtectedRequest)
 from ace.rs.token_cache import TokenCache
+from ace.rs.shared_state import SharedState
@@ -1,10 +1,19 @@
+import asyncio
+import time
+from collections import namedtuple
+from typing import List
+
 import aiocoap
-from aiocoap import resource
+from aiocoap import resource, error
 from cbor2 import dumps, loads
 from ecdsa import SigningKey, VerifyingKey
 
 import ace.cose.cwt as cwt
-from ace.rs import NotAuthorizedException, ResourceServer
+from ace.rs import (NotAuthorizedException, ResourceServer, AudienceMismatchError, IntrospectionFailedError,
+                    IntrospectNotActiveError)
+from ace.rs.resource_server import is_token_batch, is_token_reference
+from ace.edhoc import ContextStore
+from ace.rs.shared_state import SharedState
 from ace.cbor.constants import Keys as CK
 from ace.cose import CoseKey
 from ace.cose.constants import Key as Cose
@@ -19,31 +28,109 @@ class AuthzInfoResource(resource.Resource):
         self.resource_server = resource_server
 
     async def render_post(self, request):
-        access_token = request.payload
+        return await self.resource_server.authz_info(request)
 
-        # introspect_payload = self.introspect(access_token)
 
-        # Verify if valid CWT from AS
-        try:
-            decoded = cwt.decode(access_token, key=self.resource_server.as_public_key)
+class ProtectedResource(resource.Resource):
+    """
+    Resource protected with OSCORE. Requests are decrypted and authorized for scope before they are
+    passed as ProtectedRequest to render_protected_<method>(request, message) of subclasses
+    """
 
-        except SignatureVerificationFailed as err:
+    def __init__(self, scope: str, resource_server):
+        super().__init__()
+        self.scope = scope
+        self.resource_server = resource_server
+
+    async def render(self, request):
+        handler = getattr(self, f"render_protected_{str(request.code).lower()}", None)
+        if handler is None:
+            raise error.UnallowedMethod()
+
+        try:
+            message = self.protected_request(request)
+        except NotAuthorizedException:
             return aiocoap.Message(code=aiocoap.UNAUTHORIZED)
+        except ValueError:
+            return aiocoap.Message(code=aiocoap.BAD_REQUEST)
 
-        # Check if audience claim in token matches audience identifier of this resource server
-        if decoded[CK.AUD] != self.resource_server.audience:
-            return aiocoap.Message(code=aiocoap.FORBIDDEN)
+        response = await handler(request, message)
 
-        # Extract PoP Key
-        pop_key = CoseKey.from_cose(decoded[CK.CNF][Cose.COSE_KEY])
+        if response.code is None:
+            response.code = aiocoap.CONTENT if request.code == aiocoap.GET else aiocoap.CHANGED
 
-        # Store token and store by PoP key id
-        self.resource_server.token_cache.add_token(token=decoded, pop_key_id=pop_key.key_id)
+        return response
 
-        # Inform EDHOC Server about new key
-        self.resource_server.edhoc_server.add_peer_identity(pop_key.key_id, pop_key.key)
-        
-        return aiocoap.Message(code=aiocoap.CREATED)
+    def protected_request(self, request):
+        """
+        :return: The decrypted and authorized request as ProtectedRequest
+        """
+        return self.resource_server.protected_request(request.payload, self.scope)
+
+
+class ObservableProtectedResource(ProtectedResource, resource.ObservableResource):
+    """
+    Protected resource that can be observed with GET. The request registering an observer is decrypted
+    and authorized once, every notification is rendered by render_protected_get() with the same
+    ProtectedRequest and so encrypted with the next sequence number of the observer's own context.
+    Observers are removed with 4.01 Unauthorized when their token expires.
+    """
+
+    def __init__(self, scope: str, resource_server):
+        super().__init__(scope, resource_server)
+        # id(request) => Observer
+        self.observers = {}
+
+    async def add_observation(self, request, serverobservation):
+        if request.code != aiocoap.GET:
+            return
+
+        try:
+            message = self.resource_server.protected_request(request.payload, self.scope)
+        except (NotAuthorizedException, ValueError):
+            # Not accepted, render() responds with the error
+            return
+
+        key = id(request)
+
+        timer = None
+        if message.token.expires is not None:
+            timer = asyncio.get_running_loop().call_later(max(0.0, message.token.expires - time.time()),
+                                                          self._expire, key)
+
+        self.observers[key] = Observer(request, message, serverobservation, timer)
+
+        serverobservation.accept(lambda: self._cancel(key))
+        self.update_observation_count(len(self.observers))
+
+    def protected_request(self, request):
+        observer = self.observers.get(id(request))
+        if observer is None:
+            return super().protected_request(request)
+
+        if observer.message.token.expires is not None and observer.message.token.expires <= time.time():
+            raise NotAuthorizedException()
+
+        return observer.message
+
+    def updated_state(self, response=None):
+        """
+        Notify all observers, responses are always rendered per observer
+        """
+        for observer in list(self.observers.values()):
+            observer.observation.trigger()
+
+    def _expire(self, key):
+        observer = self.observers.get(key)
+        if observer is not None:
+            observer.observation.trigger(aiocoap.Message(code=aiocoap.UNAUTHORIZED))
+
+    def _cancel(self, key):
+        observer = self.observers.pop(key, None)
+        if observer is not None and observer.timer is not None:
+            observer.timer.cancel()
+
+        self.update_observation_count(len(self.observers))
 
 
 class EdhocResource(resource.Resource):
@@ -66,9 +153,15 @@ class CoAPResourceServer(ResourceServer):
                  as_public_key: VerifyingKey,
                  site,
                  client_id=None,
-                 client_secret=None):
-
-        super().__init__(audience, identity, as_url, as_public_key, client_id, client_secret)
+                 client_secret=None,
+                 scopes: List[str] = None,
+                 as_mac_key: bytes = None,
+                 aead_algorithms: List[int] = None,
+                 shared_state: SharedState = None,
+                 context_store: ContextStore = None):
+
+        super().__init__(audience, identity, as_url, as_public_key, client_id, client_secret, scopes, as_mac_key,
+                         aead_algorithms, shared_state, context_store)
         self.site = site
         self.site.add_resource(('authz-info',), AuthzInfoResource(self))
         self.site.add_resource(('.well-known', 'edhoc'), EdhocResource(self))
@@ -80,23 +173,38 @@ class CoAPResourceServer(ResourceServer):
 
     async def authz_info(self, request):
         access_token = request.payload
+
+        if is_token_batch(access_token):
+            try:
+                results = await self.register_token_batch(access_token)
+            except ValueError:
+                return aiocoap.Message(code=aiocoap.BAD_REQUEST)
+
+            return aiocoap.Message(code=aiocoap.CREATED, payload=dumps(results))
+
+        if is_token_reference(access_token):
+            try:
+                await self.register_reference(access_token)
+
+            except (IntrospectionFailedError, IntrospectNotActiveError, ValueError):
+                return aiocoap.Message(code=aiocoap.UNAUTHORIZED)
+
+            except AudienceMismatchError:
+                return aiocoap.Message(code=aiocoap.FORBIDDEN)
+
+            return aiocoap.Message(code=aiocoap.CREATED)
+
         # Verify if valid CWT from AS
         try:
-            decoded = cwt.decode(access_token, key=self.as_public_key)
-        except SignatureVerificationFailed as err:
-            return aiocoap.Message(code=aiocoap.UNAUTHORIZED)
+            self.register_token(access_token)
 
-        # Check if audience claim in token matches audience identifier of this resource server
-        if decoded[CK.AUD] != self.audience:
-            return web.Response(status=403, body=dumps({'error': 'Audience mismatch'}))
+        except (SignatureVerificationFailed, ValueError):
+            return aiocoap.Message(code=aiocoap.UNAUTHORIZED)
 
-        # Extract PoP Key
-        pop_key = CoseKey.from_cose(decoded[CK.CNF][Cose.COSE_KEY])
+        except AudienceMismatchError:
+            return aiocoap.Message(code=aiocoap.FORBIDDEN)
 
-        # Store token and store by PoP key id
-        self.token_cache.add_token(token=decoded, pop_key_id=pop_key.key_id)
+        return aiocoap.Message(code=aiocoap.CREATED)
 
-        # Inform EDHOC Server about new key
-        self.edhoc_server.add_peer_identity(pop_key.key_id, pop_key.key)
 
-        return aiocoap.Message(code=aiocoap.CREATED)
+Observer = namedtuple('Observer', 'request message observation timer')
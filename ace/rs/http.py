@@ -1,3 +1,5 @@
+from typing import List
+
 from cbor2 import dumps, loads
 from ecdsa import VerifyingKey, SigningKey
 
@@ -10,7 +12,11 @@ from ace.cose import CoseKey
 from ace.cbor.constants import Keys as CK
 from ace.cose.constants import Key as Cose, Header
 from ace.cose.cose import SignatureVerificationFailed
-from ace.rs import ResourceServer, NotAuthorizedException
+from ace.rs import (ResourceServer, NotAuthorizedException, AudienceMismatchError, IntrospectionFailedError,
+                    IntrospectNotActiveError)
+from ace.rs.resource_server import is_token_batch, is_token_reference
+from ace.edhoc import ContextStore
+from ace.rs.shared_state import SharedState
 
 
 class HTTPResourceServer(ResourceServer):
@@ -21,25 +27,42 @@ class HTTPResourceServer(ResourceServer):
                  as_public_key: VerifyingKey,
                  router: AbstractRouter,
                  client_id=None,
-                 client_secret=None):
-
-        super().__init__(audience, identity, as_url, as_public_key, client_id, client_secret)
+                 client_secret=None,
+                 scopes: List[str] = None,
+                 as_mac_key: bytes = None,
+                 aead_algorithms: List[int] = None,
+                 shared_state: SharedState = None,
+                 context_store: ContextStore = None):
+
+        super().__init__(audience, identity, as_url, as_public_key, client_id, client_secret, scopes, as_mac_key,
+                         aead_algorithms, shared_state, context_store)
         router.add_post('/authz-info', self.authz_info)
         router.add_post('/.well-known/edhoc', self.edhoc)
 
     def wrap(self, scope, handler):
+        """
+        Protect a route with OSCORE, handler is called with the request and its ProtectedRequest
+        :param scope: The scope the sender's token must grant
+        """
         async def wrapped_handler(request):
             payload = await request.content.read()
-            prot, unprot, cipher = loads(payload).value
             try:
-                oscore_context = self.oscore_context(unprot, scope)
+                message = self.protected_request(payload, scope)
             except NotAuthorizedException:
                 return web.Response(status=401, body=dumps({'error': 'not authorized'}))
+            except ValueError:
+                return web.Response(status=400, body=dumps({'error': 'invalid_request'}))
 
-            return await handler(request, payload, None, oscore_context)
+            return await handler(request, message)
 
         return wrapped_handler
 
+    def protect(self, scope):
+        """
+        Decorator form of wrap()
+        """
+        return lambda handler: self.wrap(scope, handler)
+
     async def edhoc(self, request):
         message = await request.content.read()
 
@@ -51,26 +74,37 @@ class HTTPResourceServer(ResourceServer):
         # Extract access token
         access_token = await request.content.read()
 
-        # introspect_payload = self.introspect(access_token)
+        if is_token_batch(access_token):
+            try:
+                results = await self.register_token_batch(access_token)
+            except ValueError:
+                return web.Response(status=400, body=dumps({'error': 'invalid_request'}))
+
+            return web.Response(status=201, body=dumps(results))
+
+        if is_token_reference(access_token):
+            try:
+                await self.register_reference(access_token)
+
+            except (IntrospectionFailedError, IntrospectNotActiveError, ValueError):
+                return web.Response(status=401, body=dumps({'error': 'invalid_token'}))
+
+            except AudienceMismatchError:
+                return web.Response(status=403, body=dumps({'error': 'Audience mismatch'}))
+
+            return web.Response(status=201)
 
         # Verify if valid CWT from AS
         try:
-            decoded = cwt.decode(access_token, key=self.as_public_key)
+            self.register_token(access_token)
 
         except SignatureVerificationFailed as err:
             return web.Response(status=401, body=dumps({'error': str(err)}))
 
-        # Check if audience claim in token matches audience identifier of this resource server
-        if decoded[CK.AUD] != self.audience:
-            return web.Response(status=403, body=dumps({'error': 'Audience mismatch'}))
+        except ValueError:
+            return web.Response(status=401, body=dumps({'error': 'invalid_token'}))
 
-        # Extract PoP Key
-        pop_key = CoseKey.from_cose(decoded[CK.CNF][Cose.COSE_KEY])
-
-        # Store token and store by PoP key id
-        self.token_cache.add_token(token=decoded, pop_key_id=pop_key.key_id)
-
-        # Inform EDHOC Server about new key
-        self.edhoc_server.add_peer_identity(pop_key.key_id, pop_key.key)
+        except AudienceMismatchError:
+            return web.Response(status=403, body=dumps({'error': 'Audience mismatch'}))
 
         return web.Response(status=201)
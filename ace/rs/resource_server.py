@@ -1,13 +1,27 @@
-from cbor2 import dumps, loads
+import asyncio
+import hashlib
+import time
+
+from collections import namedtuple
+from typing import List
+
+from cryptography.exceptions import InvalidTag
+
+from cbor2 import dumps, loads, CBORDecodeError
 from ecdsa import VerifyingKey, SigningKey
 
 import ace.cose.cwt as cwt
 from ace.cbor.constants import Keys as CK
 from ace.cose.constants import Key as Cose, Header
 from ace.cose.cose import SignatureVerificationFailed
-from ace.cose import CoseKey
-from ace.edhoc import Server as EdhocServer
-from .token_cache import TokenCache
+from ace.cose import CoseKey, TrustStore, Encrypt0Message
+from ace.cose.signing import as_verifier
+from ace.edhoc import Server as EdhocServer, ContextStore
+from ace.cache import ExpiringDict
+from ace.cbor.cbor import decode_head, ARRAY, BYTE_STRING, TAG
+from ace.scope import ScopeMap
+from .token_cache import TokenCache, TokenRecord
+from .shared_state import SharedState
 
 
 class AudienceMismatchError(Exception):
@@ -26,39 +40,317 @@ class NotAuthorizedException(Exception):
     pass
 
 
+def is_token_batch(payload: bytes) -> bool:
+    """
+    :return: True if payload is a CBOR array of tokens rather than a single token. Tokens are tagged
+             COSE structures, an untagged COSE_Sign1 starts with a byte string holding a map instead
+    """
+    try:
+        (major_type, length, offset) = decode_head(payload)
+        if major_type != ARRAY:
+            return False
+        if length == 0:
+            return True
+
+        (major_type, size, offset) = decode_head(payload, offset)
+        return major_type == BYTE_STRING and size > 0 and payload[offset] >> 5 == TAG
+    except (IndexError, ValueError):
+        return False
+
+
+def is_token_reference(payload: bytes) -> bool:
+    """
+    :return: True if payload is a reference token, i.e. a single CBOR byte string rather than a tagged
+             COSE structure or an array of tokens
+    """
+    try:
+        (major_type, length, offset) = decode_head(payload)
+    except (IndexError, ValueError):
+        return False
+
+    return major_type == BYTE_STRING and offset + length == len(payload)
+
+
+def token_error(error: Exception) -> str:
+    """
+    :return: The error reported to the client for a token that was not accepted
+    """
+    if isinstance(error, AudienceMismatchError):
+        return 'Audience mismatch'
+
+    return 'invalid_token'
+
+
 class ResourceServer(object):
 
+    # Key id of as_public_key, the AS default
+    AS_KEY_ID = b'ace.as-server.com'
+
+    # Maximum number of verified tokens remembered, see decode_token()
+    VERIFIED_TOKENS_CAPACITY = 4096
+
+    # Maximum number of accepted tokens, the least recently used token is dropped when full
+    TOKEN_CACHE_CAPACITY = 65536
+
+    # Maximum number of tokens accepted in one upload to authz-info, see register_tokens()
+    MAX_TOKEN_BATCH = 256
+
+    # Maximum number of introspection responses remembered and for how many seconds, see introspect()
+    INTROSPECTION_CAPACITY = 4096
+    INTROSPECTION_TTL = 300.0
+
+    # Maximum number of kept-alive connections to the AS
+    INTROSPECTION_CONNECTIONS = 8
+
     def __init__(self, audience: str,
                  identity: SigningKey,
                  as_url: str,
                  as_public_key: VerifyingKey,
                  client_id=None,
-                 client_secret=None):
+                 client_secret=None,
+                 scopes: List[str] = None,
+                 as_mac_key: bytes = None,
+                 aead_algorithms: List[int] = None,
+                 shared_state: SharedState = None,
+                 context_store: ContextStore = None):
+        """
+        :param scopes: Scopes of this resource server in the order registered with the AS. Required to
+                       accept compact tokens, their scope masks are only meaningful in this order
+        :param as_mac_key: Key shared with the AS if it MACs the tokens for this resource server
+        :param aead_algorithms: AEAD algorithms accepted for OSCORE in order of preference, see EdhocServer
+        :param shared_state: State shared with the other workers of a multi-process resource server, see
+                             run_workers()
+        :param context_store: Persists the OSCORE contexts of a single-process resource server, so they are
+                              resumed after a restart. Contexts of shared_state are persisted by it instead
+        """
+        if shared_state is not None and context_store is not None:
+            raise ValueError("Shared state persists the contexts of all workers itself")
 
         self.audience = audience
         self.identity = identity
         self.as_url = as_url
         self.as_public_key = as_public_key
+        self.as_verifier = as_verifier(as_public_key) if as_public_key is not None else None
+        self.as_mac_key = as_mac_key
+
+        # Public keys of the AS by kid, see trust_as_key()
+        self.trust_store = TrustStore()
+        if self.as_verifier is not None:
+            self.trust_store.add(self.AS_KEY_ID, self.as_verifier)
 
         self.client_secret = client_secret
         self.client_id = client_id
-        self.token_cache = TokenCache()
+        self.token_cache = TokenCache(capacity=self.TOKEN_CACHE_CAPACITY)
+        self.scope_map = ScopeMap(scopes or [])
+
+        # SHA-256 of verified tokens => claims, until the token expires or its AS key is no longer trusted
+        self.verified_tokens = ExpiringDict(capacity=self.VERIFIED_TOKENS_CAPACITY)
+
+        # Executor verifying batches of tokens, the event loop's default executor if None
+        self.executor = None
 
-        self.edhoc_server = EdhocServer(self.identity)
+        # Reference => introspection response, until the token expires or INTROSPECTION_TTL passed
+        self.introspected = ExpiringDict(capacity=self.INTROSPECTION_CAPACITY)
+        # Reference => introspection request in flight
+        self._introspecting = {}
+        self._introspection_session = None
+        self.introspections = 0
+
+        self.shared_state = shared_state
+        self.edhoc_server = EdhocServer(self.identity, aead_algorithms, store=shared_state, context_store=context_store)
 
     def oscore_context(self, unprotected_header, scope):
-        kid = unprotected_header[Header.KID]
+        (oscore_context, token) = self._authorize(unprotected_header[Header.KID], scope)
+
+        return oscore_context
+
+    def protected_request(self, payload: bytes, scope: str) -> 'ProtectedRequest':
+        """
+        Parse an OSCORE protected request once, check that its sender is authorized for scope and
+        decrypt it
+        :return: The decrypted request
+        :raises NotAuthorizedException: If the sender has no valid token granting scope
+        :raises ValueError: If the request is malformed or can not be decrypted
+        """
+        (protected, unprotected, ciphertext) = Encrypt0Message.parse(payload)
+
+        if Header.KID not in unprotected or Header.PARTIAL_IV not in unprotected:
+            raise ValueError("Missing OSCORE header")
+
+        (oscore_context, token) = self._authorize(unprotected[Header.KID], scope)
 
-        # Retrieve token for recipient
-        pop_key_id = self.edhoc_server.pop_key_id_for_recipient(rid=kid)
-        token = self.token_cache.get_token(pop_key_id=pop_key_id)
+        try:
+            plaintext = oscore_context.decrypt_parsed(protected, unprotected, ciphertext)
+        except InvalidTag:
+            raise ValueError("Decryption failed")
 
-        # Verify scope
-        authorized_scopes = token[CK.SCOPE].split(",")
-        if scope not in authorized_scopes:
+        return ProtectedRequest(plaintext, token, oscore_context)
+
+    def _authorize(self, kid: bytes, scope: str):
+        """
+        :return: (OSCORE context, TokenRecord) of the recipient kid
+        :raises NotAuthorizedException: If the token of kid does not grant scope
+        """
+        try:
+            # Retrieve token for recipient
+            pop_key_id = self.edhoc_server.pop_key_id_for_recipient(rid=kid)
+            token = self._cached_token(pop_key_id)
+        except KeyError:
+            # Unknown recipient, expired or evicted token
+            raise NotAuthorizedException()
+
+        # Verify scope, compact tokens carry the mask itself
+        if not token.allows(scope, self.scope_map):
             raise NotAuthorizedException()
 
-        return self.edhoc_server.oscore_context_for_recipient(kid)
+        return self.edhoc_server.oscore_context_for_recipient(kid), token
+
+    def _cached_token(self, pop_key_id: bytes) -> TokenRecord:
+        try:
+            return self.token_cache.get_token(pop_key_id=pop_key_id)
+        except KeyError:
+            # The token may have been uploaded to another worker
+            claims = self.shared_state.load_token(pop_key_id) if self.shared_state is not None else None
+            if claims is None:
+                raise
+
+        return self.token_cache.add_token(token=claims, pop_key_id=pop_key_id)
+
+    def decode_token(self, access_token: bytes) -> dict:
+        """
+        Verify a self-contained access token, either MACed with the shared key or signed by the AS.
+        Tokens uploaded again are recognized by their digest and not verified a second time.
+        :return: The claims of the token
+        :raises SignatureVerificationFailed: If the token can not be verified
+        """
+        digest = hashlib.sha256(access_token).digest()
+
+        claims = self.verified_tokens.get(digest)
+        if claims is None:
+            claims = self._verify_token(access_token)
+            self.verified_tokens.set(digest, claims, expires=self._verified_until(access_token, claims))
+
+        return claims
+
+    def _verified_until(self, access_token: bytes, claims: dict) -> float:
+        """
+        :return: Time until a verified token is remembered: its expiry, but no longer than the AS key
+                 that signed it is trusted
+        """
+        expires = claims.get(CK.EXP)
+
+        if not cwt.is_maced(access_token):
+            trusted_until = self.trust_store.expires(access_token)
+            if trusted_until is not None:
+                expires = trusted_until if expires is None else min(expires, trusted_until)
+
+        return expires
+
+    def _verify_token(self, access_token: bytes) -> dict:
+        return cwt.decode_any(access_token, self._token_key(access_token))
+
+    def _token_key(self, access_token: bytes):
+        """
+        :return: The key to verify access_token with, the shared key for MACed tokens
+        """
+        if cwt.is_maced(access_token):
+            if self.as_mac_key is None:
+                raise SignatureVerificationFailed("No key shared with the AS")
+            return self.as_mac_key
+
+        return self.trust_store
+
+    def trust_as_key(self, kid: bytes, key, expires: float = None):
+        """
+        Accept tokens signed by the AS under kid, e.g. a new key the AS is rotating to
+        :param expires: Time after which tokens signed with this key are rejected
+        """
+        self.trust_store.add(kid, key, expires)
+
+    def distrust_as_key(self, kid: bytes):
+        """
+        Reject tokens signed by the AS under kid from now on, including tokens verified before
+        """
+        self.trust_store.remove(kid)
+        self.verified_tokens.clear()
+
+    def register_token(self, access_token: bytes) -> dict:
+        """
+        Verify an access token posted to authz-info and accept its PoP key for EDHOC
+        :return: The claims of the token
+        :raises SignatureVerificationFailed: If the token can not be verified
+        :raises AudienceMismatchError: If the token is meant for another resource server
+        """
+        return self._accept_token(self.decode_token(access_token))
+
+    async def register_tokens(self, access_tokens: list) -> list:
+        """
+        Verify a batch of access tokens, e.g. pushed by a gateway after reconnecting, on the executor
+        and accept their PoP keys
+        :return: For each token in input order either its claims or the exception raised for it
+        """
+        digests = [hashlib.sha256(token).digest() for token in access_tokens]
+        results = [self.verified_tokens.get(digest) for digest in digests]
+
+        pending = [i for (i, claims) in enumerate(results) if claims is None]
+        verified = await cwt.decode_many_async([access_tokens[i] for i in pending],
+                                               self._token_key,
+                                               executor=self.executor)
+
+        for (i, claims) in zip(pending, verified):
+            results[i] = claims
+            if not isinstance(claims, Exception):
+                self.verified_tokens.set(digests[i], claims, expires=self._verified_until(access_tokens[i], claims))
+
+        for (i, claims) in enumerate(results):
+            if isinstance(claims, Exception):
+                continue
+            try:
+                self._accept_token(claims)
+            except (AudienceMismatchError, KeyError, ValueError) as e:
+                results[i] = e
+
+        return results
+
+    async def register_token_batch(self, payload: bytes) -> list:
+        """
+        Register the CBOR array of tokens posted to authz-info, see is_token_batch()
+        :return: For each token in input order None if it was accepted, else an error map
+        :raises ValueError: If the batch is malformed or larger than MAX_TOKEN_BATCH
+        """
+        try:
+            tokens = loads(payload)
+        except CBORDecodeError as e:
+            raise ValueError(str(e))
+
+        if not isinstance(tokens, list) or len(tokens) > self.MAX_TOKEN_BATCH or not all(isinstance(token, bytes) for token in tokens):
+            raise ValueError("Invalid token batch")
+
+        results = await self.register_tokens(tokens)
+
+        return [{'error': token_error(result)} if isinstance(result, Exception) else None for result in results]
+
+    def _accept_token(self, decoded: dict) -> dict:
+        # Check if audience claim in token matches audience identifier of this resource server
+        if decoded[CK.AUD] != self.audience:
+            raise AudienceMismatchError()
+
+        # A mask can only be interpreted with the scope order of the AS
+        if isinstance(decoded.get(CK.SCOPE), int) and not len(self.scope_map):
+            raise ValueError("Compact token without the scopes of the AS")
+
+        # Extract PoP Key
+        pop_key = CoseKey.from_cose(decoded[CK.CNF][Cose.COSE_KEY])
+
+        # Store token and store by PoP key id
+        self.token_cache.add_token(token=decoded, pop_key_id=pop_key.key_id)
+        if self.shared_state is not None:
+            self.shared_state.put_token(pop_key.key_id, decoded)
+
+        # Inform EDHOC Server about new key
+        self.edhoc_server.add_peer_identity(pop_key.key_id, pop_key.key)
+
+        return decoded
 
     async def edhoc(self, request):
         raise NotImplementedError
@@ -66,13 +358,37 @@ class ResourceServer(object):
     async def authz_info(self, request):
         raise NotImplementedError
 
-    async def introspect(self, token: str):
+    async def register_reference(self, payload: bytes) -> dict:
         """
-        POST token to AS for introspection using RS as a client of the AS
-        :param token: The token to be introspected (not self-contained)
+        Introspect a reference token posted to authz-info and accept its PoP key for EDHOC
+        :return: The introspection response
+        :raises IntrospectionFailedError: If the AS could not be asked
+        :raises IntrospectNotActiveError: If the token is not active
+        :raises AudienceMismatchError: If the token is meant for another resource server
         """
-        from aiohttp import request
+        return self._accept_token(await self.introspect(loads(payload)))
 
+    async def introspect(self, token: bytes) -> dict:
+        """
+        POST token to AS for introspection using RS as a client of the AS. Responses are cached until
+        the token expires, at most for INTROSPECTION_TTL seconds, and concurrent calls for the same
+        token share one request
+        :param token: The reference of the token to be introspected (not self-contained)
+        """
+        response = self.introspected.get(token)
+        if response is not None:
+            return response
+
+        pending = self._introspecting.get(token)
+        if pending is None:
+            pending = asyncio.ensure_future(self._introspect(token))
+            pending.add_done_callback(lambda _: self._introspecting.pop(token, None))
+            self._introspecting[token] = pending
+
+        # A cancelled caller must not cancel the request for the others
+        return await asyncio.shield(pending)
+
+    async def _introspect(self, token: bytes) -> dict:
         cose = {
             CK.TOKEN: token,
             CK.TOKEN_TYPE_HINT: 'pop',
@@ -80,10 +396,8 @@ class ResourceServer(object):
             CK.CLIENT_SECRET: self.client_secret
         }
 
-        async with request('POST', f'{self.as_url}/introspect', data=dumps(cose)) as resp:
-            if resp.status != 201:
-                raise IntrospectionFailedError()
-            response_payload = loads(await resp.read())
+        self.introspections += 1
+        response_payload = await self._post_to_as('/introspect', cose, expected_status=201)
         """ ACE p. 61
         Response-Payload:
         {
@@ -97,13 +411,86 @@ class ResourceServer(object):
         }
         """
 
-        if resp.status != 201:
-            raise IntrospectionFailedError()
-
-        if not response_payload[CK.ACTIVE]:
+        if not isinstance(response_payload, dict) or not response_payload.get(CK.ACTIVE):
             raise IntrospectNotActiveError()
 
-        if response_payload[CK.AUD] != self.audience:
+        if response_payload.get(CK.AUD) != self.audience:
             raise AudienceMismatchError()
 
+        self._cache_introspection(token, response_payload)
+
         return response_payload
+
+    async def introspect_batch(self, tokens: list) -> list:
+        """
+        Introspect many tokens with one request to the AS, e.g. to revalidate tokens after a restart.
+        Responses of active tokens for this resource server given by reference are cached like by
+        introspect()
+        :param tokens: References of tokens or maps holding their binary cti
+        :return: The introspection response for each token in input order
+        :raises IntrospectionFailedError: If the AS could not be asked
+        """
+        params = {
+            CK.TOKEN: tokens,
+            CK.CLIENT_ID: self.client_id,
+            CK.CLIENT_SECRET: self.client_secret
+        }
+
+        self.introspections += 1
+        responses = await self._post_to_as('/introspect/batch', params, expected_status=200)
+
+        if not isinstance(responses, list) or len(responses) != len(tokens):
+            raise IntrospectionFailedError()
+
+        for (token, response) in zip(tokens, responses):
+            if isinstance(token, bytes) and isinstance(response, dict) and response.get(CK.ACTIVE) \
+                    and response.get(CK.AUD) == self.audience:
+                self._cache_introspection(token, response)
+
+        return responses
+
+    def _cache_introspection(self, token: bytes, response: dict):
+        expires = time.time() + self.INTROSPECTION_TTL
+        if response.get(CK.EXP) is not None:
+            expires = min(expires, response[CK.EXP])
+
+        self.introspected.set(token, response, expires=expires)
+
+    async def _post_to_as(self, path: str, payload, expected_status: int):
+        """
+        :return: The decoded response of the AS
+        :raises IntrospectionFailedError: If the request failed
+        """
+        import aiohttp
+
+        try:
+            async with self._client_session().post(f'{self.as_url}{path}', data=dumps(payload)) as resp:
+                if resp.status != expected_status:
+                    raise IntrospectionFailedError()
+                return loads(await resp.read())
+        except (aiohttp.ClientError, CBORDecodeError):
+            raise IntrospectionFailedError()
+
+    def _client_session(self):
+        """
+        :return: The session holding the kept-alive connections to the AS, created on first use
+        """
+        import aiohttp
+
+        if self._introspection_session is None or self._introspection_session.closed:
+            connector = aiohttp.TCPConnector(limit=self.INTROSPECTION_CONNECTIONS)
+            self._introspection_session = aiohttp.ClientSession(connector=connector)
+
+        return self._introspection_session
+
+    async def close(self):
+        """
+        Close the connections to the AS
+        """
+        if self._introspection_session is not None:
+            await self._introspection_session.close()
+            self._introspection_session = None
+
+
+# Decrypted payload of a protected request, the token authorizing it and the context to respond with
+ProtectedRequest = namedtuple('ProtectedRequest', 'payload token oscore_context')
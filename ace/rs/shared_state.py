@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import threading
+import time
+
+from cbor2 import dumps, loads
+
+from ace.cbor.constants import Keys as CK
+from ace.cose import CoseKey
+from ace.cose.constants import Key as Cose
+from ace.edhoc.context import OscoreContext
+from ace.edhoc.protocol import EdhocSession
+from ace.edhoc.store import ContextStore
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    pop_key_id BLOB PRIMARY KEY,
+    exp        INTEGER,
+    claims     BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tokens_exp ON tokens (exp);
+CREATE TABLE IF NOT EXISTS sessions (
+    id            BLOB PRIMARY KEY,
+    peer_id       BLOB NOT NULL,
+    shared_secret BLOB NOT NULL,
+    aead          INTEGER NOT NULL,
+    message1      BLOB NOT NULL,
+    message2      BLOB NOT NULL,
+    created       REAL NOT NULL
+);
+"""
+
+
+class SharedState:
+    """
+    Token, EDHOC and OSCORE state of a resource server shared by several worker processes through a
+    local SQLite database in WAL mode, see run_workers().
+
+    Unlike the AS store, writes are committed synchronously: a handshake finished by one worker must
+    be visible to the worker receiving the next request. Security contexts are kept in a shared
+    ContextStore: workers reserve blocks of sequence numbers in the database, so no two workers ever
+    encrypt with the same nonce, and mark received messages there, so a request accepted by one
+    worker is rejected as a replay by all others.
+    """
+
+    # Seconds an EDHOC handshake may take between MSG1 and MSG3
+    SESSION_LIFETIME = 60.0
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        """
+        :param path: Path of the database file, the same for all workers
+        :param timeout: Seconds to wait for a lock held by another worker
+        """
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self.contexts = ContextStore(path, shared=True, timeout=timeout)
+
+        connection = self._connect()
+        connection.executescript(_SCHEMA)
+        connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not be inherited by forked workers
+        (pid, connection) = getattr(self._local, 'connection', (None, None))
+        if pid != os.getpid():
+            connection = self._connect()
+            self._local.connection = (os.getpid(), connection)
+        return connection
+
+    def put_token(self, pop_key_id: bytes, claims: dict):
+        with self._connection as connection:
+            connection.execute('DELETE FROM tokens WHERE exp <= ?', (time.time(),))
+            connection.execute('INSERT OR REPLACE INTO tokens (pop_key_id, exp, claims) VALUES (?, ?, ?)',
+                               (pop_key_id, claims.get(CK.EXP), dumps(claims)))
+
+    def load_token(self, pop_key_id: bytes) -> dict:
+        """
+        :return: The claims of the token accepted for the PoP key, None if unknown or expired
+        """
+        row = self._connection.execute(
+            'SELECT claims FROM tokens WHERE pop_key_id = ? AND (exp IS NULL OR exp > ?)',
+            (pop_key_id, time.time())
+        ).fetchone()
+
+        return None if row is None else loads(row[0])
+
+    def load_peer_identity(self, pop_key_id: bytes):
+        """
+        :return: The PoP key of an accepted token, None if unknown or expired
+        """
+        claims = self.load_token(pop_key_id)
+
+        return None if claims is None else CoseKey.from_cose(claims[CK.CNF][Cose.COSE_KEY]).key
+
+    def put_session(self, session: EdhocSession):
+        """
+        Share a handshake after MSG2 was sent, so that any worker can process MSG3
+        """
+        now = time.time()
+
+        with self._connection as connection:
+            connection.execute('DELETE FROM sessions WHERE created < ?', (now - self.SESSION_LIFETIME,))
+            connection.execute(
+                'INSERT OR REPLACE INTO sessions (id, peer_id, shared_secret, aead, message1, message2, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (session.id, session.peer_id, session.shared_secret, session.aead,
+                 bytes(session.message1), bytes(session.message2), now)
+            )
+
+    def load_session(self, session_id: bytes) -> EdhocSession:
+        """
+        :return: The handshake waiting for MSG3, None if unknown or timed out
+        """
+        row = self._connection.execute(
+            'SELECT peer_id, shared_secret, aead, message1, message2 FROM sessions WHERE id = ? AND created >= ?',
+            (session_id, time.time() - self.SESSION_LIFETIME)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        session = EdhocSession()
+        session.id = session_id
+        (session.peer_id, session.shared_secret, session.aead, session.message1, session.message2) = row
+
+        return session
+
+    def remove_session(self, session_id: bytes):
+        with self._connection as connection:
+            connection.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+
+    def put_context(self, rid: bytes, pop_key_id: bytes, context: OscoreContext):
+        """
+        Share a security context established by EDHOC. From now on its sequence numbers are
+        reserved in the database
+        """
+        self.contexts.save(rid, context, peer=pop_key_id)
+
+    def load_context(self, rid: bytes):
+        """
+        :return: (OscoreContext, PoP key id) of the recipient rid, None if unknown
+        """
+        return self.contexts.load(rid)
+
+    def close(self):
+        self.contexts.close()
+
+        (pid, connection) = getattr(self._local, 'connection', (None, None))
+        if pid == os.getpid():
+            connection.close()
+        self._local.connection = (None, None)
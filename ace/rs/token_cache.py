@@ -1,11 +1,84 @@
+import time
+
+from ace.cache import ExpiringDict
+from ace.cbor.constants import Keys as CK
+from ace.scope import ScopeMap
+
+
+class TokenRecord(object):
+    """
+    Authorization state of an accepted token, parsed once when the token is accepted
+    """
+
+    __slots__ = ('pop_key_id', 'audience', 'scopes', 'mask', 'expires')
+
+    def __init__(self, pop_key_id: bytes, audience: str, scope, expires: float = None):
+        """
+        :param scope: The scope claim, a comma separated string or the integer mask of a compact token
+        """
+        self.pop_key_id = pop_key_id
+        self.audience = audience
+        self.expires = expires
+
+        if isinstance(scope, int):
+            self.scopes, self.mask = None, scope
+        elif isinstance(scope, str):
+            self.scopes, self.mask = frozenset(scope.split(",")), None
+        else:
+            raise ValueError("Invalid scope")
+
+    @classmethod
+    def from_claims(cls, claims: dict, pop_key_id: bytes) -> 'TokenRecord':
+        return cls(pop_key_id, claims[CK.AUD], claims[CK.SCOPE], claims.get(CK.EXP))
+
+    def allows(self, scope: str, scope_map: ScopeMap) -> bool:
+        """
+        :return: True if the token grants scope, a mask is checked against the bit of scope in scope_map.
+                 Scopes unknown to scope_map are never granted by a mask
+        """
+        if self.mask is not None:
+            mask = scope_map.mask((scope,), strict=True)
+            return mask is not None and self.mask & mask != 0
+
+        return scope in self.scopes
+
+
 class TokenCache(object):
+    """
+    Accepted tokens by PoP key id until they expire. With a capacity set, the least recently used
+    token is evicted when full.
+    """
+
+    def __init__(self, capacity: int = None, clock=time.time):
+        self.tokens = ExpiringDict(capacity=capacity, clock=clock)
+
+    def add_token(self, token: dict, pop_key_id) -> TokenRecord:
+        """
+        :param token: The claims of the token
+        """
+        record = TokenRecord.from_claims(token, pop_key_id)
+        self.tokens.set(pop_key_id, record, expires=record.expires)
+
+        return record
+
+    def get_token(self, pop_key_id) -> TokenRecord:
+        """
+        :raises KeyError: If no token is cached for the key or it expired
+        """
+        record = self.tokens.get(pop_key_id)
+        if record is None:
+            raise KeyError(pop_key_id)
+
+        return record
 
-    def __init__(self):
-        self.tokens = {}
+    def remove_token(self, pop_key_id):
+        self.tokens.pop(pop_key_id)
 
-    def add_token(self, token, pop_key_id):
-        self.tokens[pop_key_id] = token
+    def stats(self) -> dict:
+        return self.tokens.stats()
 
-    def get_token(self, pop_key_id):
-        return self.tokens[pop_key_id]
+    def __contains__(self, pop_key_id):
+        return pop_key_id in self.tokens
 
+    def __len__(self):
+        return len(self.tokens)
@@ -0,0 +1,42 @@
+import multiprocessing
+import os
+import socket
+
+from aiohttp import web
+
+
+def run_workers(make_app, host: str, port: int, workers: int = None):
+    """
+    Serve an HTTP resource server from several processes sharing one listening socket.
+
+    Every worker calls make_app() after it was started, so that event loops, connections and caches
+    are not shared. The resource servers created by make_app() need a SharedState on the same
+    database file, so that tokens and security contexts established with one worker are known to all.
+
+    :param make_app: Callable returning the aiohttp application of a worker
+    :param workers: Number of worker processes, the number of CPUs if None
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_serve, args=(make_app, sock), name=f'ace-rs-worker-{i}', daemon=True)
+                 for i in range(workers or os.cpu_count())]
+
+    for process in processes:
+        process.start()
+
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            process.terminate()
+        sock.close()
+
+
+def _serve(make_app, sock: socket.socket):
+    web.run_app(make_app(), sock=sock, print=None)
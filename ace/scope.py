@@ -0,0 +1,91 @@
+from typing import List
+
+from ace.cache import LRUCache
+
+
+class ScopeMap(object):
+    """
+    Assigns each scope of a resource server a bit, so that sets of scopes become integer masks and
+    authorization checks become a bitwise AND. AS and RS agree on the bits by listing the scopes
+    in the same order.
+    """
+
+    def __init__(self, scopes: List[str] = (), cache_size: int = 256):
+        """
+        :param scopes: Scope names, the n-th scope is assigned bit n
+        :param cache_size: Number of parsed scope strings to remember
+        """
+        self.scopes: List[str] = []
+        self.bits = {}
+        self._parsed = LRUCache(maxsize=cache_size)
+
+        for scope in scopes:
+            self.add(scope)
+
+    @property
+    def all(self) -> int:
+        """
+        :return: Mask with the bits of all known scopes set
+        """
+        return (1 << len(self.scopes)) - 1
+
+    def add(self, scope: str) -> int:
+        """
+        Assign the next free bit to scope if it is not known yet
+        :return: The bit of the scope
+        """
+        if scope not in self.bits:
+            self.bits[scope] = 1 << len(self.scopes)
+            self.scopes.append(scope)
+            self._parsed.clear()
+
+        return self.bits[scope]
+
+    def bit(self, scope: str) -> int:
+        """
+        :return: The bit of the scope, 0 if unknown
+        """
+        return self.bits.get(scope, 0)
+
+    def mask(self, scopes, strict: bool = True) -> int:
+        """
+        :param scopes: A comma separated string, a list of scope names or an integer mask
+        :param strict: Whether unknown scopes invalidate the whole set
+        :return: The mask of the scopes, None if strict and a scope is unknown
+        """
+        if isinstance(scopes, int):
+            return scopes if not strict or scopes & ~self.all == 0 else None
+
+        if isinstance(scopes, str):
+            key = (scopes, strict)
+            mask = self._parsed.get(key, False)
+
+            if mask is False:
+                mask = self._mask(scopes.split(","), strict)
+                self._parsed.set(key, mask)
+
+            return mask
+
+        return self._mask(scopes, strict)
+
+    def _mask(self, scopes, strict: bool) -> int:
+        mask = 0
+
+        for scope in scopes:
+            bit = self.bits.get(scope)
+            if bit is None:
+                if strict:
+                    return None
+                continue
+            mask |= bit
+
+        return mask
+
+    def names(self, mask: int) -> List[str]:
+        """
+        :return: The names of the scopes set in mask
+        """
+        return [scope for (i, scope) in enumerate(self.scopes) if mask & (1 << i)]
+
+    def __len__(self):
+        return len(self.scopes)
@@ -1,5 +1,7 @@
 import unittest
 from .test_cose import TestCose
-from .test_edhoc import TestEdhoc
+from .test_edhoc import TestEdhoc, TestContextStore
+from .test_cache import TestCache
+from .test_authz import TestAuthorizationServer, TestKeyRotation, TestSharedState, TestTokenCache, TestScopeMap, TestSigningService, TestClientRegistry, TestSQLiteStore
 
 unittest.main()
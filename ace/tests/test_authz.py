@@ -0,0 +1,879 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+import aiocoap
+from aiocoap import resource
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from cbor2 import dumps, loads
+from ecdsa import SigningKey, NIST256p
+from ace.authz import AuthorizationServer, Grant, AccessToken, SigningService, SigningServiceOverloaded, \
+    SigningServiceUnavailable, SQLiteStore
+from ace.authz.client_registry import Client, ClientRegistry
+from ace.authz.key_registry import KeyRegistry
+from ace.authz.key_ring import KeyRing
+from ace.authz.token_registry import TokenRegistry
+from ace.cose import CoseKey, TrustStore
+from ace.scope import ScopeMap
+from ace.cbor.constants import Keys as CK, GrantTypes
+from ace.cose.constants import Key as Cose, Header
+from ace.cose import cwt
+from ace.cose.signing import generate_signing_key
+from ace.cose.cose import SignatureVerificationFailed
+from ace.rs import (ResourceServer, AudienceMismatchError, NotAuthorizedException, SharedState,
+                    IntrospectionFailedError, IntrospectNotActiveError)
+from ace.rs.coap import CoAPResourceServer, ObservableProtectedResource
+from ace.rs.http import HTTPResourceServer
+from ace.rs.token_cache import TokenCache
+from ace.edhoc import Client as EdhocClient, OscoreContext, ContextStore
+from ace.edhoc.context import ReplayError, ReplayWindow
+from ace.rs.resource_server import is_token_batch, is_token_reference
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class AuthorizationServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.as_key = SigningKey.generate(curve=NIST256p)
+        self.rs_key = SigningKey.generate(curve=NIST256p)
+        self.pop_key = SigningKey.generate(curve=NIST256p).get_verifying_key()
+
+        app = web.Application()
+        self.server = AuthorizationServer(self.as_key, app.router)
+        self.server.register_client('client-1', b'secret-1', grants=[Grant('tempSensor0', ['read', 'write'])])
+        self.server.register_client('client-2', b'secret-2', grants=[Grant('tempSensor0', ['read'])])
+        self.server.register_resource_server('tempSensor0', ['read', 'write'], self.rs_key.get_verifying_key())
+
+        async def start():
+            self.client = TestClient(TestServer(app))
+            await self.client.start_server()
+
+        run(start())
+
+    def tearDown(self):
+        run(self.client.close())
+
+    def token_request(self, client_id, client_secret, scope, audience='tempSensor0', key_id=b'pop-key'):
+        return {
+            CK.GRANT_TYPE: GrantTypes.CLIENT_CREDENTIALS,
+            CK.CLIENT_ID: client_id,
+            CK.CLIENT_SECRET: client_secret,
+            CK.SCOPE: scope,
+            CK.AUD: audience,
+            CK.CNF: { Cose.COSE_KEY: CoseKey(self.pop_key, key_id, CoseKey.Type.ECDSA).encode() }
+        }
+
+    def post(self, path, payload):
+        async def request():
+            response = await self.client.post(path, data=dumps(payload))
+            return response.status, loads(await response.read())
+
+        return run(request())
+
+
+class TestAuthorizationServer(AuthorizationServerTestCase):
+
+    def test_token(self):
+        (status, response) = self.post('/token', self.token_request('client-1', b'secret-1', 'read,write'))
+
+        assert status == 200
+        claims = cwt.decode(response[CK.ACCESS_TOKEN], self.as_key.get_verifying_key())
+        assert claims[CK.SCOPE] == 'read,write'
+
+    def test_grants(self):
+        assert self.post('/token', self.token_request('client-2', b'secret-2', 'read'))[0] == 200
+
+        (status, response) = self.post('/token', self.token_request('client-2', b'secret-2', 'read,write'))
+        assert (status, response) == (400, {'error': 'invalid_scope'})
+
+        (status, response) = self.post('/token', self.token_request('client-2', b'secret-2', 'delete'))
+        assert (status, response) == (400, {'error': 'unknown_scope'})
+
+        (status, response) = self.post('/token', self.token_request('client-2', b'wrong', 'read'))
+        assert (status, response) == (400, {'error': 'unauthorized_client'})
+
+    def test_token_batch(self):
+        requests = [
+            self.token_request('client-1', b'secret-1', 'read', key_id=b'device-1'),
+            self.token_request('client-2', b'secret-2', 'write', key_id=b'device-2'),
+            self.token_request('client-1', b'secret-1', 'read,write', key_id=b'device-3'),
+            'not a token request'
+        ]
+
+        (status, responses) = self.post('/token/batch', requests)
+
+        assert status == 200
+        assert len(responses) == 4
+        assert responses[1] == {'error': 'invalid_scope'}
+        assert responses[3] == {'error': 'invalid_request'}
+
+        for (i, scope) in [(0, 'read'), (2, 'read,write')]:
+            claims = cwt.decode(responses[i][CK.ACCESS_TOKEN], self.as_key.get_verifying_key())
+            assert claims[CK.SCOPE] == scope
+
+        assert self.server.key_registry._has_key('client-1', b'device-3')
+        assert not self.server.key_registry._has_key('client-2', b'device-2')
+
+        # Malformed requests fail on their own instead of failing the batch
+        missing_scope = self.token_request('client-1', b'secret-1', 'read', key_id=b'device-4')
+        del missing_scope[CK.SCOPE]
+        missing_cnf = self.token_request('client-1', b'secret-1', 'read', key_id=b'device-5')
+        del missing_cnf[CK.CNF]
+        bad_key = self.token_request('client-1', b'secret-1', 'read', key_id=b'device-6')
+        bad_key[CK.CNF] = {Cose.COSE_KEY: b'\xa1\x01\x02'}
+        bad_point = self.token_request('client-1', b'secret-1', 'read', key_id=b'device-7')
+        bad_point[CK.CNF] = {Cose.COSE_KEY: dumps({Cose.KTY: Cose.Type.EC2, Cose.CRV: Cose.Curve.P_256, Cose.X: b'\x01' * 32,
+                                                   Cose.Y: b'\x02' * 32, Cose.KID: b'device-7'})}
+        unhashable = self.token_request('client-1', b'secret-1', 'read', key_id=b'device-8')
+        unhashable[CK.AUD] = ['tempSensor0']
+
+        (status, responses) = self.post('/token/batch', [missing_scope, missing_cnf, bad_key, bad_point, unhashable,
+                                                         requests[0]])
+
+        assert status == 200
+        assert responses[:5] == [{'error': 'invalid_request'}] * 5
+        assert CK.ACCESS_TOKEN in responses[5]
+
+    def test_eddsa_token(self):
+        as_key = generate_signing_key(Cose.Curve.Ed25519)
+        server = AuthorizationServer(as_key, web.Application().router)
+        server.register_client('client-1', b'secret-1', grants=[Grant('tempSensor0', ['read'])])
+        server.register_resource_server('tempSensor0', ['read'], generate_signing_key(Cose.Curve.Ed25519).public_key())
+
+        pop_key = generate_signing_key(Cose.Curve.Ed25519).public_key()
+        params = self.token_request('client-1', b'secret-1', 'read')
+        params[CK.CNF] = { Cose.COSE_KEY: CoseKey(pop_key, b'pop-key', CoseKey.Type.ECDSA).encode() }
+
+        response = run(server._issue(*server._grant(params)))
+        claims = cwt.decode(response[CK.ACCESS_TOKEN], as_key.public_key())
+
+        assert CoseKey.from_cose(claims[CK.CNF][Cose.COSE_KEY]).encode() == params[CK.CNF][Cose.COSE_KEY]
+        assert loads(response[CK.RS_CNF])[Cose.KTY] == Cose.Type.OKP
+
+        service = SigningService.with_thread_pool(as_key, workers=1)
+        token = AccessToken(claims={CK.AUD: 'tempSensor0', CK.CTI: '0'})
+        signed = run(token.sign_and_export_self_contained_async(service, key_id=b''))
+        with self.assertRaises(TypeError):
+            run(service.sign_digest(bytes(32)))
+        service.shutdown()
+
+        assert cwt.decode(signed, as_key.public_key()) == token.claims
+
+    def test_authz_info_batch(self):
+        app = web.Application()
+        rs = HTTPResourceServer('tempSensor0', self.rs_key, 'http://localhost:8080', self.as_key.get_verifying_key(),
+                                app.router)
+
+        tokens = [self.post('/token', self.token_request('client-1', b'secret-1', 'read', key_id=bytes([i])))[1]
+                  [CK.ACCESS_TOKEN] for i in range(5)]
+        tokens[2] = cwt.encode({ CK.AUD: 'tempSensor1' }, self.as_key, kid=AuthorizationServer.KEY_ID)
+        tokens[3] = tokens[3][:-1] + bytes([tokens[3][-1] ^ 1])
+
+        assert is_token_batch(dumps(tokens)) and is_token_batch(dumps([]))
+        assert not is_token_batch(tokens[0]) and not is_token_batch(dumps(loads(tokens[0]).value))
+
+        async def upload(payload):
+            client = TestClient(TestServer(app))
+            await client.start_server()
+            response = await client.post('/authz-info', data=payload)
+            result = (response.status, loads(await response.read()))
+            await client.close()
+            return result
+
+        (status, results) = run(upload(dumps(tokens)))
+
+        assert status == 201
+        assert results == [None, None, {'error': 'Audience mismatch'}, {'error': 'invalid_token'}, None]
+        assert rs.token_cache.get_token(bytes([4])).scopes == {'read'}
+        assert bytes([4]) in rs.edhoc_server.peer_identities
+
+        assert run(upload(dumps([tokens[0]] * (rs.MAX_TOKEN_BATCH + 1)))) == (400, {'error': 'invalid_request'})
+
+    def test_protected_request(self):
+        app = web.Application()
+        rs = HTTPResourceServer('tempSensor0', self.rs_key, 'http://localhost:8080', self.as_key.get_verifying_key(),
+                                app.router, scopes=['read', 'write'])
+
+        async def handler(request, message):
+            return web.Response(status=200, body=message.oscore_context.encrypt(message.payload.upper()))
+
+        app.router.add_post('/read', rs.wrap('read', handler))
+        app.router.add_post('/write', rs.protect('write')(handler))
+
+        pop_key = SigningKey.generate(curve=NIST256p)
+        params = self.token_request('client-2', b'secret-2', 'read')
+        params[CK.CNF] = { Cose.COSE_KEY: CoseKey(pop_key.get_verifying_key(), b'pop-key', CoseKey.Type.ECDSA).encode() }
+        rs.register_token(self.post('/token', params)[1][CK.ACCESS_TOKEN])
+
+        edhoc = EdhocClient(pop_key, self.rs_key.get_verifying_key(), kid=b'pop-key')
+        message2 = rs.edhoc_server.on_receive(bytes(edhoc.initiate_edhoc()))
+        rs.edhoc_server.on_receive(bytes(edhoc.continue_edhoc(bytes(message2))))
+        context = edhoc.session.oscore_context
+
+        async def request(path, payload):
+            client = TestClient(TestServer(app))
+            await client.start_server()
+            response = await client.post(path, data=payload)
+            result = (response.status, await response.read())
+            await client.close()
+            return result
+
+        (status, body) = run(request('/read', context.encrypt(b'hello')))
+        assert status == 200 and context.decrypt(body) == b'HELLO'
+
+        assert run(request('/write', context.encrypt(b'hello')))[0] == 401
+        assert run(request('/read', b'\x80'))[0] == 400
+
+        encrypted = bytearray(context.encrypt(b'hello'))
+        encrypted[-1] ^= 1
+        assert run(request('/read', bytes(encrypted)))[0] == 400
+
+    def test_observe(self):
+        class Counter(ObservableProtectedResource):
+            value = 0
+
+            async def render_protected_get(self, request, message):
+                return aiocoap.Message(payload=message.oscore_context.encrypt(dumps(self.value)))
+
+        site = resource.Site()
+        rs = CoAPResourceServer('tempSensor0', self.rs_key, 'http://localhost:8080', self.as_key.get_verifying_key(),
+                                site)
+        counter = Counter('read', rs)
+        site.add_resource(('counter',), counter)
+
+        pop_key = SigningKey.generate(curve=NIST256p)
+        params = self.token_request('client-2', b'secret-2', 'read')
+        params[CK.CNF] = { Cose.COSE_KEY: CoseKey(pop_key.get_verifying_key(), b'pop-key', CoseKey.Type.ECDSA).encode() }
+        rs.register_token(self.post('/token', params)[1][CK.ACCESS_TOKEN])
+
+        edhoc = EdhocClient(pop_key, self.rs_key.get_verifying_key(), kid=b'pop-key')
+        message2 = rs.edhoc_server.on_receive(bytes(edhoc.initiate_edhoc()))
+        rs.edhoc_server.on_receive(bytes(edhoc.continue_edhoc(bytes(message2))))
+        context = edhoc.session.oscore_context
+
+        # The token expires while observed
+        rs.token_cache.get_token(b'pop-key').expires = time.time() + 1.0
+
+        async def observe():
+            # Any free port, read back from the UDP transport of the server
+            server = await aiocoap.Context.create_server_context(site, bind=('127.0.0.1', 0))
+            port = next(interface.token_interface.message_interface.transport.get_extra_info('socket').getsockname()[1]
+                        for interface in server.request_interfaces
+                        if hasattr(getattr(interface.token_interface, 'message_interface', None), 'transport'))
+            client = await aiocoap.Context.create_client_context()
+
+            request = client.request(aiocoap.Message(code=aiocoap.GET, uri=f'coap://127.0.0.1:{port}/counter',
+                                                     observe=0, payload=context.encrypt(b'')))
+            responses = [await request.response]
+            assert len(counter.observers) == 1
+
+            counter.value += 1
+            counter.updated_state()
+
+            async for notification in request.observation:
+                responses.append(notification)
+                if counter.value < 2:
+                    counter.value += 1
+                    counter.updated_state()
+
+            await client.shutdown()
+            await server.shutdown()
+            return responses
+
+        (*responses, last) = run(observe())
+        assert last.code == aiocoap.UNAUTHORIZED
+
+        assert [loads(context.decrypt(response.payload)) for response in responses] == [0, 1, 2]
+        # Every notification is encrypted with a new sequence number
+        assert len({loads(response.payload).value[1][Header.PARTIAL_IV] for response in responses}) == 3
+        assert counter.observers == {}
+
+    def test_maced_token(self):
+        mac_key = os.urandom(32)
+        self.server.register_resource_server('tempSensor1', ['read'], self.rs_key.get_verifying_key(), mac_key=mac_key)
+        self.server.register_client('client-3', b'secret-3', grants=[Grant('tempSensor1', ['read'])])
+
+        (status, response) = self.post('/token', self.token_request('client-3', b'secret-3', 'read', 'tempSensor1'))
+        token = response[CK.ACCESS_TOKEN]
+
+        assert status == 200
+        assert cwt.is_maced(token)
+        assert cwt.decode_mac(token, mac_key)[CK.AUD] == 'tempSensor1'
+
+        # Both forms are accepted by a resource server knowing both keys
+        rs = ResourceServer('tempSensor1', self.rs_key, 'http://localhost:8080', self.as_key.get_verifying_key(),
+                            as_mac_key=mac_key)
+        signed = self.post('/token', self.token_request('client-1', b'secret-1', 'read', key_id=b'other'))[1]
+
+        assert rs.register_token(token)[CK.SCOPE] == 'read'
+        assert rs.decode_token(signed[CK.ACCESS_TOKEN])[CK.AUD] == 'tempSensor0'
+
+        with self.assertRaises(AudienceMismatchError):
+            rs.register_token(signed[CK.ACCESS_TOKEN])
+
+        rs = ResourceServer('tempSensor1', self.rs_key, 'http://localhost:8080', None, as_mac_key=os.urandom(32))
+        with self.assertRaises(SignatureVerificationFailed):
+            rs.decode_token(token)
+        with self.assertRaises(SignatureVerificationFailed):
+            rs.decode_token(signed[CK.ACCESS_TOKEN])
+
+    def test_verified_tokens(self):
+        rs = ResourceServer('tempSensor0', self.rs_key, 'http://localhost:8080', self.as_key.get_verifying_key())
+        token = self.post('/token', self.token_request('client-1', b'secret-1', 'read'))[1][CK.ACCESS_TOKEN]
+
+        verified = []
+        verify = rs._verify_token
+        rs._verify_token = lambda access_token: verified.append(access_token) or verify(access_token)
+
+        assert rs.register_token(token) == rs.register_token(token)
+        assert verified == [token]
+
+        # Expires with the token
+        claims = rs.decode_token(token)
+        rs.verified_tokens.set(hashlib.sha256(token).digest(), claims, expires=time.time() - 1)
+        rs.decode_token(token)
+        assert verified == [token, token]
+
+        with self.assertRaises(SignatureVerificationFailed):
+            rs.decode_token(token[:-1] + bytes([token[-1] ^ 1]))
+
+    def test_compact_token(self):
+        self.server.register_resource_server('tempSensor1', ['read', 'write'], self.rs_key.get_verifying_key(),
+                                             compact=True)
+        self.server.register_client('client-3', b'secret-3', grants=[Grant('tempSensor1', ['write'])])
+
+        token = self.post('/token', self.token_request('client-3', b'secret-3', 'write', 'tempSensor1'))[1][CK.ACCESS_TOKEN]
+        claims = cwt.decode(token, self.as_key.get_verifying_key())
+
+        assert claims[CK.SCOPE] == 0b10
+        assert isinstance(claims[CK.CTI], bytes) and len(claims[CK.CTI]) == AuthorizationServer.CTI_LENGTH
+        assert self.server.token_registry.get_token(cti=claims[CK.CTI]).scope == 0b10
+
+        # Masks are checked against the grants like scope strings
+        (status, response) = self.post('/token', self.token_request('client-3', b'secret-3', 0b01, 'tempSensor1'))
+        assert (status, response) == (400, {'error': 'invalid_scope'})
+        (status, response) = self.post('/token', self.token_request('client-3', b'secret-3', 0b100, 'tempSensor1'))
+        assert (status, response) == (400, {'error': 'unknown_scope'})
+
+        # Requesting a mask opts in per request, textual requests keep textual tokens
+        token = self.post('/token', self.token_request('client-1', b'secret-1', 0b11))[1][CK.ACCESS_TOKEN]
+        assert cwt.decode(token, self.as_key.get_verifying_key())[CK.SCOPE] == 0b11
+        token = self.post('/token', self.token_request('client-1', b'secret-1', 'read'))[1][CK.ACCESS_TOKEN]
+        assert isinstance(cwt.decode(token, self.as_key.get_verifying_key())[CK.CTI], str)
+
+        rs = ResourceServer('tempSensor0', self.rs_key, 'http://localhost:8080', self.as_key.get_verifying_key(),
+                            scopes=['read', 'write'])
+        for (scope, expected) in [(0b11, 'write'), ('read', 'read')]:
+            token = self.post('/token', self.token_request('client-1', b'secret-1', scope))[1][CK.ACCESS_TOKEN]
+            granted = rs.scope_map.mask(rs.register_token(token)[CK.SCOPE], strict=False)
+            assert granted & rs.scope_map.bit(expected)
+
+        # Bits are never assigned while authorizing, unknown scopes are denied
+        record = rs.token_cache.get_token(b'pop-key')
+        record.mask = 0b100
+        assert not record.allows('delete', rs.scope_map)
+        assert len(rs.scope_map) == 2
+
+        # Without the scope order of the AS a mask can not be interpreted
+        rs = ResourceServer('tempSensor0', self.rs_key, 'http://localhost:8080', self.as_key.get_verifying_key())
+        token = self.post('/token', self.token_request('client-1', b'secret-1', 0b01))[1][CK.ACCESS_TOKEN]
+        with self.assertRaises(ValueError):
+            rs.register_token(token)
+
+
+    def test_reference_token(self):
+        self.server.register_resource_server('tempSensor1', ['read'], self.rs_key.get_verifying_key(), referential=True,
+                                             client_id='tempSensor1', client_secret=b'rs-secret')
+        self.server.register_client('client-3', b'secret-3', grants=[Grant('tempSensor1', ['read'])])
+
+        (status, response) = self.post('/token', self.token_request('client-3', b'secret-3', 'read', 'tempSensor1'))
+        token = response[CK.ACCESS_TOKEN]
+
+        assert status == 200
+        assert is_token_reference(token) and not is_token_reference(dumps([token]))
+        assert len(loads(token)) == 16
+
+        as_url = str(self.client.make_url('')).rstrip('/')
+        rs = ResourceServer('tempSensor1', self.rs_key, as_url, self.as_key.get_verifying_key(),
+                            client_id='tempSensor1', client_secret=b'rs-secret')
+
+        async def register():
+            # Concurrent uploads of the same reference share one introspection
+            results = await asyncio.gather(*[rs.register_reference(token) for _ in range(4)])
+            results.append(await rs.register_reference(token))
+            await rs.close()
+            return results
+
+        results = run(register())
+
+        assert rs.introspections == 1
+        assert all(claims[CK.SCOPE] == 'read' for claims in results)
+        assert rs.token_cache.get_token(b'pop-key').audience == 'tempSensor1'
+        assert rs.introspected.get(loads(token))[CK.EXP] == results[0][CK.EXP]
+
+        # Introspection needs the credentials of a resource server and only reveals its own tokens
+        rs = ResourceServer('tempSensor1', self.rs_key, as_url, self.as_key.get_verifying_key(),
+                            client_id='tempSensor1', client_secret=b'wrong')
+        with self.assertRaises(IntrospectionFailedError):
+            run(rs.register_reference(token))
+        run(rs.close())
+
+        self.server.register_resource_server('tempSensor0', ['read', 'write'], self.rs_key.get_verifying_key(),
+                                             client_id='tempSensor0', client_secret=b'rs-secret-0')
+        rs = ResourceServer('tempSensor0', self.rs_key, as_url, self.as_key.get_verifying_key(),
+                            client_id='tempSensor0', client_secret=b'rs-secret-0')
+        with self.assertRaises(IntrospectNotActiveError):
+            run(rs.register_reference(token))
+        run(rs.close())
+
+        # An active response without audience is not for this resource server
+        async def post_to_as(path, payload, expected_status):
+            return [7, {CK.ACTIVE: True}] if path == '/introspect/batch' else {CK.ACTIVE: True}
+
+        rs._post_to_as = post_to_as
+        with self.assertRaises(AudienceMismatchError):
+            run(rs.introspect(os.urandom(16)))
+        assert run(rs.introspect_batch([os.urandom(16), os.urandom(16)])) == [7, {CK.ACTIVE: True}]
+        assert len(rs.introspected) == 0
+
+    def test_introspect_batch(self):
+        self.server.register_resource_server('tempSensor1', ['read'], self.rs_key.get_verifying_key(), referential=True,
+                                             client_id='tempSensor1', client_secret=b'rs-secret')
+        self.server.register_client('client-3', b'secret-3', grants=[Grant('tempSensor1', ['read'])])
+
+        self.server.register_resource_server('tempSensor0', ['read', 'write'], self.rs_key.get_verifying_key(),
+                                             client_id='tempSensor0', client_secret=b'rs-secret-0')
+
+        reference = loads(self.post('/token', self.token_request('client-3', b'secret-3', 'read', 'tempSensor1'))[1]
+                          [CK.ACCESS_TOKEN])
+        (compact, textual) = [cwt.decode(self.post('/token', self.token_request('client-1', b'secret-1', scope))[1]
+                                         [CK.ACCESS_TOKEN], self.as_key.get_verifying_key())[CK.CTI]
+                              for scope in (0b11, 'read')]
+
+        credentials = {CK.CLIENT_ID: 'tempSensor0', CK.CLIENT_SECRET: b'rs-secret-0'}
+        (status, responses) = self.post('/introspect/batch', {
+            CK.TOKEN: [{CK.CTI: compact}, {CK.CTI: textual}, reference, os.urandom(16), {}, 7], **credentials
+        })
+
+        assert status == 200
+        assert responses[0][CK.ACTIVE] and responses[0][CK.SCOPE] == 0b11
+        # Textual ctis are guessable and tokens of other resource servers are not revealed
+        assert isinstance(textual, str)
+        assert responses[1:] == [{CK.ACTIVE: False}] * 5
+
+        credentials = {CK.CLIENT_ID: 'tempSensor1', CK.CLIENT_SECRET: b'rs-secret'}
+        (status, responses) = self.post('/introspect/batch', {CK.TOKEN: [reference, {CK.CTI: compact}], **credentials})
+        assert responses[0][CK.ACTIVE] and responses[0][CK.AUD] == 'tempSensor1'
+        assert responses[1] == {CK.ACTIVE: False}
+
+        # Unknown tokens are inactive rather than an error
+        assert self.post('/introspect', {CK.TOKEN: os.urandom(16), **credentials}) == (201, {CK.ACTIVE: False})
+        assert self.post('/introspect/batch', {}) == (400, {'error': 'invalid_request'})
+
+        # Introspection requires the credentials of a resource server
+        assert self.post('/introspect', {CK.TOKEN: reference}) == (401, {'error': 'unauthorized_client'})
+        assert self.post('/introspect/batch', {CK.TOKEN: [reference], CK.CLIENT_ID: 'tempSensor1',
+                                               CK.CLIENT_SECRET: b'wrong'}) == (401, {'error': 'unauthorized_client'})
+        assert self.post('/introspect/batch', {CK.TOKEN: [reference], CK.CLIENT_ID: 'client-1',
+                                               CK.CLIENT_SECRET: b'secret-1'}) == (401, {'error': 'unauthorized_client'})
+
+        as_url = str(self.client.make_url('')).rstrip('/')
+        rs = ResourceServer('tempSensor1', self.rs_key, as_url, self.as_key.get_verifying_key(),
+                            client_id='tempSensor1', client_secret=b'rs-secret')
+
+        async def introspect():
+            responses = await rs.introspect_batch([reference, os.urandom(16)])
+            claims = await rs.register_reference(dumps(reference))
+            await rs.close()
+            return responses, claims
+
+        (responses, claims) = run(introspect())
+
+        assert responses[0] == claims and not responses[1][CK.ACTIVE]
+        assert rs.introspections == 1
+
+
+class TestKeyRotation(AuthorizationServerTestCase):
+
+    def test_key_ring(self):
+        now = [100.0]
+        ring = KeyRing(clock=lambda: now[0])
+
+        ring.add(b'k1', self.as_key)
+        ring.add(b'k2', SigningKey.generate(curve=NIST256p), activates=200.0, retires=300.0)
+
+        assert ring.current().kid == b'k1'
+        now[0] = 200.0
+        assert ring.current().kid == b'k2'
+        now[0] = 300.0
+        assert ring.current().kid == b'k1'
+
+        ring.retire(b'k1', when=350.0)
+        assert ring.current().kid == b'k1'
+        now[0] = 350.0
+        assert ring.current() is None
+
+    def test_rotation(self):
+        rs = ResourceServer('tempSensor0', self.rs_key, 'http://localhost:8080', self.as_key.get_verifying_key())
+        old_token = self.post('/token', self.token_request('client-1', b'secret-1', 'read'))[1][CK.ACCESS_TOKEN]
+
+        # The RS learns the new key before the AS starts using it
+        new_key = generate_signing_key(Cose.Curve.Ed25519)
+        self.server.add_signing_key(new_key, b'as-key-2')
+        self.server.retire_signing_key(AuthorizationServer.KEY_ID)
+
+        (verifier, expires) = self.server.trusted_keys()[b'as-key-2']
+        assert expires is None
+        assert self.server.trusted_keys()[AuthorizationServer.KEY_ID][1] > time.time()
+        rs.trust_as_key(b'as-key-2', verifier, expires)
+
+        new_token = self.post('/token', self.token_request('client-1', b'secret-1', 'read'))[1][CK.ACCESS_TOKEN]
+        assert loads(loads(new_token).value[1])[Header.KID] == b'as-key-2'
+
+        assert rs.decode_token(old_token)[CK.SCOPE] == 'read'
+        assert rs.decode_token(new_token)[CK.SCOPE] == 'read'
+
+        rs.distrust_as_key(AuthorizationServer.KEY_ID)
+        with self.assertRaises(SignatureVerificationFailed):
+            rs.decode_token(old_token)
+        assert rs.decode_token(new_token)[CK.SCOPE] == 'read'
+
+        # Verified tokens are not remembered beyond the trust in their key
+        trusted_until = time.time() + 60
+        rs.trust_as_key(b'as-key-2', verifier, trusted_until)
+        rs.verified_tokens.clear()
+        rs.decode_token(new_token)
+        assert rs.verified_tokens._entries[hashlib.sha256(new_token).digest()][1] == trusted_until
+
+    def test_trust_store(self):
+        now = [100.0]
+        store = TrustStore(clock=lambda: now[0])
+        store.add(b'as', self.as_key.get_verifying_key(), expires=200.0)
+
+        token = cwt.encode({ CK.CTI: '1' }, self.as_key, kid=b'as')
+        assert cwt.decode(token, store) == { CK.CTI: '1' }
+
+        with self.assertRaises(SignatureVerificationFailed):
+            cwt.decode(cwt.encode({ CK.CTI: '1' }, self.as_key, kid=b'other'), store)
+
+        now[0] = 200.0
+        with self.assertRaises(SignatureVerificationFailed):
+            cwt.decode(token, store)
+
+
+class TestSharedState(AuthorizationServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'rs.db')
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+    def worker(self):
+        return ResourceServer('tempSensor0', self.rs_key, 'http://localhost:8080', self.as_key.get_verifying_key(),
+                              shared_state=SharedState(self.path))
+
+    def test_workers(self):
+        (worker1, worker2) = (self.worker(), self.worker())
+
+        pop_key = SigningKey.generate(curve=NIST256p)
+        params = self.token_request('client-2', b'secret-2', 'read')
+        params[CK.CNF] = { Cose.COSE_KEY: CoseKey(pop_key.get_verifying_key(), b'pop-key', CoseKey.Type.ECDSA).encode() }
+        worker1.register_token(self.post('/token', params)[1][CK.ACCESS_TOKEN])
+
+        # The handshake is finished by the other worker
+        edhoc = EdhocClient(pop_key, self.rs_key.get_verifying_key(), kid=b'pop-key')
+        message2 = worker1.edhoc_server.on_receive(bytes(edhoc.initiate_edhoc()))
+        assert bytes(worker2.edhoc_server.on_receive(bytes(edhoc.continue_edhoc(bytes(message2))))) == dumps(["OK"])
+        context = edhoc.session.oscore_context
+
+        pivs = []
+        for worker in (worker1, worker2, worker1):
+            message = worker.protected_request(context.encrypt(b'hello'), 'read')
+            response = message.oscore_context.encrypt(message.payload)
+
+            assert context.decrypt(response) == b'hello'
+            pivs.append(loads(response).value[1][Header.PARTIAL_IV])
+
+        # Both workers encrypt with the same context, but never with the same sequence number
+        assert len(set(pivs)) == 3
+
+        # A request accepted by one worker is a replay for the other
+        request = context.encrypt(b'hello')
+        assert worker1.protected_request(request, 'read').payload == b'hello'
+        with self.assertRaises(ReplayError):
+            worker2.protected_request(request, 'read')
+
+        with self.assertRaises(NotAuthorizedException):
+            worker2.protected_request(context.encrypt(b'hello'), 'write')
+
+    def test_context_store(self):
+        def restart():
+            return ResourceServer('tempSensor0', self.rs_key, 'http://localhost:8080',
+                                  self.as_key.get_verifying_key(), context_store=ContextStore(self.path))
+
+        rs = restart()
+        assert not rs.edhoc_server.context_store.shared
+
+        pop_key = SigningKey.generate(curve=NIST256p)
+        params = self.token_request('client-2', b'secret-2', 'read')
+        params[CK.CNF] = { Cose.COSE_KEY: CoseKey(pop_key.get_verifying_key(), b'pop-key', CoseKey.Type.ECDSA).encode() }
+        token = self.post('/token', params)[1][CK.ACCESS_TOKEN]
+        rs.register_token(token)
+
+        edhoc = EdhocClient(pop_key, self.rs_key.get_verifying_key(), kid=b'pop-key')
+        message2 = rs.edhoc_server.on_receive(bytes(edhoc.initiate_edhoc()))
+        rs.edhoc_server.on_receive(bytes(edhoc.continue_edhoc(bytes(message2))))
+        context = edhoc.session.oscore_context
+
+        def exchange(rs, request):
+            message = rs.protected_request(request, 'read')
+            return loads(message.oscore_context.encrypt(message.payload)).value[1][Header.PARTIAL_IV]
+
+        seen = context.encrypt(b'hello')
+        assert exchange(rs, seen) == b'\x00'
+
+        # A clean restart resumes the exact state, the client presents its token again
+        rs.edhoc_server.context_store.close()
+        rs = restart()
+        rs.register_token(token)
+
+        with self.assertRaises(ReplayError):
+            rs.protected_request(seen, 'read')
+        seen = context.encrypt(b'hello')
+        assert exchange(rs, seen) == b'\x01'
+
+        # After a crash, numbers up to one block beyond the checkpoints count as used and received
+        rs = restart()
+        rs.register_token(token)
+
+        with self.assertRaises(ReplayError):
+            rs.protected_request(context.encrypt(b'hello'), 'read')
+        assert type(rs.edhoc_server.oscore_context_for_recipient(context.sender_id).replay_window) is ReplayWindow
+
+        # The window was checkpointed at 1 and the block reserved after the clean restart ends at 65
+        context.sequence_number = 66
+        assert exchange(rs, context.encrypt(b'hello')) == bytes([65])
+
+        with self.assertRaises(ValueError):
+            ResourceServer('tempSensor0', self.rs_key, 'http://localhost:8080', self.as_key.get_verifying_key(),
+                           shared_state=SharedState(self.path), context_store=ContextStore(self.path))
+
+    def test_sequence_numbers(self):
+        state = SharedState(self.path)
+        state.put_context(b'rid', b'pop-key', OscoreContext(b'secret', b'salt', b'sid', b'rid'))
+
+        def allocate(queue):
+            (context, pop_key_id) = SharedState(self.path).load_context(b'rid')
+            queue.put([context.next_sequence_number() for _ in range(50)])
+
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        processes = [context.Process(target=allocate, args=(queue,)) for _ in range(3)]
+        for process in processes:
+            process.start()
+
+        allocated = [n for _ in processes for n in queue.get(timeout=30)]
+        for process in processes:
+            process.join()
+
+        # Every worker reserves its own block of sequence numbers
+        assert len(set(allocated)) == 150
+        assert state.load_context(b'rid')[0].next_sequence_number() > max(allocated)
+
+
+class TestTokenCache(unittest.TestCase):
+
+    def test_token_cache(self):
+        now = [1000.0]
+        cache = TokenCache(capacity=2, clock=lambda: now[0])
+        scopes = ScopeMap(['read', 'write'])
+
+        record = cache.add_token({CK.AUD: 'rs', CK.SCOPE: 'read', CK.EXP: 1010}, b'a')
+        cache.add_token({CK.AUD: 'rs', CK.SCOPE: 0b10, CK.EXP: 1020}, b'b')
+
+        assert cache.get_token(b'a') is record and record.audience == 'rs'
+        assert record.allows('read', scopes) and not record.allows('write', scopes)
+        assert cache.get_token(b'b').allows('write', scopes) and not cache.get_token(b'b').allows('read', scopes)
+
+        # Expired tokens are rejected at lookup
+        now[0] = 1010.0
+        with self.assertRaises(KeyError):
+            cache.get_token(b'a')
+
+        # The least recently used token is evicted when full
+        cache.add_token({CK.AUD: 'rs', CK.SCOPE: 'read'}, b'c')
+        cache.add_token({CK.AUD: 'rs', CK.SCOPE: 'read'}, b'd')
+        assert b'b' not in cache and b'c' in cache and len(cache) == 2
+
+        with self.assertRaises(ValueError):
+            cache.add_token({CK.AUD: 'rs', CK.SCOPE: ['read']}, b'e')
+
+
+class TestScopeMap(unittest.TestCase):
+
+    def test_scope_map(self):
+        scopes = ScopeMap(['read', 'write', 'delete'])
+
+        assert scopes.mask('read,delete') == 0b101
+        assert scopes.mask(['write']) == 0b010
+        assert scopes.mask('read,execute') is None
+        assert scopes.mask('read,execute', strict=False) == 0b001
+        assert scopes.names(0b110) == ['write', 'delete']
+
+
+class TestSigningService(unittest.TestCase):
+
+    def setUp(self):
+        self.key = SigningKey.generate(curve=NIST256p)
+        self.pk = self.key.get_verifying_key()
+
+    def sign_tokens(self, service, count, return_exceptions=False):
+        tokens = [AccessToken(claims={CK.AUD: 'tempSensor0', CK.CTI: str(i)}) for i in range(count)]
+        return run(asyncio.gather(*[t.sign_and_export_self_contained_async(service, key_id=b'') for t in tokens],
+                                  return_exceptions=return_exceptions))
+
+    def test_thread_pool(self):
+        service = SigningService.with_thread_pool(self.key, workers=2, max_batch=4)
+
+        signed = self.sign_tokens(service, 10)
+        service.shutdown()
+
+        assert [cwt.decode(t, self.pk)[CK.CTI] for t in signed] == [str(i) for i in range(10)]
+
+    def test_process_pool(self):
+        service = SigningService.with_process_pool(self.key, workers=1)
+
+        signed = self.sign_tokens(service, 3)
+        service.shutdown()
+
+        assert [cwt.decode(t, self.pk)[CK.CTI] for t in signed] == ['0', '1', '2']
+
+    def test_overload(self):
+        service = SigningService.with_thread_pool(self.key, workers=1, max_queue=2)
+
+        results = self.sign_tokens(service, 3, return_exceptions=True)
+        service.shutdown()
+
+        assert isinstance(results[2], SigningServiceOverloaded)
+        assert cwt.decode(results[0], self.pk)[CK.CTI] == '0'
+
+    def test_shutdown(self):
+        service = SigningService.with_thread_pool(self.key, workers=1)
+        service.shutdown()
+
+        # Fails instead of waiting for a batch that is never signed
+        results = run(asyncio.wait_for(asyncio.gather(service.sign(b'x'), service.sign_digest(bytes(32)),
+                                                      return_exceptions=True), timeout=5))
+
+        assert all(isinstance(result, SigningServiceUnavailable) for result in results)
+        assert service.queue_depth == 0
+
+
+class TestClientRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ClientRegistry(cache_size=1)
+        self.registry.register_client(Client('client-1', b'secret-1', grants=[]))
+        self.registry.register_client(Client('client-2', b'secret-2', grants=[]))
+
+    def test_check_secret(self):
+        assert self.registry.client_exists('client-1')
+        assert not self.registry.client_exists('client-3')
+
+        assert b'secret-1' != self.registry.get_client('client-1').secret_hash
+
+        assert self.registry.check_secret('client-1', b'secret-1')
+        assert not self.registry.check_secret('client-1', b'secret-2')
+        assert not self.registry.check_secret('client-3', b'secret-1')
+
+    def test_verification_cache(self):
+        assert self.registry.check_secret('client-1', b'secret-1')
+
+        # Cached verification must still reject other secrets
+        assert not self.registry.check_secret('client-1', b'wrong')
+        assert self.registry.check_secret('client-1', b'secret-1')
+
+        # Only a keyed MAC of the secret is kept, not a plain hash
+        assert self.registry._verified.get('client-1') != hashlib.sha256(b'secret-1').digest()
+
+        # Evicts client-1 from the cache
+        assert self.registry.check_secret('client-2', b'secret-2')
+        assert self.registry.check_secret('client-1', b'secret-1')
+
+
+class TestSQLiteStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'as.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_warm_start(self):
+        pop_key = CoseKey(SigningKey.generate(curve=NIST256p).get_verifying_key(), b'pop-key', CoseKey.Type.ECDSA)
+
+        valid = AccessToken(claims={CK.CTI: 'a', CK.EXP: int(time.time() + 60)})
+        valid.bind_key(pop_key)
+        expired = AccessToken(claims={CK.CTI: 'b', CK.EXP: int(time.time() - 60)})
+
+        store = SQLiteStore(self.path)
+        tokens = TokenRegistry(store=store)
+        keys = KeyRegistry(store=store)
+        tokens.add_token(valid)
+        tokens.add_token(expired)
+        tokens.add_token(valid, self_contained=False)
+        keys.add_key('client-1', pop_key, expires=valid.expires)
+        store.close()
+
+        # Simulate a restart
+        store = SQLiteStore(self.path)
+        tokens = TokenRegistry(store=store)
+        keys = KeyRegistry(store=store)
+
+        assert len(tokens) == 0
+
+        restored = tokens.get_token(cti='a')
+        assert restored.claims == valid.claims
+        assert restored.bound_key.encode() == pop_key.encode()
+        assert tokens.get_token(reference=valid.reference).cti == 'a'
+        assert keys.find_key('client-1', b'pop-key').encode() == pop_key.encode()
+        # Restored keys still expire with their token
+        assert keys.registry._entries[('client-1', b'pop-key')][1] == valid.expires
+
+        with self.assertRaises(KeyError):
+            tokens.get_token(cti='b')
+
+        store.close()
+
+    def test_write_failure(self):
+        store = SQLiteStore(self.path, retries=1, retry_delay=0.0)
+
+        # A batch that can not be committed is retried, then reported to the next flush()
+        store._queue.put(('INSERT INTO keys (client_id) VALUES (?)', ('client-1',)))
+        with self.assertRaises(sqlite3.Error):
+            store.flush()
+        assert store.failed_writes == 1
+
+        pop_key = CoseKey(SigningKey.generate(curve=NIST256p).get_verifying_key(), b'pop-key', CoseKey.Type.ECDSA)
+        store.put_key('client-1', pop_key)
+        store.flush()
+        assert store.load_key('client-1', b'pop-key')[1] is None
+
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
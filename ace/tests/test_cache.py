@@ -0,0 +1,71 @@
+import unittest
+from ace.cache import LRUCache, ExpiringDict
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert 'a' in cache and 'c' in cache
+        assert 'b' not in cache
+
+    def test_expiry(self):
+        clock = Clock()
+        tokens = ExpiringDict(clock=clock)
+
+        tokens.set('short', 1, expires=clock.now + 10)
+        tokens.set('long', 2, expires=clock.now + 100)
+        tokens.set('forever', 3)
+
+        clock.now += 50
+        tokens.expire()
+
+        assert len(tokens) == 2
+        assert tokens.get('short') is None
+        assert tokens.get('long') == 2
+        assert tokens.stats()['expired'] == 1
+
+        # Expired entries are also rejected before the wheel got to them
+        clock.now += 50
+        assert tokens.get('long') is None
+        assert tokens.get('forever') == 3
+
+    def test_reinsert(self):
+        clock = Clock()
+        tokens = ExpiringDict(clock=clock)
+
+        tokens.set('token', 1, expires=clock.now + 10)
+        tokens.set('token', 2, expires=clock.now + 100)
+
+        clock.now += 50
+        tokens.expire()
+
+        assert tokens.get('token') == 2
+
+    def test_capacity(self):
+        clock = Clock()
+        tokens = ExpiringDict(capacity=2, clock=clock)
+
+        for i in range(5):
+            tokens.set(i, i, expires=clock.now + 10)
+
+        assert len(tokens) == 2
+        assert tokens.stats()['evicted'] == 3
+        assert 3 in tokens and 4 in tokens
+
+
+if __name__ == '__main__':
+    unittest.main()
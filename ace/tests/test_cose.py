@@ -1,10 +1,22 @@
+import asyncio
+import time
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from ecdsa import SigningKey, NIST256p
 from ace.cose.constants import Header, Key, Algorithm
-from ace.cose import Encrypt0Message, cwt
+from ace.cose import Encrypt0Message, CoseKey, cwt
 from ace.cbor.constants import Keys as CK
-from ace.edhoc.util import ecdsa_key_to_cose
-from cbor2 import dumps
+from ace.cose.cose import aead_algorithms, Signature1Message, Mac0Message, SignatureVerificationFailed, MacVerificationFailed
+from ace.cose.signing import as_signer, as_verifier, generate_signing_key, PrecomputedNonceSigner, CRYPTOGRAPHY, ECDSA
+from ecdsa.util import sigdecode_string
+from ace.edhoc.util import ecdsa_key_to_cose, ecdh_key_to_cose, ecdh_cose_to_key, cose_to_verifier, decode_cose_key
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+from cbor2 import dumps, loads, CBORTag
+import hashlib
+import hmac
+import pickle
 
 
 class TestCose(unittest.TestCase):
@@ -26,6 +38,278 @@ class TestCose(unittest.TestCase):
         payload = cwt.decode(token, pk)
         print(payload)
 
+    def test_signature_backends(self):
+        key = SigningKey.generate(curve=NIST256p)
+        pk = key.get_verifying_key()
+
+        claims = { CK.AUD: 'thatSensor01', CK.SCOPE: 'r' }
+
+        for (sign_with, verify_with) in [(CRYPTOGRAPHY, ECDSA), (ECDSA, CRYPTOGRAPHY)]:
+            token = cwt.encode(claims, as_signer(key, sign_with), kid=b'')
+            assert cwt.decode(token, as_verifier(pk, verify_with)) == claims
+
+        # COSE key encoding must not depend on the backend
+        assert ecdsa_key_to_cose(pk) == ecdsa_key_to_cose(as_verifier(pk, CRYPTOGRAPHY))
+
+    def test_signature_verification_failed(self):
+        key = SigningKey.generate(curve=NIST256p)
+        other = SigningKey.generate(curve=NIST256p)
+
+        token = cwt.encode({ CK.AUD: 'thatSensor01' }, key, kid=b'')
+
+        with self.assertRaises(SignatureVerificationFailed):
+            cwt.decode(token, other.get_verifying_key())
+
+    def test_streaming_verify(self):
+        key = SigningKey.generate(curve=NIST256p)
+        pk = key.get_verifying_key()
+
+        payload = b'x' * 1000
+        token = cwt.encode({ CK.AUD: 'thatSensor01', CK.CNF: payload }, key, kid=b'kid')
+        protected = loads(token).value[0]
+
+        # Standard COSE_Sign1 with an unprotected map instead of an encoded map, tagged and untagged
+        message = Signature1Message(payload=payload, protected_header=protected, unprotected_header={ Header.KID: b'kid' })
+        signed = message.serialize_signed(key)
+
+        assert Signature1Message.verify(signed, pk, external_aad=b'') == payload
+        assert Signature1Message.verify(dumps(loads(signed).value), pk, external_aad=b'') == payload
+
+        with self.assertRaises(SignatureVerificationFailed):
+            Signature1Message.verify(signed[:-10], pk, external_aad=b'')
+
+        with self.assertRaises(SignatureVerificationFailed):
+            Signature1Message.verify(dumps(CBORTag(17, loads(signed).value)), pk, external_aad=b'')
+
+    def test_cwt_template(self):
+        key = SigningKey.generate(curve=NIST256p)
+        cose_key = ecdsa_key_to_cose(key.get_verifying_key(), kid=b'you-know-that-one')
+
+        template = cwt.CwtTemplate(kid=b'ace.as-server.com',
+                                   static_claims={ CK.ISS: 'ace.as-server.com', CK.AUD: 'thatSensor01' })
+
+        for aud in ['thatSensor01', 'otherSensor02']:
+            claims = {
+                CK.ISS: 'ace.as-server.com',
+                CK.IAT: 234234,
+                CK.CTI: '0a1b',
+                CK.SCOPE: 'r',
+                CK.AUD: aud,
+                CK.CNF: { Key.COSE_KEY: cose_key }
+            }
+
+            expected = cwt.prepare(claims, kid=b'ace.as-server.com')
+            prepared = template.prepare(claims)
+
+            assert prepared.to_be_signed() == expected.to_be_signed()
+            assert prepared.serialize(b'\x01' * 64) == expected.serialize(b'\x01' * 64)
+
+        assert cwt.decode(template.encode(claims, key), key.get_verifying_key()) == claims
+
+    def test_precomputed_nonces(self):
+        key = SigningKey.generate(curve=NIST256p)
+        signer = PrecomputedNonceSigner(key, pool_size=8, low_water=4)
+
+        for _ in range(100):
+            if signer.stats()['pool'] == 8:
+                break
+            time.sleep(0.01)
+
+        digest = hashlib.sha256(b'data').digest()
+        signatures = [signer.sign_digest(digest) for _ in range(12)]
+
+        # Nonces are never reused
+        assert len(set(s[:32] for s in signatures)) == 12
+        for library in (CRYPTOGRAPHY, ECDSA):
+            verifier = as_verifier(key.get_verifying_key(), library)
+            assert all(verifier.verify_digest(s, digest) for s in signatures)
+            assert verifier.verify(signer.sign(b'data'), b'data')
+
+        stats = signer.stats()
+        assert stats['signed'] + stats['fallbacks'] == 14 and stats['signed'] >= 8 and stats['refills'] >= 1
+
+        token = cwt.encode({ CK.CTI: '1' }, signer, kid=b'')
+        assert cwt.decode(token, signer.verifier()) == { CK.CTI: '1' }
+
+        # Copies must not share the pool
+        assert type(pickle.loads(pickle.dumps(signer))) is type(signer.base)
+
+        signer.close()
+        assert signer.stats()['pool'] == 0
+        assert key.get_verifying_key().verify_digest(signer.sign_digest(digest), digest, sigdecode=sigdecode_string)
+
+        for low_water in (-1, 9):
+            with self.assertRaises(ValueError):
+                PrecomputedNonceSigner(key, pool_size=8, low_water=low_water)
+
+        # Counters stay exact when several threads sign at once
+        signer = PrecomputedNonceSigner(key, pool_size=16, low_water=8)
+        threads = [threading.Thread(target=lambda: [signer.sign_digest(digest) for _ in range(50)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        signer.close()
+
+        stats = signer.stats()
+        assert stats['signed'] + stats['fallbacks'] == 200
+
+    def test_eddsa(self):
+        key = generate_signing_key(Key.Curve.Ed25519)
+        claims = { CK.AUD: 'thatSensor01', CK.SCOPE: 'r', CK.IAT: 234234 }
+
+        token = cwt.encode(claims, key, kid=b'')
+        assert loads(loads(token).value[0]) == { Header.ALG: Algorithm.EdDSA }
+        assert len(loads(token).value[3]) == 64
+        assert cwt.decode(token, key.public_key()) == claims
+
+        template = cwt.CwtTemplate(kid=b'', alg=Algorithm.EdDSA)
+        assert template.encode(claims, key) == token
+
+        with self.assertRaises(SignatureVerificationFailed):
+            cwt.decode(token, generate_signing_key(Key.Curve.Ed25519).public_key())
+
+        # Digests are unsupported for good, not unimplemented
+        assert not as_signer(key).prehash and not as_verifier(key.public_key()).prehash
+        for unsupported in [lambda: as_signer(key).sign_digest(bytes(32)),
+                            lambda: as_verifier(key.public_key()).verify_digest(bytes(64), bytes(32)),
+                            lambda: as_verifier(key.public_key()).public_numbers()]:
+            with self.assertRaises(TypeError):
+                unsupported()
+
+        # OKP COSE_Key with the 32 byte public key only
+        cose_key = loads(ecdsa_key_to_cose(key.public_key(), kid=b'pop'))
+        assert cose_key[Key.KTY] == Key.Type.OKP and len(cose_key[Key.X]) == 32 and Key.Y not in cose_key
+
+        decoded = CoseKey.from_cose(dumps(cose_key))
+        assert decoded.key_id == b'pop'
+        assert cwt.decode(token, decoded.key) == claims
+        assert cwt.decode(token, pickle.loads(pickle.dumps(as_verifier(key.public_key())))) == claims
+        assert cwt.decode(cwt.encode(claims, pickle.loads(pickle.dumps(as_signer(key))), b''), decoded.key) == claims
+
+    def test_cose_key_codec(self):
+        vk = SigningKey.generate(curve=NIST256p).get_verifying_key()
+        encoded = ecdsa_key_to_cose(vk, kid=b'pop-key')
+
+        assert decode_cose_key(encoded) == loads(encoded)
+
+        extended = dumps({ **loads(encoded), Key.KEY_OPS: [Key.Op.VERIFY], 'label': 'value', Key.ALG: Algorithm.ES256 })
+        assert decode_cose_key(extended) == { k: v for (k, v) in loads(extended).items() if k != Key.KEY_OPS }
+
+        for malformed in [dumps([1, 2]), encoded[:-1], dumps({ 1.5: 2 })]:
+            with self.assertRaises(ValueError):
+                decode_cose_key(malformed)
+
+        # Repeated keys are served from the cache without decoding and validating them again
+        cose_key = CoseKey.from_cose(encoded)
+        assert CoseKey.from_cose(bytearray(encoded)).key is cose_key.key
+        assert cose_key.encode() == encoded
+        assert cose_key.key.public_numbers()[1:] == (vk.pubkey.point.x(), vk.pubkey.point.y())
+        assert cose_to_verifier(encoded) is cose_key.key
+
+        ecdh_key = ecdh_key_to_cose(ec.generate_private_key(ec.SECP256R1(), default_backend()).public_key())
+        assert ecdh_cose_to_key(ecdh_key) is ecdh_cose_to_key(ecdh_key)
+
+        # COSE_Key objects and the EDHOC helpers share one cache
+        ecdh_key = ecdh_key_to_cose(ec.generate_private_key(ec.SECP256R1(), default_backend()).public_key(), kid=b'e')
+        assert CoseKey.from_cose(ecdh_key, CoseKey.Type.ECDHE).key is ecdh_cose_to_key(ecdh_key)
+
+    def test_mac0(self):
+        key = bytes(range(32))
+        claims = { CK.AUD: 'thatSensor01', CK.SCOPE: 'r', CK.IAT: 234234 }
+
+        for (alg, length) in [(Algorithm.HMAC_256_256, 32), (Algorithm.HMAC_256_64, 8)]:
+            token = cwt.encode_mac(claims, key, kid=b'ace.as-server.com', alg=alg)
+            (protected, unprotected, payload, tag) = loads(token).value
+
+            message = Mac0Message(payload=payload, protected_header=protected, unprotected_header=unprotected)
+            expected = hmac.new(key, message.to_be_maced(), hashlib.sha256).digest()[:length]
+
+            assert loads(token).tag == 17
+            assert tag == expected
+            assert cwt.is_maced(token)
+            assert cwt.decode_mac(token, key) == claims
+
+            with self.assertRaises(MacVerificationFailed):
+                cwt.decode_mac(token, bytes(32))
+
+            with self.assertRaises(MacVerificationFailed):
+                Mac0Message.verify(dumps(CBORTag(17, [protected, unprotected, payload + b'\x00', tag])), key, b'')
+
+        template = cwt.CwtTemplate(kid=b'ace.as-server.com', static_claims={ CK.AUD: 'thatSensor01' },
+                                   alg=Algorithm.HMAC_256_64)
+        assert template.encode_mac(claims, key) == cwt.encode_mac(claims, key, b'ace.as-server.com',
+                                                                  alg=Algorithm.HMAC_256_64)
+
+        # A signed token is no COSE_Mac0
+        signed = cwt.encode(claims, SigningKey.generate(curve=NIST256p), kid=b'')
+        assert not cwt.is_maced(signed)
+        with self.assertRaises(MacVerificationFailed):
+            cwt.decode_mac(signed, key)
+
+    def test_aead_algorithms(self):
+        for (alg, parameters) in aead_algorithms.items():
+            key = bytes(range(parameters.key_length))
+            iv = bytes(parameters.nonce_length)
+
+            encrypted = Encrypt0Message(plaintext=b'plaintext',
+                                        protected_header=dumps({ Header.ALG: alg }),
+                                        unprotected_header={ Header.IV: iv },
+                                        external_aad=b'aad').serialize(iv, key)
+
+            (protected, unprotected, ciphertext) = loads(encrypted).value
+            assert len(ciphertext) == len(b'plaintext') + parameters.tag_length
+            assert Encrypt0Message.decrypt(encrypted, key, iv, external_aad=b'aad') == b'plaintext'
+
+        # Without an alg in the protected header the caller's alg applies
+        key = bytes(32)
+        encrypted = Encrypt0Message(plaintext=b'plaintext',
+                                    protected_header=b'',
+                                    unprotected_header={},
+                                    alg=Algorithm.CHACHA20_POLY1305).serialize(bytes(12), key)
+
+        assert Encrypt0Message.decrypt(encrypted, key, bytes(12), b'', alg=Algorithm.CHACHA20_POLY1305) == b'plaintext'
+        with self.assertRaises(ValueError):
+            Encrypt0Message.decrypt(encrypted, key, bytes(12), b'', alg=-1)
+
+        # The sender can not override the caller's alg
+        encrypted = Encrypt0Message(plaintext=b'plaintext',
+                                    protected_header=dumps({ Header.ALG: Algorithm.A256GCM }),
+                                    unprotected_header={},
+                                    alg=Algorithm.CHACHA20_POLY1305).serialize(bytes(12), key)
+        (protected, unprotected, ciphertext) = Encrypt0Message.parse(encrypted)
+        assert Encrypt0Message.algorithm(protected, Algorithm.CHACHA20_POLY1305) == Algorithm.CHACHA20_POLY1305
+        assert Encrypt0Message.decrypt(encrypted, key, bytes(12), b'', alg=Algorithm.CHACHA20_POLY1305) == b'plaintext'
+
+        for protected in (dumps([Header.ALG]), dumps(7), b'\xff', dumps({ Header.ALG: -1 })):
+            with self.assertRaises(ValueError):
+                Encrypt0Message.algorithm(protected)
+
+    def test_decode_many(self):
+        key = SigningKey.generate(curve=NIST256p)
+        mac_key = bytes(32)
+
+        tokens = [cwt.encode({ CK.CTI: str(i) }, key, kid=b'') for i in range(10)]
+        tokens[3] = cwt.encode_mac({ CK.CTI: '3' }, mac_key, kid=b'')
+        tokens[5] = tokens[5][:-1] + bytes([tokens[5][-1] ^ 1])
+        tokens[7] = b'not a token'
+
+        resolver = lambda token: mac_key if cwt.is_maced(token) else key.get_verifying_key()
+
+        def check(results):
+            assert len(results) == 10
+            assert isinstance(results[5], SignatureVerificationFailed)
+            assert isinstance(results[7], Exception)
+            assert [r[CK.CTI] for (i, r) in enumerate(results) if i not in (5, 7)] == \
+                   [str(i) for i in range(10) if i not in (5, 7)]
+
+        check(cwt.decode_many(tokens, resolver))
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        check(asyncio.get_event_loop().run_until_complete(
+            cwt.decode_many_async(tokens, resolver, executor=executor, chunk_size=3)))
+        executor.shutdown()
+
     def test_encrypt0(self):
         """ Test parameters from https://github.com/cose-wg/Examples/blob/master/RFC8152/Appendix_C_4_1.json"""
         plaintext = b"This is the content."
@@ -1,8 +1,17 @@
+import os
+import tempfile
 import unittest
 import hashlib
 from ecdsa import SigningKey, NIST256p, NIST384p
 from ace.edhoc import Client, Server, OscoreContext, bxor
+from ace.client import Client as AceClient
+from ace.edhoc.context import partial_iv, MAX_SEQUENCE_NUMBER, ReplayError, ReplayWindow
+from ace.edhoc import store as context_store
+from ace.edhoc.store import ContextStore, SharedReplayWindow
 from ace.edhoc.util import ecdsa_key_to_cose, ecdsa_cose_to_key
+from ace.cose.constants import Key, Algorithm
+from ace.cose.signing import generate_signing_key
+from cbor2 import dumps
 
 
 class TestEdhoc(unittest.TestCase):
@@ -57,6 +66,108 @@ class TestEdhoc(unittest.TestCase):
         client_plaintext = b"hello from client"
         assert server_ctx.decrypt(client_ctx.encrypt(client_plaintext)) == client_plaintext
 
+    def test_partial_iv(self):
+        assert [partial_iv(n) for n in (0, 255, 256, MAX_SEQUENCE_NUMBER)] == \
+            [b'\x00', b'\xff', b'\x01\x00', b'\xff' * 5]
+
+        with self.assertRaises(ValueError):
+            partial_iv(MAX_SEQUENCE_NUMBER + 1)
+
+        message1 = self.client.initiate_edhoc()
+        message2 = self.server.on_receive(bytes(message1))
+        message3 = self.client.continue_edhoc(bytes(message2))
+        self.server.on_receive(bytes(message3))
+
+        client_ctx = self.client.session.oscore_context
+        server_ctx = self.server.oscore_context_for_recipient(client_ctx.sender_id)
+
+        # Sequence numbers beyond one byte
+        server_ctx.sequence_number = 300
+        assert client_ctx.decrypt(server_ctx.encrypt(b'hello')) == b'hello'
+        assert server_ctx.sequence_number == 301
+
+    def test_replay(self):
+        message1 = self.client.initiate_edhoc()
+        message2 = self.server.on_receive(bytes(message1))
+        message3 = self.client.continue_edhoc(bytes(message2))
+        self.server.on_receive(bytes(message3))
+
+        client_ctx = self.client.session.oscore_context
+        server_ctx = self.server.oscore_context_for_recipient(client_ctx.sender_id)
+
+        (first, second, third) = [client_ctx.encrypt(b'hello') for _ in range(3)]
+        assert server_ctx.decrypt(first) == b'hello'
+        with self.assertRaises(ReplayError):
+            server_ctx.decrypt(first)
+
+        # Reordered messages are accepted once
+        assert server_ctx.decrypt(third) == b'hello'
+        assert server_ctx.decrypt(second) == b'hello'
+        with self.assertRaises(ReplayError):
+            server_ctx.decrypt(second)
+
+    def test_replay_window(self):
+        window = ReplayWindow(size=4)
+        for n in (0, 2, 5):
+            assert window.check(n)
+            window.update(n)
+
+        assert [window.check(n) for n in range(7)] == [False, False, False, True, True, False, True]
+
+    def test_ed25519(self):
+        client_sk = generate_signing_key(Key.Curve.Ed25519)
+        server_sk = generate_signing_key(Key.Curve.Ed25519)
+
+        client = Client(client_sk, server_sk.public_key(), kid=b'client-ed25519')
+        server = Server(server_sk)
+        server.add_peer_identity(client.kid, client_sk.public_key())
+
+        message1 = client.initiate_edhoc()
+        message2 = server.on_receive(bytes(message1))
+        message3 = client.continue_edhoc(bytes(message2))
+        assert bytes(server.on_receive(bytes(message3))) == dumps(["OK"])
+
+        client_ctx = client.session.oscore_context
+        server_ctx = server.oscore_context_for_recipient(client_ctx.sender_id)
+
+        assert client_ctx.master_secret == server_ctx.master_secret
+
+    def test_aead_negotiation(self):
+        server_sk = SigningKey.generate(curve=NIST256p)
+        server = Server(server_sk, aead_algorithms=[Algorithm.A128GCM, Algorithm.CHACHA20_POLY1305])
+
+        offers = [
+            ([Algorithm.CHACHA20_POLY1305, Algorithm.A128GCM], Algorithm.A128GCM),
+            ([Algorithm.CHACHA20_POLY1305], Algorithm.CHACHA20_POLY1305),
+            ([Algorithm.AES_CCM_16_64_256], Algorithm.AES_CCM_16_64_128),
+            (None, Algorithm.AES_CCM_16_64_128)
+        ]
+
+        for (i, (offered, chosen)) in enumerate(offers):
+            client_sk = SigningKey.generate(curve=NIST256p)
+            client = Client(client_sk, server_sk.get_verifying_key(), kid=bytes([i]), aead_algorithms=offered)
+            server.add_peer_identity(client.kid, client_sk.get_verifying_key())
+
+            message1 = client.initiate_edhoc()
+            message2 = server.on_receive(bytes(message1))
+            message3 = client.continue_edhoc(bytes(message2))
+            server.on_receive(bytes(message3))
+
+            client_ctx = client.session.oscore_context
+            server_ctx = server.oscore_context_for_recipient(client_ctx.sender_id)
+
+            assert client_ctx.alg == server_ctx.alg == chosen
+            assert client_ctx.decrypt(server_ctx.encrypt(b'hello')) == b'hello'
+            assert server_ctx.decrypt(client_ctx.encrypt(b'world')) == b'world'
+
+        # 7 byte nonces can not hold the 2 byte session ids
+        with self.assertRaises(ValueError):
+            Server(server_sk, aead_algorithms=[Algorithm.A128GCM, Algorithm.AES_CCM_64_64_128])
+        with self.assertRaises(ValueError):
+            Client(server_sk, server_sk.get_verifying_key(), kid=b'', aead_algorithms=[Algorithm.AES_CCM_64_64_256])
+        with self.assertRaises(ValueError):
+            OscoreContext(b'secret', b'salt', b'\x01\x02', b'\x03', Algorithm.AES_CCM_64_64_128)
+
     def test_multiple_clients(self):
         # 1st Client
         client1_key = SigningKey.generate(curve=NIST256p)
@@ -122,5 +233,100 @@ class TestEdhoc(unittest.TestCase):
         assert (bxor(a, b) == bytes.fromhex("444C"))
 
 
+class TestContextStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'contexts.db')
+
+        secret = bytes.fromhex("0102030405060708090a0b0c0d0e0f10")
+        self.client = OscoreContext(secret, b'salt', b'c', b's')
+        self.server = OscoreContext(secret, b'salt', b's', b'c')
+        self.server.replay_window = ReplayWindow()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def exchange(self, store):
+        store.save(b'c', self.server, peer=b'pop-key')
+
+        requests = [self.client.encrypt(b'hello') for _ in range(20)]
+        for request in requests[:10]:
+            assert self.server.decrypt(request) == b'hello'
+        for _ in range(20):
+            self.server.encrypt(b'hello')
+
+        return requests
+
+    def test_restart(self):
+        store = ContextStore(self.path, checkpoint_interval=16)
+        requests = self.exchange(store)
+        store.close()
+
+        (context, peer) = ContextStore(self.path, checkpoint_interval=16).load(b'c')
+        assert peer == b'pop-key'
+        assert context.sequence_number == 20
+
+        with self.assertRaises(ReplayError):
+            context.decrypt(requests[9])
+        assert context.decrypt(requests[10]) == b'hello'
+        assert self.client.decrypt(context.encrypt(b'hello')) == b'hello'
+
+    def test_crash(self):
+        requests = self.exchange(ContextStore(self.path, checkpoint_interval=16))
+
+        # Without close(), the context continues after the last reserved block
+        (context, peer) = ContextStore(self.path, checkpoint_interval=16).load(b'c')
+        assert context.sequence_number == 32
+
+        # and everything up to one block beyond the last replay checkpoint counts as received
+        with self.assertRaises(ReplayError):
+            context.decrypt(requests[16])
+        assert context.decrypt(requests[17]) == b'hello'
+
+    def test_shared(self):
+        (first, second) = (ContextStore(self.path, shared=True), ContextStore(self.path, shared=True))
+        first.save(b'c', self.server)
+        (context, peer) = second.load(b'c')
+
+        assert isinstance(self.server.replay_window, SharedReplayWindow)
+
+        # Each store reserves its own blocks
+        assert {self.server.next_sequence_number(), context.next_sequence_number()} == {0, 64}
+
+        # A message accepted through one store is a replay for the other, in either order
+        requests = [self.client.encrypt(b'hello') for _ in range(2)]
+        assert self.server.decrypt(requests[0]) == b'hello'
+        with self.assertRaises(ReplayError):
+            context.decrypt(requests[0])
+        assert context.decrypt(requests[1]) == b'hello'
+        with self.assertRaises(ReplayError):
+            self.server.decrypt(requests[1])
+
+    def test_without_returning(self):
+        context_store.RETURNING_SUPPORTED = False
+        try:
+            store = ContextStore(self.path, checkpoint_interval=16)
+            self.exchange(store)
+        finally:
+            context_store.RETURNING_SUPPORTED = True
+
+        (context, peer) = ContextStore(self.path, checkpoint_interval=16).load(b'c')
+        assert context.sequence_number == 32
+
+    def test_resume_session(self):
+        client = AceClient('client', b'secret', context_store=ContextStore(self.path))
+        assert client.resume_session('coap://localhost') is None
+
+        client.context_store.save(b'coap://localhost', self.client, peer=b'pop-key')
+        self.client.encrypt(b'hello')
+        client.context_store.close()
+
+        session = AceClient('client', b'secret', context_store=ContextStore(self.path)).resume_session('coap://localhost')
+        assert session.pop_key_id == b'pop-key'
+        assert session.oscore_context.sequence_number == 1
+        assert self.server.decrypt(session.oscore_context.encrypt(b'hello')) == b'hello'
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -30,6 +30,10 @@ async def main():
     response = await client.access_resource(session, RS_URL, '/temperature')
     print(f"Response: {response}")
 
+    # Observe temperature resource
+    async for notification in client.observe_resource(session, RS_URL, '/temperature'):
+        print(f"Notification: {notification}")
+
 
 if __name__ == "__main__":
     asyncio.get_event_loop().run_until_complete(main())
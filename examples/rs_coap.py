@@ -3,30 +3,18 @@ import random
 
 import aiocoap
 from aiocoap import resource, Context
-from cbor2 import dumps, loads
+from cbor2 import dumps
 from ecdsa import SigningKey, VerifyingKey
 
-from ace.rs.coap import CoAPResourceServer
-from ace.rs import NotAuthorizedException
+from ace.rs.coap import CoAPResourceServer, ObservableProtectedResource
 
 
-class TemperatureResource(resource.Resource):
-
-    def __init__(self, scope, resource_server):
-        super().__init__()
-        self.scope = scope
-        self.resource_server = resource_server
-
-    async def render_get(self, request):
-        prot, unprot, cipher = loads(request.payload).value
-        try:
-            oscore_context = self.resource_server.oscore_context(unprot, self.scope)
-        except NotAuthorizedException:
-            return aiocoap.Message(code=aiocoap.UNAUTHORIZED)
+class TemperatureResource(ObservableProtectedResource):
 
+    async def render_protected_get(self, request, message):
         temperature = random.randint(8, 42)
 
-        response = oscore_context.encrypt(dumps({'temperature': f"{temperature}C"}))
+        response = message.oscore_context.encrypt(dumps({'temperature': f"{temperature}C"}))
 
         return aiocoap.Message(payload=response)
 
@@ -42,7 +30,13 @@ class TemperatureServer(CoAPResourceServer):
                  client_id=None,
                  client_secret=None):
         super().__init__(audience, identity, as_url, as_public_key, site, client_id, client_secret)
-        self.site.add_resource(('temperature',), TemperatureResource("read_temperature", self))
+        self.temperature = TemperatureResource("read_temperature", self)
+        self.site.add_resource(('temperature',), self.temperature)
+
+    async def notify_observers(self, interval: float = 5.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.temperature.updated_state()
 
 
 if __name__ == "__main__":
@@ -77,4 +71,5 @@ if __name__ == "__main__":
         site=root
     )
     asyncio.ensure_future(Context.create_server_context(server.site), loop=loop)
+    asyncio.ensure_future(server.notify_observers(), loop=loop)
     loop.run_forever()
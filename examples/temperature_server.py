@@ -22,17 +22,17 @@ class TemperatureServer(HTTPResourceServer):
         router.add_get('/temperature', self.wrap(scope="read_temperature", handler=self.get_temperature))
         router.add_post('/led', self.wrap(scope="post_led", handler=self.post_led))
 
-    async def post_led(self, request, payload, token, oscore_context):
-        data = loads(oscore_context.decrypt(payload))
+    async def post_led(self, request, message):
+        data = loads(message.payload)
 
         print(f"Setting LED value to: {data[b'led_value']}")
 
-        response = oscore_context.encrypt(dumps(b'OK'))
+        response = message.oscore_context.encrypt(dumps(b'OK'))
         return web.Response(status=201, body=response)
 
     # GET /temperature
-    async def get_temperature(self, request, payload, token, oscore_context):
+    async def get_temperature(self, request, message):
         temperature = random.randint(22, 26)
-        response = oscore_context.encrypt(dumps({'temperature': f"{temperature}C"}))
+        response = message.oscore_context.encrypt(dumps({'temperature': f"{temperature}C"}))
 
         return web.Response(status=200, body=response)